@@ -27,11 +27,20 @@ method to make a substitution (or ``tmpl.substitute(a_dict)``).
 can use ``__name='tmpl.html'`` to set the name of the template.
 
 If there are syntax errors ``TemplateError`` will be raised.
+
+Templates are interpreted by walking the parsed template on every
+substitution.  With ``Template(content, compiled=True)`` (or
+``Template.compiled = True``) the template is instead compiled once into
+a Python render function, see ``compile_template``; functions are shared
+by all templates with the same content, and with ``cache_dir=...`` they
+are also kept on disk across processes.
 """
 
 import re
 import sys
 import cgi
+import hashlib
+import marshal
 from urllib import quote as url_quote
 import os
 import tokenize
@@ -90,11 +99,14 @@ class Template(object):
 
     default_encoding = 'utf8'
     default_inherit = None
+    compiled = False
+    cache_dir = None
 
     def __init__(self, content, name=None, namespace=None, stacklevel=None,
                  get_template=None, default_inherit=None, line_offset=0,
-                 delimiters=None):
+                 delimiters=None, compiled=None, cache_dir=None):
         self.content = content
+        self.line_offset = line_offset
 
         # set delimiters
         if delimiters is None:
@@ -135,16 +147,23 @@ class Template(object):
         self.get_template = get_template
         if default_inherit is not None:
             self.default_inherit = default_inherit
+        if compiled is not None:
+            self.compiled = compiled
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
+        self._render = None
 
     def from_filename(cls, filename, namespace=None, encoding=None,
-                      default_inherit=None, get_template=get_file_template):
+                      default_inherit=None, get_template=get_file_template,
+                      compiled=None, cache_dir=None):
         f = open(filename, 'rb')
         c = f.read()
         f.close()
         if encoding:
             c = c.decode(encoding)
         return cls(content=c, name=filename, namespace=namespace,
-                   default_inherit=default_inherit, get_template=get_template)
+                   default_inherit=default_inherit, get_template=get_template,
+                   compiled=compiled, cache_dir=cache_dir)
 
     from_filename = classmethod(from_filename)
 
@@ -181,13 +200,26 @@ class Template(object):
         __traceback_hide__ = True
         parts = []
         defs = {}
-        self._interpret_codes(self._parsed, ns, out=parts, defs=defs)
+        if self.compiled:
+            self.compiled_render()(self, ns, parts, defs)
+        else:
+            self._interpret_codes(self._parsed, ns, out=parts, defs=defs)
         if '__inherit__' in defs:
             inherit = defs.pop('__inherit__')
         else:
             inherit = None
         return ''.join(parts), defs, inherit
 
+    def compiled_render(self):
+        """
+        Return the compiled render function for this template, compiling
+        it (or loading it from ``cache_dir``) on first use
+        """
+        if self._render is None:
+            key = compile_key(self.content, self.delimiters, self.line_offset)
+            self._render = load_compiled(key, self._parsed, self.cache_dir)
+        return self._render
+
     def _interpret_inherit(self, body, defs, inherit_template, ns):
         __traceback_hide__ = True
         if not self.get_template:
@@ -504,7 +536,7 @@ def sub_html(content, **kw):
 
 class TemplateDef(object):
     def __init__(self, template, func_name, func_signature,
-                 body, ns, pos, bound_self=None):
+                 body, ns, pos, bound_self=None, render=None):
         self._template = template
         self._func_name = func_name
         self._func_signature = func_signature
@@ -512,6 +544,7 @@ class TemplateDef(object):
         self._ns = ns
         self._pos = pos
         self._bound_self = bound_self
+        self._render = render
 
     def __repr__(self):
         return '<tempita function %s(%s) at %s:%s>' % (
@@ -529,7 +562,10 @@ class TemplateDef(object):
             ns['self'] = self._bound_self
         out = []
         subdefs = {}
-        self._template._interpret_codes(self._body, ns, out, subdefs)
+        if self._render is not None:
+            self._render(self._template, ns, out, subdefs)
+        else:
+            self._template._interpret_codes(self._body, ns, out, subdefs)
         return ''.join(out)
 
     def __get__(self, obj, type=None):
@@ -537,7 +573,8 @@ class TemplateDef(object):
             return self
         return self.__class__(
             self._template, self._func_name, self._func_signature,
-            self._body, self._ns, self._pos, bound_self=obj)
+            self._body, self._ns, self._pos, bound_self=obj,
+            render=self._render)
 
     def _parse_signature(self, args, kw):
         values = {}
@@ -1107,6 +1144,219 @@ def isolate_expression(string, start_pos, end_pos):
         parts.append(lines[erow][:ecol])
     return ''.join(parts)
 
+############################################################
+## Compiling
+############################################################
+
+_compile_magic = 'tempita-compiled-1'
+_compiled_cache = {}
+_compiled_cache_max = 500
+
+
+def compile_key(content, delimiters, line_offset=0):
+    """
+    Key of the compiled form of a template: a hash of its content,
+    delimiters and line offset, and of the Python version
+    """
+    h = hashlib.sha1()
+    if is_unicode(content):
+        h.update(b'u' + content.encode('utf8'))
+    else:
+        h.update(b'b' + content)
+    extra = (delimiters, line_offset, sys.version_info[:2], _compile_magic)
+    h.update(repr(extra).encode('utf8'))
+    return h.hexdigest()
+
+
+def load_compiled(key, parsed, cache_dir=None):
+    """
+    Return the render function for the parsed template `parsed`, from
+    memory, from ``cache_dir/<key>.tmplc``, or by compiling it (and then
+    writing it to `cache_dir`)
+    """
+    render = _compiled_cache.get(key)
+    if render is not None:
+        return render
+    code = None
+    if cache_dir:
+        path = os.path.join(cache_dir, key + '.tmplc')
+        try:
+            f = open(path, 'rb')
+            try:
+                magic, code, constants = marshal.load(f)
+            finally:
+                f.close()
+            if magic != _compile_magic:
+                code = None
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            code = None
+    if code is None:
+        code, constants = compile_template(parsed)
+        if cache_dir:
+            _write_compiled(path, (_compile_magic, code, constants))
+    ns = {'_k': constants, 'TemplateDef': TemplateDef,
+          '_TemplateContinue': _TemplateContinue,
+          '_TemplateBreak': _TemplateBreak}
+    exec(code, ns)
+    if len(_compiled_cache) >= _compiled_cache_max:
+        _compiled_cache.clear()
+    render = _compiled_cache[key] = ns['render']
+    return render
+
+
+def _write_compiled(path, data):
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(tmp, 'wb')
+        try:
+            marshal.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        # The cache is only an optimization
+        pass
+
+
+def compile_template(parsed):
+    """
+    Compile a parsed template (as returned by ``parse``) to Python code.
+
+    Returns ``(code, constants)``.  Executing `code` in a namespace
+    where ``_k`` is `constants` defines ``render(tmpl, ns, out, defs)``,
+    which does what ``tmpl._interpret_codes(parsed, ns, out, defs)``
+    does: text and expression results are appended to `out` and
+    variables live in `ns`.  Expressions and ``py:`` blocks are compiled
+    to code objects once, instead of being passed to ``eval`` as strings
+    on every render; evaluation, quoting and error reporting still go
+    through ``tmpl._eval``, ``tmpl._exec`` and ``tmpl._repr``.
+    ``{{def}}`` bodies become functions of their own.
+    """
+    compiler = _TemplateCompiler()
+    compiler.function('render', parsed)
+    for i in range(len(compiler.constants)):
+        compiler.lines.append('_k%d = _k[%d]' % (i, i))
+    source = '\n'.join(compiler.lines) + '\n'
+    return compile(source, '<tempita compiled>', 'exec'), compiler.constants
+
+
+class _TemplateCompiler(object):
+
+    def __init__(self):
+        self.lines = []
+        self.constants = []
+        self.functions = 0
+
+    def const(self, value):
+        self.constants.append(value)
+        return '_k%d' % (len(self.constants) - 1)
+
+    def code(self, source, mode='eval'):
+        # Source that does not compile is kept as a string, so the
+        # error is raised by _eval/_exec when (and if) it is reached,
+        # as when interpreting.  eval() ignores leading blanks,
+        # compile() does not.
+        if mode == 'eval':
+            stripped = source.lstrip(' \t')
+        else:
+            stripped = source
+        try:
+            return self.const(compile(stripped, '<string>', mode))
+        except SyntaxError:
+            return self.const(source)
+
+    def function(self, name, codes):
+        body = []
+        self.codes(codes, body, 1, 0)
+        self.lines.extend([
+            'def %s(tmpl, ns, out, defs):' % name,
+            '    append = out.append',
+            '    _eval = tmpl._eval',
+            '    _exec = tmpl._exec',
+            '    _repr = tmpl._repr'])
+        self.lines.extend(body)
+
+    def codes(self, codes, out, indent, loop):
+        start = len(out)
+        for item in codes:
+            if isinstance(item, basestring_):
+                out.append('    ' * indent + 'append(%s)' % self.const(item))
+            else:
+                self.item(item, out, indent, loop)
+        if len(out) == start:
+            out.append('    ' * indent + 'pass')
+
+    def item(self, code, out, indent, loop):
+        def w(line, extra=0):
+            out.append('    ' * (indent + extra) + line)
+        name, pos = code[0], code[1]
+        if name == 'comment':
+            return
+        pos = self.const(pos)
+        if name == 'py':
+            w('_exec(%s, ns, %s)' % (self.code(code[2], 'exec'), pos))
+        elif name in ('continue', 'break'):
+            if loop:
+                w(name)
+            elif name == 'continue':
+                w('raise _TemplateContinue()')
+            else:
+                w('raise _TemplateBreak()')
+        elif name == 'for':
+            vars, expr, content = code[2], code[3], code[4]
+            item = 'item%d' % (loop + 1)
+            w('for %s in _eval(%s, ns, %s):' % (item, self.code(expr), pos))
+            if len(vars) == 1:
+                w('ns[%r] = %s' % (vars[0], item), 1)
+            else:
+                w('if len(%s) != %d:' % (item, len(vars)), 1)
+                w("raise ValueError('Need %d items to unpack (got %%i items)'"
+                  " %% len(%s))" % (len(vars), item), 2)
+                w('%s = %s' % (', '.join(['ns[%r]' % v for v in vars]), item), 1)
+            w('try:', 1)
+            self.codes(content, out, indent + 2, loop + 1)
+            w('except _TemplateContinue:', 1)
+            w('continue', 2)
+            w('except _TemplateBreak:', 1)
+            w('break', 2)
+        elif name == 'cond':
+            keyword = 'if'
+            for part in code[2:]:
+                if part[0] == 'else':
+                    w('else:')
+                else:
+                    w('%s _eval(%s, ns, %s):' % (
+                        keyword, self.code(part[2]), self.const(part[1])))
+                self.codes(part[3], out, indent + 1, loop)
+                if part[0] == 'else':
+                    break
+                keyword = 'elif'
+        elif name == 'expr':
+            parts = code[2].split('|')
+            w('value = _eval(%s, ns, %s)' % (self.code(parts[0]), pos))
+            for part in parts[1:]:
+                w('value = _eval(%s, ns, %s)(value)' % (self.code(part), pos))
+            w('append(_repr(value, %s))' % pos)
+        elif name == 'default':
+            var, expr = code[2], code[3]
+            w('if %r not in ns:' % var)
+            w('ns[%r] = _eval(%s, ns, %s)' % (var, self.code(expr), pos), 1)
+        elif name == 'inherit':
+            w("defs['__inherit__'] = _eval(%s, ns, %s)" % (self.code(code[2]), pos))
+        elif name == 'def':
+            func_name, signature, body = code[2], code[3], code[4]
+            self.functions += 1
+            func = 'def%d' % self.functions
+            self.function(func, body)
+            w('ns[%r] = defs[%r] = TemplateDef(tmpl, %r, %s, body=None, ns=ns, '
+              'pos=%s, render=%s)' % (func_name, func_name, func_name,
+                                      self.const(signature), pos, func))
+        else:
+            assert 0, "Unknown code: %r" % name
+
+
 _fill_command_usage = """\
 %prog [OPTIONS] TEMPLATE arg=value
 
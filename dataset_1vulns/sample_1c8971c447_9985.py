@@ -2,11 +2,12 @@ import itertools
 import mimetypes
 import re
 import time
+from collections import deque
 from datetime import datetime
 from urllib import unquote, quote
 from hashlib import md5
 
-from eventlet import sleep, GreenPile
+from eventlet import sleep, spawn, GreenPile
 from eventlet.queue import Queue
 from eventlet.timeout import Timeout
 
@@ -68,6 +69,14 @@ class SegmentedIterable(object):
     `status_int` will be updated (again, just for logging since the original
     status would have already been sent to the client).
 
+    Segments can be read ahead: up to `prefetch_window` segments after the
+    one being sent are fetched concurrently in green threads and buffered,
+    as long as their listed sizes fit in `prefetch_max_bytes` altogether.
+    Output order is unchanged; a segment too large for the buffer is
+    streamed once it is reached, as without read-ahead.  Every buffered
+    segment is checked against the size and ETag of its response (and, for
+    SLO, of the manifest) before any of it is sent.
+
     :param controller: The ObjectController instance to work with.
     :param container: The container the object segments are within. If
                       container is None will derive container from elements
@@ -77,10 +86,16 @@ class SegmentedIterable(object):
                     'bytes' keys.
     :param response: The swob.Response this iterable is associated with, if
                      any (default: None)
+    :param prefetch_window: Number of segments to read ahead; defaults to the
+                            app's `segment_prefetch_window`, or 0 (off)
+    :param prefetch_max_bytes: Cap on the bytes buffered by read-ahead;
+                               defaults to the app's
+                               `segment_prefetch_max_bytes`
     """
 
     def __init__(self, controller, container, listing, response=None,
-                 is_slo=False):
+                 is_slo=False, prefetch_window=None,
+                 prefetch_max_bytes=None):
         self.controller = controller
         self.container = container
         self.listing = segment_listing_iter(listing)
@@ -97,6 +112,159 @@ class SegmentedIterable(object):
         if not self.response:
             self.response = Response()
         self.next_get_time = 0
+        if prefetch_window is None:
+            prefetch_window = getattr(controller.app,
+                                      'segment_prefetch_window', 0)
+        if prefetch_max_bytes is None:
+            prefetch_max_bytes = getattr(controller.app,
+                                         'segment_prefetch_max_bytes',
+                                         64 * 1024 * 1024)
+        self.prefetch_window = int(prefetch_window)
+        self.prefetch_max_bytes = int(prefetch_max_bytes)
+        # (segment_dict, green thread) of segments being read ahead, in
+        # listing order, and the listed bytes they have reserved.
+        self.prefetched = deque()
+        self.prefetched_bytes = 0
+        self.listing_done = False
+
+    def _segment_path(self, segment_dict):
+        if self.container is None:
+            container, obj = segment_dict['name'].lstrip('/').split('/', 1)
+        else:
+            container, obj = self.container, segment_dict['name']
+        return container, obj
+
+    def _rate_limit_time(self, segment):
+        """
+        Returns the time segment number `segment` may be requested at (0 for
+        no wait) and books the slot for the next one.
+        """
+        start_at = 0
+        if not self.is_slo and segment > \
+                self.controller.app.rate_limit_after_segment:
+            start_at = self.next_get_time
+        self.next_get_time = max(start_at, time.time()) + \
+            1.0 / self.controller.app.rate_limit_segments_per_sec
+        return start_at
+
+    def _get_segment(self, segment_dict, seek=0, start_at=0):
+        """
+        Issues the GET for one segment and checks its status and, for SLO,
+        its size and ETag against the manifest.
+
+        :returns: (path, swob.Response)
+        """
+        container, obj = self._segment_path(segment_dict)
+        partition, nodes = self.controller.app.object_ring.get_nodes(
+            self.controller.account_name, container, obj)
+        path = '/%s/%s/%s' % (self.controller.account_name, container, obj)
+        req = Request.blank(path)
+        if seek:
+            req.range = 'bytes=%s-' % seek
+        if start_at:
+            sleep(max(start_at - time.time(), 0))
+        nodes = self.controller.app.sort_nodes(nodes)
+        resp = self.controller.GETorHEAD_base(
+            req, _('Object'), partition,
+            self.controller.iter_nodes(partition, nodes,
+                                       self.controller.app.object_ring),
+            path, len(nodes))
+        if self.is_slo and resp.status_int == HTTP_NOT_FOUND:
+            raise SloSegmentError(_(
+                'Could not load object segment %(path)s:'
+                ' %(status)s') % {'path': path, 'status': resp.status_int})
+        if not is_success(resp.status_int):
+            raise Exception(_(
+                'Could not load object segment %(path)s:'
+                ' %(status)s') % {'path': path, 'status': resp.status_int})
+        if self.is_slo:
+            if (resp.content_length != segment_dict['bytes'] or
+                    resp.etag != segment_dict['hash']):
+                raise SloSegmentError(_(
+                    'Object segment no longer valid: '
+                    '%(path)s etag: %(r_etag)s != %(s_etag)s or '
+                    'size: %(r_size)s != %(s_size)s') %
+                    {'path': path, 'r_etag': resp.etag,
+                     's_etag': segment_dict['hash'],
+                     'r_size': resp.content_length,
+                     's_size': segment_dict['bytes']})
+        return path, resp
+
+    def _prefetch_segment(self, segment_dict, seek, start_at):
+        """
+        Green thread body: fetches one segment completely and validates what
+        was read against the response's Content-Length and ETag.
+
+        :returns: list of the segment's chunks
+        """
+        path, resp = self._get_segment(segment_dict, seek, start_at)
+        chunks = []
+        received = 0
+        checksum = md5()
+        segment_iter = iter(resp.app_iter)
+        try:
+            while True:
+                with ChunkReadTimeout(self.controller.app.node_timeout):
+                    try:
+                        chunk = segment_iter.next()
+                    except StopIteration:
+                        break
+                chunks.append(chunk)
+                received += len(chunk)
+                checksum.update(chunk)
+        finally:
+            # See NOTE: swift_conn at top of file about this.
+            swift_conn = getattr(resp, 'swift_conn', None)
+            if swift_conn:
+                try:
+                    swift_conn.close()
+                except Exception:
+                    pass
+        etag = checksum.hexdigest()
+        # A ranged response's ETag still describes the whole object.
+        if (resp.content_length is not None and
+                received != resp.content_length) or \
+                (not seek and resp.etag and etag != resp.etag.strip('"')):
+            error = SloSegmentError if self.is_slo else Exception
+            raise error(_(
+                'Object segment did not match its response: '
+                '%(path)s etag: %(r_etag)s != %(etag)s or '
+                'size: %(r_size)s != %(size)s') %
+                {'path': path, 'r_etag': resp.etag, 'etag': etag,
+                 'r_size': resp.content_length, 'size': received})
+        return chunks
+
+    def _fill_prefetch(self, first):
+        """
+        Starts read-ahead for the segments following those already queued
+        until the window is full or the next one does not fit in the buffer.
+
+        :param first: segment number of the head of the queue
+        """
+        while not self.listing_done and \
+                len(self.prefetched) < self.prefetch_window:
+            if self.segment_peek is None:
+                try:
+                    self.segment_peek = self.listing.next()
+                except StopIteration:
+                    self.listing_done = True
+                    return
+            size = self.segment_peek['bytes'] - self.seek
+            if self.prefetched_bytes + size > self.prefetch_max_bytes:
+                return
+            start_at = self._rate_limit_time(first + len(self.prefetched))
+            thread = spawn(self._prefetch_segment, self.segment_peek,
+                           self.seek, start_at)
+            self.prefetched.append((self.segment_peek, size, thread))
+            self.prefetched_bytes += size
+            self.segment_peek = None
+            self.seek = 0
+
+    def _cancel_prefetch(self):
+        while self.prefetched:
+            thread = self.prefetched.popleft()[2]
+            thread.kill()
+        self.prefetched_bytes = 0
 
     def _load_next_segment(self):
         """
@@ -107,56 +275,31 @@ class SegmentedIterable(object):
         """
         try:
             self.segment += 1
+            if self.prefetch_window > 0:
+                self._fill_prefetch(self.segment)
+            if self.prefetched:
+                self.segment_dict, size, thread = self.prefetched.popleft()
+                self.prefetched_bytes -= size
+                self.segment_iter = iter(thread.wait())
+                self.segment_iter_swift_conn = None
+                self._fill_prefetch(self.segment + 1)
+                return
+            if self.listing_done:
+                raise StopIteration()
             self.segment_dict = self.segment_peek or self.listing.next()
             self.segment_peek = None
-            if self.container is None:
-                container, obj = \
-                    self.segment_dict['name'].lstrip('/').split('/', 1)
-            else:
-                container, obj = self.container, self.segment_dict['name']
-            partition, nodes = self.controller.app.object_ring.get_nodes(
-                self.controller.account_name, container, obj)
-            path = '/%s/%s/%s' % (self.controller.account_name, container, obj)
-            req = Request.blank(path)
-            if self.seek:
-                req.range = 'bytes=%s-' % self.seek
-                self.seek = 0
-            if not self.is_slo and self.segment > \
-                    self.controller.app.rate_limit_after_segment:
-                sleep(max(self.next_get_time - time.time(), 0))
-            self.next_get_time = time.time() + \
-                1.0 / self.controller.app.rate_limit_segments_per_sec
-            nodes = self.controller.app.sort_nodes(nodes)
-            resp = self.controller.GETorHEAD_base(
-                req, _('Object'), partition,
-                self.controller.iter_nodes(partition, nodes,
-                                           self.controller.app.object_ring),
-                path, len(nodes))
-            if self.is_slo and resp.status_int == HTTP_NOT_FOUND:
-                raise SloSegmentError(_(
-                    'Could not load object segment %(path)s:'
-                    ' %(status)s') % {'path': path, 'status': resp.status_int})
-            if not is_success(resp.status_int):
-                raise Exception(_(
-                    'Could not load object segment %(path)s:'
-                    ' %(status)s') % {'path': path, 'status': resp.status_int})
-            if self.is_slo:
-                if (resp.content_length != self.segment_dict['bytes'] or
-                        resp.etag != self.segment_dict['hash']):
-                    raise SloSegmentError(_(
-                        'Object segment no longer valid: '
-                        '%(path)s etag: %(r_etag)s != %(s_etag)s or '
-                        'size: %(r_size)s != %(s_size)s') %
-                        {'path': path, 'r_etag': resp.etag,
-                         's_etag': self.segment_dict['hash'],
-                         'r_size': resp.content_length,
-                         's_size': self.segment_dict['bytes']})
+            start_at = self._rate_limit_time(self.segment)
+            path, resp = self._get_segment(self.segment_dict, self.seek,
+                                           start_at)
+            self.seek = 0
             self.segment_iter = resp.app_iter
             # See NOTE: swift_conn at top of file about this.
             self.segment_iter_swift_conn = getattr(resp, 'swift_conn', None)
         except StopIteration:
+            self._cancel_prefetch()
             raise
         except SloSegmentError, err:
+            self._cancel_prefetch()
             if not getattr(err, 'swift_logged', False):
                 self.controller.app.logger.error(_(
                     'ERROR: While processing manifest '
@@ -168,6 +311,7 @@ class SegmentedIterable(object):
                 self.response.status_int = HTTP_CONFLICT
             raise StopIteration('Invalid manifiest segment')
         except (Exception, Timeout), err:
+            self._cancel_prefetch()
             if not getattr(err, 'swift_logged', False):
                 self.controller.app.logger.exception(_(
                     'ERROR: While processing manifest '
@@ -242,6 +386,7 @@ class SegmentedIterable(object):
                         yield chunk[:length]
                         break
                 yield chunk
+            self._cancel_prefetch()
             # See NOTE: swift_conn at top of file about this.
             if self.segment_iter_swift_conn:
                 try:
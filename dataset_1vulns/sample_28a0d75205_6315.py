@@ -1,5 +1,6 @@
 from __future__ import division, print_function, absolute_import
 
+import time
 import warnings
 
 import numpy as np
@@ -12,6 +13,10 @@ __all__ = ["KroghInterpolator", "krogh_interpolate", "BarycentricInterpolator",
            "barycentric_interpolate", "PiecewisePolynomial",
            "piecewise_polynomial_interpolate", "approximate_taylor_polynomial"]
 
+# Number of points evaluated at a time by the blocked evaluators; their
+# workspaces are a few arrays of this length, small enough to stay in cache.
+_BLOCK_SIZE = 1024
+
 
 def _isscalar(x):
     """Check whether x is if a scalar type, or 0-dim"""
@@ -42,11 +47,14 @@ class _Interpolator1D(object):
     -------
     __call__
     _prepare_x
+    _y_axes
     _finish_y
+    _out_rows
     _reshape_yi
     _set_yi
     _set_dtype
     _evaluate
+    _evaluate_blocks
 
     """
 
@@ -59,7 +67,7 @@ class _Interpolator1D(object):
         if yi is not None:
             self._set_yi(yi, xi=xi, axis=axis)
 
-    def __call__(self, x):
+    def __call__(self, x, out=None):
         """
         Evaluate the interpolant
 
@@ -67,15 +75,23 @@ class _Interpolator1D(object):
         ----------
         x : array-like
             Points to evaluate the interpolant at.
+        out : ndarray, optional
+            Array with the shape of the result to write the values into.
+            The points are then evaluated in blocks, so memory use does
+            not grow with the size of `x`.
 
         Returns
         -------
         y : array-like
             Interpolated values. Shape is determined by replacing
             the interpolation axis in the original array with the shape of x.
+            This is `out` if it was given.
 
         """
         x, x_shape = self._prepare_x(x)
+        if out is not None:
+            self._evaluate_blocks(x, self._out_rows(out, x_shape))
+            return out
         y = self._evaluate(x)
         return self._finish_y(y, x_shape)
 
@@ -85,6 +101,15 @@ class _Interpolator1D(object):
         """
         raise NotImplementedError()
 
+    def _evaluate_blocks(self, x, y):
+        """
+        Evaluate the interpolator at the 1-D array x into the rows of y,
+        `_BLOCK_SIZE` points at a time.
+        """
+        for start in xrange(0, len(x), _BLOCK_SIZE):
+            stop = start + _BLOCK_SIZE
+            y[start:stop] = self._evaluate(x[start:stop])
+
     def _prepare_x(self, x):
         """Reshape input x array to 1-D"""
         x = np.asarray(x)
@@ -94,17 +119,42 @@ class _Interpolator1D(object):
         x_shape = x.shape
         return x.ravel(), x_shape
 
-    def _finish_y(self, y, x_shape):
-        """Reshape interpolated y back to n-d array similar to initial y"""
-        y = y.reshape(x_shape + self._y_extra_shape)
+    def _y_axes(self, x_shape):
+        """Axis order taking y from (x..., extra...) to the result, or None"""
         if self._y_axis != 0 and x_shape != ():
             nx = len(x_shape)
             ny = len(self._y_extra_shape)
-            s = (list(range(nx, nx + self._y_axis))
-                 + list(range(nx)) + list(range(nx+self._y_axis, nx+ny)))
+            return (list(range(nx, nx + self._y_axis))
+                    + list(range(nx)) + list(range(nx+self._y_axis, nx+ny)))
+        return None
+
+    def _finish_y(self, y, x_shape):
+        """Reshape interpolated y back to n-d array similar to initial y"""
+        y = y.reshape(x_shape + self._y_extra_shape)
+        s = self._y_axes(x_shape)
+        if s is not None:
             y = y.transpose(s)
         return y
 
+    def _out_rows(self, out, x_shape):
+        """View an output array as the (len(x), r) array of _evaluate"""
+        shape = x_shape + self._y_extra_shape
+        s = self._y_axes(x_shape)
+        if s is not None:
+            shape = tuple(shape[i] for i in s)
+            y = out.transpose(np.argsort(s))
+        else:
+            y = out
+        if out.shape != shape:
+            raise ValueError("out must be of shape %r, not %r"
+                             % (shape, out.shape))
+        rows = y.reshape((int(np.prod(x_shape)),
+                          int(np.prod(self._y_extra_shape))))
+        if rows.size > 0 and not np.may_share_memory(rows, out):
+            raise ValueError("out must be viewable as a (len(x), R) array "
+                             "without copying")
+        return rows
+
     def _reshape_yi(self, yi, check=False):
         yi = np.rollaxis(np.asarray(yi), self._y_axis)
         if check and yi.shape[1:] != self._y_extra_shape:
@@ -316,15 +366,27 @@ class KroghInterpolator(_Interpolator1DWithDerivatives):
         self.c = c
 
     def _evaluate(self, x):
-        pi = 1
-        p = np.zeros((len(x), self.r), dtype=self.dtype)
-        p += self.c[0,np.newaxis,:]
-        for k in range(1, self.n):
-            w = x - self.xi[k-1]
-            pi = w*pi
-            p += pi[:,np.newaxis] * self.c[k]
+        p = np.empty((len(x), self.r), dtype=self.dtype)
+        self._evaluate_blocks(x, p)
         return p
 
+    def _evaluate_blocks(self, x, y):
+        b = max(1, min(len(x), _BLOCK_SIZE))
+        pi = np.empty(b, dtype=np.result_type(x, self.xi))
+        w = np.empty_like(pi)
+        t = np.empty((b, self.r), dtype=self.dtype)
+        for start in xrange(0, len(x), b):
+            xb = x[start:start+b]
+            m = len(xb)
+            p, pib, wb, tb = y[start:start+m], pi[:m], w[:m], t[:m]
+            p[...] = self.c[0]
+            pib.fill(1)
+            for k in xrange(1, self.n):
+                np.subtract(xb, self.xi[k-1], out=wb)
+                pib *= wb
+                np.multiply(pib[:,np.newaxis], self.c[k], out=tb)
+                p += tb
+
     def _evaluate_derivatives(self, x, der=None):
         n = self.n
         r = self.r
@@ -484,6 +546,12 @@ class BarycentricInterpolator(_Interpolator1D):
         If None, the y values will be supplied later via the `set_y` method.
     axis : int, optional
         Axis in the yi array corresponding to the x-coordinate values.
+    online : bool, optional
+        If True, keep the points in buffers that grow geometrically and
+        update the weights in place, O(N) per added point, as logarithms
+        and signs so they neither overflow nor underflow however many
+        points are added. Meant for points that arrive one or a few at
+        a time through `add_xi`. Default is False.
 
     Notes
     -----
@@ -495,15 +563,33 @@ class BarycentricInterpolator(_Interpolator1D):
     polynomial interpolation itself is a very ill-conditioned process
     due to the Runge phenomenon.
 
+    The interpolant only depends on the weights up to a common factor;
+    with ``online=True`` `wi` is normalized to a largest magnitude of 1.
+    Without it the weights are the plain products, which overflow or
+    underflow from about a thousand points.
+
     Based on Berrut and Trefethen 2004, "Barycentric Lagrange Interpolation".
 
     """
-    def __init__(self, xi, yi=None, axis=0):
+    def __init__(self, xi, yi=None, axis=0, online=False):
         _Interpolator1D.__init__(self, xi, yi, axis)
 
         self.xi = np.asarray(xi)
         self.set_yi(yi)
         self.n = len(self.xi)
+        self.online = online
+
+        if online:
+            self._xbuf = self.xi.astype(np.result_type(self.xi, float))
+            self._wbuf = np.zeros(self.n)
+            self._lbuf = np.zeros(self.n)
+            self._sbuf = np.ones(self.n)
+            self._ybuf = None
+            if self.yi is not None:
+                self._ybuf = self.yi.astype(self.dtype)
+            self._views()
+            self._add_weights(1)
+            return
 
         self.wi = np.zeros(self.n)
         self.wi[0] = 1
@@ -529,12 +615,17 @@ class BarycentricInterpolator(_Interpolator1D):
             Axis in the yi array corresponding to the x-coordinate values.
 
         """
+        self._table = None
         if yi is None:
             self.yi = None
             return
         self._set_yi(yi, xi=self.xi, axis=axis)
         self.yi = self._reshape_yi(yi)
         self.n, self.r = self.yi.shape
+        if getattr(self, 'online', False):
+            self._ybuf = np.zeros((len(self._xbuf), self.r), dtype=self.dtype)
+            self._ybuf[:self.n] = self.yi
+            self.yi = self._ybuf[:self.n]
 
     def add_xi(self, xi, yi=None):
         """
@@ -560,10 +651,27 @@ class BarycentricInterpolator(_Interpolator1D):
             if self.yi is None:
                 raise ValueError("No previous yi value to update!")
             yi = self._reshape_yi(yi, check=True)
-            self.yi = np.vstack((self.yi,yi))
         else:
             if self.yi is not None:
                 raise ValueError("No update to yi provided!")
+        self._table = None
+        if self.online:
+            xi = np.asarray(xi)
+            old_n = self.n
+            self._reserve(old_n + len(xi))
+            self._xbuf[old_n:old_n+len(xi)] = xi
+            if yi is not None:
+                self._set_dtype(yi.dtype, union=True)
+                if self._ybuf.dtype != self.dtype:
+                    self._ybuf = self._ybuf.astype(self.dtype)
+                self._ybuf[old_n:old_n+len(xi)] = yi
+            self.n = old_n + len(xi)
+            self._views()
+            self._add_weights(max(old_n, 1))
+            return
+        if yi is not None:
+            self._set_dtype(yi.dtype, union=True)
+            self.yi = np.vstack((self.yi,yi))
         old_n = self.n
         self.xi = np.concatenate((self.xi,xi))
         self.n = len(self.xi)
@@ -576,13 +684,73 @@ class BarycentricInterpolator(_Interpolator1D):
             self.wi[j] = np.multiply.reduce(self.xi[:j]-self.xi[j])
         self.wi **= -1
 
-    def __call__(self, x):
+    def _views(self):
+        """Point xi, wi and yi at the first n entries of the online buffers"""
+        self.xi = self._xbuf[:self.n]
+        self.wi = self._wbuf[:self.n]
+        if self._ybuf is not None:
+            self.yi = self._ybuf[:self.n]
+
+    def _reserve(self, n):
+        """Grow the online buffers to hold at least n points"""
+        size = len(self._xbuf)
+        if n <= size:
+            return
+        size = max(n, 2*size, 16)
+        for name in ('_xbuf', '_wbuf', '_lbuf', '_sbuf', '_ybuf'):
+            old = getattr(self, name)
+            if old is not None:
+                new = np.zeros((size,) + old.shape[1:], dtype=old.dtype)
+                new[:self.n] = old[:self.n]
+                setattr(self, name, new)
+        self._sbuf[self.n:] = 1
+
+    def _add_weights(self, start):
+        """
+        Fold the points start..n-1 into the weights of the points before.
+
+        The log-magnitudes `_lbuf` and signs `_sbuf` of the weights are
+        updated point by point: each point divides the existing weights
+        by their distances to it and gets the reciprocal of the product
+        of those distances. `wi` is then rebuilt from them, normalized
+        to a largest magnitude of 1.
+        """
+        xi, lw, sw = self.xi, self._lbuf, self._sbuf
+        d = np.empty(self.n)
+        for j in xrange(start, self.n):
+            dj = d[:j]
+            np.subtract(xi[:j], xi[j], out=dj)
+            sw[j] = -1 if np.count_nonzero(dj > 0) % 2 else 1
+            sw[:j] *= dj
+            np.sign(sw[:j], out=sw[:j])
+            np.abs(dj, out=dj)
+            np.log(dj, out=dj)
+            lw[:j] -= dj
+            lw[j] = -dj.sum()
+        if self.n > 0:
+            np.subtract(lw[:self.n], lw[:self.n].max(), out=self.wi)
+            np.exp(self.wi, out=self.wi)
+            self.wi *= sw[:self.n]
+
+    def _weight_table(self):
+        """The (N, R+1) array [wi*yi, wi] shared by all evaluations"""
+        if self._table is None:
+            table = np.empty((self.n, self.r + 1),
+                             dtype=np.result_type(self.dtype, self.wi))
+            np.multiply(self.wi[:,np.newaxis], self.yi, out=table[:,:-1])
+            table[:,-1] = self.wi
+            self._table = table
+        return self._table
+
+    def __call__(self, x, out=None):
         """Evaluate the interpolating polynomial at the points x
 
         Parameters
         ----------
         x : array-like
             Points to evaluate the interpolant at.
+        out : ndarray, optional
+            Array with the shape of the result to write the values into.
 
         Returns
         -------
@@ -592,30 +760,42 @@ class BarycentricInterpolator(_Interpolator1D):
 
         Notes
         -----
-        Currently the code computes an outer product between x and the
-        weights, that is, it constructs an intermediate array of size
-        N by len(x), where N is the degree of the polynomial.
+        The numerators and denominator of the barycentric formula come
+        from a single product of the reciprocal distances with the table
+        ``[wi*yi, wi]``, which is computed once and shared by every call
+        until the points or values change. Many query batches can be
+        evaluated together by stacking them in `x`, e.g. with shape
+        ``(batches, M)``. The points are taken in blocks so the
+        intermediate array of reciprocal distances stays at about
+        ``256*_BLOCK_SIZE`` elements rather than N by len(x).
         """
-        return _Interpolator1D.__call__(self, x)
+        return _Interpolator1D.__call__(self, x, out)
 
     def _evaluate(self, x):
-        if x.size == 0:
-            p = np.zeros((0, self.r), dtype=self.dtype)
-        else:
-            c = x[...,np.newaxis]-self.xi
-            z = c == 0
-            c[z] = 1
-            c = self.wi/c
-            p = np.dot(c,self.yi)/np.sum(c,axis=-1)[...,np.newaxis]
-            # Now fix where x==some xi
-            r = np.nonzero(z)
-            if len(r) == 1:  # evaluation at a scalar
-                if len(r[0]) > 0:  # equals one of the points
-                    p = self.yi[r[0][0]]
-            else:
-                p[r[:-1]] = self.yi[r[-1]]
+        p = np.empty((len(x), self.r), dtype=self.dtype)
+        self._evaluate_blocks(x, p)
         return p
 
+    def _evaluate_blocks(self, x, y):
+        table = self._weight_table()
+        b = max(1, min(len(x), 256*_BLOCK_SIZE // max(self.n, 1)))
+        c = np.empty((b, self.n), dtype=np.result_type(x, self.xi))
+        t = np.empty((b, self.r + 1), dtype=np.result_type(c, table))
+        for start in xrange(0, len(x), b):
+            xb = x[start:start+b]
+            m = len(xb)
+            p, cb, tb = y[start:start+m], c[:m], t[:m]
+            np.subtract(xb[:,np.newaxis], self.xi, out=cb)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.divide(1, cb, out=cb)
+                np.dot(cb, table, out=tb)
+                np.divide(tb[:,:-1], tb[:,-1:], out=p)
+            # Now fix where x==some xi
+            for i in np.nonzero(~np.isfinite(tb[:,-1]))[0]:
+                r = np.nonzero(xb[i] == self.xi)[0]
+                if len(r) > 0:
+                    p[i] = self.yi[r[-1]]
+
 
 def barycentric_interpolate(xi, yi, x, axis=0):
     """
@@ -666,6 +846,42 @@ def barycentric_interpolate(xi, yi, x, axis=0):
     return BarycentricInterpolator(xi, yi, axis=axis)(x)
 
 
+def bench_barycentric(sizes=(1000, 10000, 100000), added=100, batches=10,
+                      batch_size=10000):
+    """
+    Time `BarycentricInterpolator` with and without ``online=True``.
+
+    For each number of Chebyshev points N in `sizes` this prints the time
+    to build each interpolator, the time per point of `added` single
+    point `add_xi` calls, and how many points per second the online one
+    evaluates with `batches` query batches of `batch_size` points in
+    one call. Plain timings whose weights have overflowed are starred.
+    """
+    print("%8s %15s %15s %13s %13s %12s" % ("N", "build (online)",
+          "build (plain)", "add (online)", "add (plain)", "eval"))
+    for n in sizes:
+        xi = np.cos(np.pi*(np.arange(n + added) + 0.5)/(n + added))
+        yi = np.sin(3*xi)
+        x = np.random.uniform(-1, 1, (batches, batch_size))
+        times = []
+        for online in (True, False):
+            start = time.time()
+            P = BarycentricInterpolator(xi[:n], yi[:n], online=online)
+            times.append(time.time() - start)
+            start = time.time()
+            for j in xrange(n, n + added):
+                P.add_xi(xi[j:j+1], yi[j:j+1])
+            times.append((time.time() - start)/added)
+            if online:
+                start = time.time()
+                P(x)
+                rate = x.size/(time.time() - start)
+        star = "" if np.isfinite(P.wi).all() else "*"
+        print("%8d %14.2fs %14.2fs%s %11.0fus %11.0fus%s %8.2gpt/s"
+              % (n, times[0], times[2], star, times[1]*1e6, times[3]*1e6,
+                 star, rate))
+
+
 class PiecewisePolynomial(_Interpolator1DWithDerivatives):
     """Piecewise polynomial curve specified by points and derivatives
 
@@ -736,6 +952,7 @@ class PiecewisePolynomial(_Interpolator1DWithDerivatives):
         self.direction = direction
         self.orders = []
         self.polynomials = []
+        self._table = None
         self.extend(xi[1:],yi[slice1],orders)
 
     def _make_polynomial(self,x1,y1,x2,y2,order,direction):
@@ -806,6 +1023,7 @@ class PiecewisePolynomial(_Interpolator1DWithDerivatives):
             self.xi[-1], self.yi[-1],
             order, self.direction))
         self.n += 1
+        self._table = None
 
     def extend(self, xi, yi, orders=None):
         """
@@ -845,20 +1063,67 @@ class PiecewisePolynomial(_Interpolator1DWithDerivatives):
                 else:
                     self.append(xi[i],yi[preslice + (i,)],orders[i])
 
+    def _segment_table(self):
+        """
+        The segment polynomials stacked for vectorized evaluation
+
+        Returns the breakpoints, the Krogh nodes of every segment as a
+        (K-1, n-1) array, their coefficients as a (K, n-1, R) array and
+        the number of coefficients of each segment, where K is the
+        largest of those; shorter segments are padded with zeros.
+        """
+        if self._table is None:
+            sizes = np.array([P.n for P in self.polynomials])
+            K = sizes.max()
+            nodes = np.zeros((K-1, self.n-1))
+            coeffs = np.zeros((K, self.n-1, self.r), dtype=self.dtype)
+            for i, P in enumerate(self.polynomials):
+                nodes[:P.n-1,i] = P.xi[:P.n-1]
+                coeffs[:P.n,i] = P.c[:P.n]
+            self._table = (np.asarray(self.xi), nodes, coeffs, sizes)
+        return self._table
+
     def _evaluate(self, x):
         if _isscalar(x):
             pos = np.clip(np.searchsorted(self.xi, x) - 1, 0, self.n-2)
             y = self.polynomials[pos](x)
         else:
-            m = len(x)
-            pos = np.clip(np.searchsorted(self.xi, x) - 1, 0, self.n-2)
-            y = np.zeros((m, self.r), dtype=self.dtype)
-            if y.size > 0:
-                for i in xrange(self.n-1):
-                    c = pos == i
-                    y[c] = self.polynomials[i](x[c])
+            y = np.empty((len(x), self.r), dtype=self.dtype)
+            self._evaluate_blocks(x, y)
         return y
 
+    def _evaluate_blocks(self, x, y):
+        if not self.polynomials:
+            y[...] = 0
+            return
+        xi, nodes, coeffs, sizes = self._segment_table()
+        uniform = (sizes == len(coeffs)).all()
+        b = max(1, min(len(x), _BLOCK_SIZE))
+        pi = np.empty(b, dtype=np.result_type(x, nodes))
+        w = np.empty_like(pi)
+        t = np.empty((b, self.r), dtype=self.dtype)
+        for start in xrange(0, len(x), b):
+            xb = x[start:start+b]
+            m = len(xb)
+            p, pib, wb, tb = y[start:start+m], pi[:m], w[:m], t[:m]
+            pos = np.searchsorted(xi, xb)
+            pos -= 1
+            np.clip(pos, 0, self.n-2, out=pos)
+            np.take(coeffs[0], pos, axis=0, out=tb, mode='clip')
+            p[...] = tb
+            pib.fill(1)
+            for k in xrange(1, len(coeffs)):
+                np.take(nodes[k-1], pos, out=wb, mode='clip')
+                np.subtract(xb, wb, out=wb)
+                pib *= wb
+                np.take(coeffs[k], pos, axis=0, out=tb, mode='clip')
+                tb *= pib[:,np.newaxis]
+                if uniform:
+                    p += tb
+                else:
+                    # past its last coefficient a segment adds nothing
+                    np.add(p, tb, out=p, where=(sizes[pos] > k)[:,np.newaxis])
+
     def _evaluate_derivatives(self, x, der=None):
         if der is None and self.polynomials:
             der = self.polynomials[0].n
@@ -23,31 +23,156 @@ from .errors import HoconParserException, HoconTokenizerException
 from .select_config import SelectConfig
 
 
+class _Generation(object):
+    """Change counter of one hocon tree
+
+    Every node points at the counter of its tree in ``_tree``, so configs
+    know when their path index and memoized values are stale. Attaching a
+    node of another tree merges the two counters union-find style: the
+    attached tree's counter gets a ``parent`` and is replaced by it.
+    """
+
+    __slots__ = ("count", "parent")
+
+    def __init__(self):
+        self.count = 0
+        self.parent = None
+
+    def find(self):
+        """Gets the counter currently standing for this tree"""
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        gen = self
+        while gen is not root:
+            gen.parent, gen = root, gen.parent
+        return root
+
+
+def _generation_of(node):
+    """Gets the change counter of the tree holding ``node``"""
+    gen = getattr(node, "_tree", None)
+    gen = _Generation() if gen is None else gen.find()
+    node._tree = gen
+    return gen
+
+
+def _touch(node):
+    """Mark the tree holding ``node`` as changed"""
+    _generation_of(node).count += 1
+
+
+def _join(node, child):
+    """Mark the tree holding ``node`` as changed and make ``child`` part of it"""
+    gen = _generation_of(node)
+    gen.count += 1
+    if child is None:
+        return
+    other = getattr(child, "_tree", None)
+    if other is None:
+        child._tree = gen
+    else:
+        other = other.find()
+        if other is not gen:
+            other.parent = gen
+
+
+_MISSING = object()
+
+
 class BaseConfig(object):
     """Base Config
 
+    Looked up nodes are kept in a flattened ``path -> node`` index, filled
+    as paths are first accessed and dropped whenever a node of the config's
+    tree is changed.
+
     :param root:  the real hocon root value
     :type root: HoconRoot
+    :param loader: a callable returning the ``HoconRoot``, called on first access instead of passing ``root``
+    :type loader: types.Function
     :raises: AttributeError
     """
 
-    def __init__(self, root):
+    def __init__(self, root, loader=None):
+        self._loader = loader
+        self._index = {}
+        self._values = {}
+        self._generation = None
+        self._seen = 0
+        if loader is None:
+            self._set_root(root)
 
+    def _set_root(self, root):
         if root.value is None:
             raise AttributeError(" error")
-        self.root = root.value  # HoconValue
-        self.substitutions = root.substitutions  # List<HoconSubstitution>
+        self._root = root.value  # HoconValue
+        self._substitutions = root.substitutions  # List<HoconSubstitution>
+        self._generation = _generation_of(self._root)
+        self._seen = self._generation.count
+
+    @property
+    def root(self):
+        """The root hocon value, loaded on first access for lazy configs"""
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            self._set_root(loader())
+        return self._root
+
+    @property
+    def substitutions(self):
+        self.root
+        return self._substitutions
+
+    def invalidate(self):
+        """Drops the path index and the memoized values"""
+        self._index.clear()
+        self._values.clear()
+        if self._generation is not None:
+            self._generation = self._generation.find()
+            self._seen = self._generation.count
+
+    def _check(self):
+        """Invalidates if the tree changed since the last lookup"""
+        gen = self._generation
+        if gen is not None and (gen.parent is not None or gen.count != self._seen):
+            self.invalidate()
 
     def get_node(self, path):
         """Gets the path data node"""
+        self._check()
+        node = self._index.get(path, _MISSING)
+        if node is _MISSING:
+            node = self._walk(path)
+        return node
+
+    def _walk(self, path):
+        """Walks down to the path node, indexing every prefix on the way"""
         keys = path.split(".")
         current_node = self.root
         if current_node is None:
             raise KeyError("Doesn't exist the key:" % (path))
+        current_path = None
         for key in keys:
             current_node = current_node.get_child_object(key)
+            current_path = key if current_path is None else current_path + "." + key
+            self._index[current_path] = current_node
         return current_node
 
+    def _memoized(self, path, method, default=_MISSING):
+        """Calls the ``method`` of the path node once and memoizes the result"""
+        self._check()
+        key = (method, path)
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        node = self.get_node(path)
+        if node is None and default is not _MISSING:
+            return default
+        value = self._values[key] = getattr(node, method)()
+        return value
+
     def __str__(self):
         if self.root is None:
             return ""
@@ -77,33 +202,21 @@ class Config(BaseConfig):
 
     def get_bool(self, path, default=False):
         """Gets the bool data value, defaults not found returns the default value"""
-        value = self.get_node(path)
-        if value is None:
-            return default
-        return value.get_bool()
+        return self._memoized(path, "get_bool", default)
 
     def get_int(self, path, default=0):
         """Gets the integer data value, defaults not found returns the default value"""
-        value = self.get_node(path)
-        if value is None:
-            return default
-        return value.get_int()
+        return self._memoized(path, "get_int", default)
 
     def get(self, path, default=None):
         """Gets the  string data value, defaults not found returns the default value"""
-        value = self.get_node(path)
-        if value is None:
-            return default
-        return value.get_string()
+        return self._memoized(path, "get_string", default)
 
     get_string = get
 
     def get_float(self, path, default=0.0):
         """Gets the  float data value, defaults not found returns the default value"""
-        value = self.get_node(path)
-        if value is None:
-            return default
-        return value.get_float()
+        return self._memoized(path, "get_float", default)
 
     def get_bool_list(self, path):
         """Gets the  bool data value, defaults not found returns the default value"""
@@ -113,21 +226,15 @@ class Config(BaseConfig):
 
     def get_float_list(self, path):
         """Gets the  float list data value"""
-        value = self.get_node(path)
-
-        return value.get_float_list()
+        return list(self._memoized(path, "get_float_list"))
 
     def get_int_list(self, path):
         """Gets the  int list data value"""
-        value = self.get_node(path)
-
-        return value.get_int_list()
+        return list(self._memoized(path, "get_int_list"))
 
     def get_list(self, path):
         """Gets the  list ojbect data value"""
-        value = self.get_node(path)
-
-        return value.get_list()
+        return list(self._memoized(path, "get_list"))
 
     def get_value(self, path):
         """Gets the  string data node, defaults not found returns the default value"""
@@ -161,12 +268,24 @@ class ConfigFactory(object):
         return configCls(res)
 
     @classmethod
-    def parse_file(cls, path, pystyle=False):
-        """Parses and creates a hocon confi from  the file path"""
+    def parse_file(cls, path, pystyle=False, lazy=False):
+        """Parses and creates a hocon confi from  the file path
+
+        :param lazy: If ``True`` the file is only read and parsed when the config is first accessed, defaults to False
+        :type lazy: bool, optional
+        """
+        if lazy:
+            configCls = PyConfig if pystyle else Config
+            return configCls(None, loader=lambda: cls._parse_file_root(path, pystyle))
         with open(path) as f:
             content = f.read()
             return cls.parse(content, pystyle=pystyle)
 
+    @staticmethod
+    def _parse_file_root(path, pystyle):
+        with open(path) as f:
+            return Parser.parse(f.read(), None, pystyle)
+
     @classmethod
     def from_json(cls, jsonObj, pystyle=False):
         """Creates hocon from json data"""
@@ -198,6 +317,8 @@ class HoconValue(MightBeAHoconObject):
 
     def __init__(self, values=None):
         self.values = values or []
+        for value in self.values:
+            _join(self, value)
 
     def at_key(self, key):
         """Get data node by key"""
@@ -227,11 +348,13 @@ class HoconValue(MightBeAHoconObject):
         """Append a value inf current node"""
         # if isinstance(value, HoconElement):
         self.values.append(value)
+        _join(self, value)
         return self
 
     def clear(self):
         """Clear the sub nodes"""
         self.values[:] = []
+        _touch(self)
 
     def new_value(self, value):
         """Clear the sub values and reset by the new value"""
@@ -345,6 +468,69 @@ class HoconArray(HoconElement, list):
         list
     """
 
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        for value in self:
+            _join(self, value)
+
+    def append(self, value):
+        list.append(self, value)
+        _join(self, value)
+
+    def extend(self, values):
+        values = list(values)
+        list.extend(self, values)
+        for value in values:
+            _join(self, value)
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def insert(self, index, value):
+        list.insert(self, index, value)
+        _join(self, value)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            list.__setitem__(self, index, value)
+            for v in value:
+                _join(self, v)
+        else:
+            list.__setitem__(self, index, value)
+            _join(self, value)
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        _touch(self)
+
+    def pop(self, *args):
+        value = list.pop(self, *args)
+        _touch(self)
+        return value
+
+    def remove(self, value):
+        list.remove(self, value)
+        _touch(self)
+
+    def clear(self):
+        del self[:]
+        _touch(self)
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        _touch(self)
+        return self
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        _touch(self)
+
+    def reverse(self):
+        list.reverse(self)
+        _touch(self)
+
     def is_string(self):
         return False
 
@@ -421,6 +607,48 @@ class HoconObject(HoconElement, dict):
     def get_list(self):
         raise BaseException(" error")
 
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        for value in self.values():
+            _join(self, value)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        _join(self, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        _touch(self)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        value = dict.pop(self, key)
+        _touch(self)
+        return value
+
+    def popitem(self):
+        item = dict.popitem(self)
+        _touch(self)
+        return item
+
+    def clear(self):
+        dict.clear(self)
+        _touch(self)
+
     def get_key(self, key):
         return self.get(key)
 
@@ -456,7 +684,16 @@ class HoconSubstitution(HoconElement, MightBeAHoconObject):
 
     def __init__(self, path=None):
         self.path = path
-        self.resolved_value = None
+        self._resolved_value = None
+
+    @property
+    def resolved_value(self):
+        return self._resolved_value
+
+    @resolved_value.setter
+    def resolved_value(self, value):
+        self._resolved_value = value
+        _join(self, value)
 
     def is_string(self):
         return self.resolved_value and self.resolved_value.is_string()
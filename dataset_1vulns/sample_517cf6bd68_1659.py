@@ -63,6 +63,7 @@ import logging
 import os
 import socket
 import sys
+import threading
 import uuid
 
 try:
@@ -309,6 +310,9 @@ class TransportMixIn(object):
     # Use the configuration to change the content-type
     readonly_headers = ("content-length", "content-type")
 
+    # Maximum number of idle keep-alive connections kept per host
+    max_idle_connections = 8
+
     def __init__(self, config=jsonrpclib.config.DEFAULT, context=None):
         """
         Sets up the transport
@@ -331,6 +335,10 @@ class TransportMixIn(object):
         self.accept_gzip_encoding = True
         self.verbose = False
 
+        # Idle keep-alive connections: host -> list of connections
+        self._idle_connections = {}
+        self._pool_lock = threading.Lock()
+
     def push_headers(self, headers):
         """
         Adds a dictionary of headers to the additional headers list
@@ -393,6 +401,70 @@ class TransportMixIn(object):
 
         return additional_headers
 
+    def make_connection(self, host):
+        """
+        Returns an idle keep-alive connection to the given host, or a new one
+        if none is available. The connection is owned by the caller until it
+        is given back with ``release_connection()``, so that a transport can
+        be shared between threads.
+
+        :param host: Target host
+        :return: An HTTPConnection object
+        """
+        with self._pool_lock:
+            idle = self._idle_connections.get(host)
+            if idle:
+                return idle.pop()
+
+        return self._create_connection(host)
+
+    def _create_connection(self, host):
+        """
+        Creates a new connection to the given host
+
+        :param host: Target host
+        :return: An HTTPConnection object
+        """
+        # The XML-RPC transport caches a single connection in _connection:
+        # reset it so that a new connection is created, and clear it again
+        # so that the connection handed out stays owned by the caller only.
+        # Both are done under the lock, as other threads use the same cache.
+        with self._pool_lock:
+            self._connection = None, None
+            try:
+                return super(TransportMixIn, self).make_connection(host)
+            finally:
+                self._connection = None, None
+
+    def release_connection(self, host, connection):
+        """
+        Puts back a connection whose last response has been fully read
+
+        :param host: Host the connection is bound to
+        :param connection: The connection to keep alive
+        """
+        with self._pool_lock:
+            idle = self._idle_connections.setdefault(host, [])
+            if len(idle) < self.max_idle_connections:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    def close(self):
+        """
+        Closes all idle connections
+        """
+        with self._pool_lock:
+            pools = list(self._idle_connections.values())
+            self._idle_connections.clear()
+
+        for idle in pools:
+            for connection in idle:
+                connection.close()
+
+        self._connection = None, None
+
     def single_request(self, host, handler, request_body, verbose=0):
         """
         Send a complete request, and parse the response.
@@ -413,16 +485,20 @@ class TransportMixIn(object):
             response = connection.getresponse()
             if response.status == 200:
                 self.verbose = verbose
-                return self.parse_response(response)
+                result = self.parse_response(response)
+                # The response has been read: the connection can be reused
+                self.release_connection(host, connection)
+                return result
         except:
             # All unexpected errors leave connection in
-            # a strange state, so we clear it.
-            self.close()
+            # a strange state, so we drop it.
+            connection.close()
             raise
 
         # Discard any response data and raise exception
         if response.getheader("content-length", 0):
             response.read()
+        connection.close()
         raise TransportError(
             host + handler, response.status, response.reason, response.msg
         )
@@ -471,9 +547,10 @@ class TransportMixIn(object):
         if "user-agent" not in additional_headers:
             connection.putheader("User-Agent", self.user_agent)
 
-        connection.endheaders()
-        if request_body:
-            connection.send(request_body)
+        # Hand the body to endheaders() so that small requests leave in a
+        # single packet, instead of headers and body stalling on Nagle's
+        # algorithm and the server's delayed ACK
+        connection.endheaders(request_body)
 
     @staticmethod
     def getparser():
@@ -561,14 +638,12 @@ class UnixTransport(TransportMixIn, XMLTransport):
         # Keep track of the given path, if any
         self.__unix_path = os.path.abspath(path) if path else None
 
-    def make_connection(self, host):
+    def _create_connection(self, host):
         """
         Connect to server.
 
-        Return an existing connection if possible.
-        This allows HTTP/1.1 keep-alive.
-
-        Code copied from xmlrpc.client (Python 3)
+        Idle connections are reused by ``make_connection()``, which allows
+        HTTP/1.1 keep-alive.
 
         :param host: Target host (ignored if a path was given)
         :return A UnixHTTPConnection object
@@ -576,13 +651,9 @@ class UnixTransport(TransportMixIn, XMLTransport):
         if self.__unix_path:
             host = self.__unix_path
 
-        if self._connection and host == self._connection[0]:
-            return self._connection[1]
-
         # create a HTTP connection object from a host descriptor
         path, self._extra_headers, _ = self.get_host_info(host)
-        self._connection = host, UnixHTTPConnection(path)
-        return self._connection[1]
+        return UnixHTTPConnection(path)
 
 
 # ------------------------------------------------------------------------------
@@ -781,6 +852,14 @@ class ServerProxy(XMLServerProxy):
         """
         return _Notify(self._request_notify)
 
+    def _multicall(self, batch_size=None):
+        """
+        Returns a MultiCall object to send calls to this server in batches
+
+        :param batch_size: Maximum number of calls per JSON-RPC batch
+        """
+        return MultiCall(self, self._config, batch_size)
+
     @contextlib.contextmanager
     def _additional_headers(self, headers):
         """
@@ -1002,18 +1081,70 @@ class MultiCall(object):
     To execute the multicall, call the MultiCall object e.g.:
 
     add_result, address = multicall()
+
+    Results are matched to calls by request ID, so the server may answer a
+    batch in any order. With a ``batch_size``, the calls are sent as several
+    batches of at most that many calls each.
     """
 
-    def __init__(self, server, config=jsonrpclib.config.DEFAULT):
+    def __init__(
+        self, server, config=jsonrpclib.config.DEFAULT, batch_size=None
+    ):
         """
         Sets up the multicall
 
         :param server: A ServerProxy object
         :param config: Request configuration
+        :param batch_size: Maximum number of calls per JSON-RPC batch
         """
         self._server = server
         self._job_list = []
         self._config = config
+        self._batch_size = batch_size
+
+    def _send_batch(self, jobs):
+        """
+        Sends one batch of calls to the server
+
+        :param jobs: A list of MultiCallMethod objects
+        :return: The responses to the calls, in the order of the calls
+        """
+        prefix = str(uuid.uuid4())
+        rpcids = []
+        requests = []
+        for index, job in enumerate(jobs):
+            if job.notify:
+                requests.append(job.request())
+            else:
+                rpcid = "{0}-{1}".format(prefix, index)
+                rpcids.append(rpcid)
+                requests.append(job.request(rpcid=rpcid))
+
+        responses = self._server._run_request(
+            "[ {0} ]".format(",".join(requests))
+        )
+        if not responses:
+            return []
+        elif isinstance(responses, utils.DictType):
+            # The whole batch was rejected
+            check_for_errors(responses)
+
+        if not isinstance(responses, utils.ListType):
+            # A valid single response can't answer a batch
+            raise ProtocolError(
+                "Batch response is not a list: {0!r}".format(responses)
+            )
+
+        by_id = dict(
+            (response.get("id"), response)
+            for response in responses
+            if isinstance(response, utils.DictType)
+        )
+        if all(rpcid in by_id for rpcid in rpcids):
+            return [by_id[rpcid] for rpcid in rpcids]
+
+        # Some responses lack their ID: keep the server order
+        return responses
 
     def _request(self):
         """
@@ -1024,13 +1155,12 @@ class MultiCall(object):
         if len(self._job_list) < 1:
             # Should we alert? This /is/ pretty obvious.
             return
-        request_body = "[ {0} ]".format(
-            ",".join(job.request() for job in self._job_list)
-        )
-        responses = self._server._run_request(request_body)
+        jobs = self._job_list
+        batch_size = self._batch_size or len(jobs)
+        responses = []
+        for start in range(0, len(jobs), batch_size):
+            responses.extend(self._send_batch(jobs[start : start + batch_size]))
         del self._job_list[:]
-        if not responses:
-            responses = []
         return MultiCallIterator(responses)
 
     @property
@@ -18,14 +18,59 @@ _speedups = None
 
 
 
+def _asbool(obj):
+
+    """
+
+    Interpret a config value as a boolean the way
+
+    ``paste.deploy.converters.asbool`` does, so that ``stream = false`` in
+
+    an ini file means False rather than a non-empty string.
+
+    """
+
+    if isinstance(obj, basestring):
+
+        value = obj.strip().lower()
+
+        if value in ('true', 'yes', 'on', 'y', 't', '1'):
+
+            return True
+
+        if value in ('false', 'no', 'off', 'n', 'f', '0'):
+
+            return False
+
+        raise ValueError("String is not true/false: %r" % (obj,))
+
+    return bool(obj)
+
+
+
+
+
+
 class JSONFilter(object):
 
-    def __init__(self, app, mime_type='text/x-json'):
+    def __init__(self, app, mime_type='text/x-json', stream=False,
+
+                 chunk_size=8192):
 
         self.app = app
 
         self.mime_type = mime_type
 
+        self.stream = _asbool(stream)
+
+        self.chunk_size = int(chunk_size)
+
+        if self.chunk_size <= 0:
+
+            raise ValueError("chunk_size must be positive, not %r"
+
+                             % (chunk_size,))
+
 
 
     def __call__(self, environ, start_response):
@@ -52,7 +97,7 @@ class JSONFilter(object):
 
                 environ['jsonfilter.json'] = simplejson.loads(data)
 
-        res = simplejson.dumps(self.app(environ, json_start_response))
+        obj = self.app(environ, json_start_response)
 
         jsonp = cgi.parse_qs(environ.get('QUERY_STRING', '')).get('jsonp')
 
@@ -60,8 +105,6 @@ class JSONFilter(object):
 
             content_type = 'text/javascript'
 
-            res = ''.join(jsonp + ['(', res, ')'])
-
         elif 'Opera' in environ.get('HTTP_USER_AGENT', ''):
 
             # Opera has bunk XMLHttpRequest support for most mime types
@@ -72,6 +115,26 @@ class JSONFilter(object):
 
             content_type = self.mime_type
 
+        if self.stream:
+
+            # The length is unknown until encoding finishes, so leave
+
+            # Content-length out and let the server delimit the body
+
+            headers = [('Content-type', content_type)]
+
+            headers.extend(response['headers'])
+
+            start_response(response['status'], headers)
+
+            return self.iter_chunks(obj, jsonp)
+
+        res = simplejson.dumps(obj)
+
+        if jsonp:
+
+            res = ''.join(jsonp + ['(', res, ')'])
+
         headers = [
 
             ('Content-type', content_type),
@@ -88,6 +151,74 @@ class JSONFilter(object):
 
 
 
+    def iter_chunks(self, obj, jsonp=None):
+
+        """
+
+        Encode ``obj`` incrementally with ``iterencode`` and yield it as
+
+        byte strings of exactly ``chunk_size`` bytes (the last one may be
+
+        shorter), wrapped in the ``jsonp`` callback if one is given.
+
+        Only one chunk's worth of output is held at a time.
+
+        """
+
+        def pieces():
+
+            if jsonp:
+
+                for piece in jsonp:
+
+                    yield piece
+
+                yield '('
+
+            for piece in simplejson.JSONEncoder().iterencode(obj):
+
+                yield piece
+
+            if jsonp:
+
+                yield ')'
+
+        size = self.chunk_size
+
+        buf = []
+
+        buffered = 0
+
+        for piece in pieces():
+
+            if isinstance(piece, unicode):
+
+                piece = piece.encode('utf-8')
+
+            buf.append(piece)
+
+            buffered += len(piece)
+
+            if buffered >= size:
+
+                data = ''.join(buf)
+
+                end = len(data) - len(data) % size
+
+                for start in range(0, end, size):
+
+                    yield data[start:start + size]
+
+                buf = [data[end:]]
+
+                buffered = len(buf[0])
+
+        if buffered:
+
+            yield ''.join(buf)
+
+
+
 def factory(app, global_conf, **kw):
 
     return JSONFilter(app, **kw)
@@ -774,15 +905,7 @@ class JSONEncoder(object):
 
             return encode_basestring_ascii(o)
 
-        # This doesn't pass the iterator directly to ''.join() because it
-
-        # sucks at reporting exceptions.  It's going to do this internally
-
-        # anyway because it uses PySequence_Fast or similar.
-
-        chunks = list(self.iterencode(o))
-
-        return ''.join(chunks)
+        return self._encode_flat(o)
 
 
 
@@ -817,6 +940,282 @@ class JSONEncoder(object):
         return self._iterencode(o, markers)
 
 
+    def _encode_flat(self, o):
+
+        """
+
+        Non-recursive equivalent of ``''.join(self.iterencode(o))``.
+
+
+
+        Lists and dicts are walked with an explicit stack instead of one
+
+        generator per nesting level, and every piece of output goes into
+
+        a single list that is joined once at the end.
+
+        """
+
+        if self.check_circular:
+
+            markers = {}
+
+        else:
+
+            markers = None
+
+        if self.ensure_ascii:
+
+            encoder = encode_basestring_ascii
+
+        else:
+
+            encoder = encode_basestring
+
+        _encoding = self.encoding
+
+        _do_decode = (_encoding is not None
+
+            and not (_need_utf8 and _encoding == 'utf-8'))
+
+        allow_nan = self.allow_nan
+
+        indent = self.indent
+
+        level = self.current_indent_level
+
+        key_separator = self.key_separator
+
+        chunks = []
+
+        append = chunks.append
+
+        # Frames are [items, is_dict, separator, markerid, first].  A frame
+
+        # whose items is None only releases the marker of an object that
+
+        # was handed to default().
+
+        stack = []
+
+        value = o
+
+        while True:
+
+            if isinstance(value, basestring):
+
+                if _do_decode and isinstance(value, str):
+
+                    value = value.decode(_encoding)
+
+                append(encoder(value))
+
+            elif value is None:
+
+                append('null')
+
+            elif value is True:
+
+                append('true')
+
+            elif value is False:
+
+                append('false')
+
+            elif isinstance(value, (int, long)):
+
+                append(str(value))
+
+            elif isinstance(value, float):
+
+                append(floatstr(value, allow_nan))
+
+            elif isinstance(value, (list, tuple, dict)) and not value:
+
+                if isinstance(value, dict):
+
+                    append('{}')
+
+                else:
+
+                    append('[]')
+
+            else:
+
+                if markers is not None:
+
+                    markerid = id(value)
+
+                    if markerid in markers:
+
+                        raise ValueError("Circular reference detected")
+
+                    markers[markerid] = value
+
+                else:
+
+                    markerid = None
+
+                if isinstance(value, (list, tuple)):
+
+                    is_dict = False
+
+                    items = iter(value)
+
+                    append('[')
+
+                elif isinstance(value, dict):
+
+                    is_dict = True
+
+                    if self.sort_keys:
+
+                        keys = list(value.keys())
+
+                        keys.sort()
+
+                        items = iter([(k, value[k]) for k in keys])
+
+                    else:
+
+                        items = iter(value.items())
+
+                    append('{')
+
+                else:
+
+                    stack.append([None, False, None, markerid, False])
+
+                    value = self.default(value)
+
+                    continue
+
+                if indent is not None:
+
+                    level += 1
+
+                    newline_indent = '\n' + (' ' * (indent * level))
+
+                    append(newline_indent)
+
+                    separator = self.item_separator + newline_indent
+
+                else:
+
+                    separator = self.item_separator
+
+                stack.append([items, is_dict, separator, markerid, True])
+
+            # Find the next value to encode, closing finished containers
+
+            # on the way.
+
+            while stack:
+
+                frame = stack[-1]
+
+                items, is_dict, separator, markerid, first = frame
+
+                if items is not None:
+
+                    for value in items:
+
+                        if not is_dict:
+
+                            break
+
+                        key, value = value
+
+                        if isinstance(key, str):
+
+                            if _do_decode:
+
+                                key = key.decode(_encoding)
+
+                        elif isinstance(key, basestring):
+
+                            pass
+
+                        elif isinstance(key, float):
+
+                            key = floatstr(key, allow_nan)
+
+                        elif isinstance(key, (int, long)):
+
+                            key = str(key)
+
+                        elif key is True:
+
+                            key = 'true'
+
+                        elif key is False:
+
+                            key = 'false'
+
+                        elif key is None:
+
+                            key = 'null'
+
+                        elif self.skipkeys:
+
+                            continue
+
+                        else:
+
+                            raise TypeError("key %r is not a string" % (key,))
+
+                        break
+
+                    else:
+
+                        items = None
+
+                    if items is not None:
+
+                        if first:
+
+                            frame[4] = False
+
+                        else:
+
+                            append(separator)
+
+                        if is_dict:
+
+                            append(encoder(key))
+
+                            append(key_separator)
+
+                        break
+
+                    if indent is not None:
+
+                        level -= 1
+
+                        append('\n' + (' ' * (indent * level)))
+
+                    if is_dict:
+
+                        append('}')
+
+                    else:
+
+                        append(']')
+
+                stack.pop()
+
+                if markerid is not None:
+
+                    del markers[markerid]
+
+            else:
+
+                break
+
+        return ''.join(chunks)
+
+
+
 
 
 
@@ -1307,6 +1706,270 @@ ANYTHING = [
 JSONScanner = Scanner(ANYTHING)
 
 
+def _scan_string(s, end, encoding):
+
+    return scanstring(s, end + 1, encoding)
+
+
+
+def _scan_number(s, end, encoding):
+
+    match = JSONNumber.regex.match(s, end)
+
+    if match is None:
+
+        if s.startswith('-Infinity', end):
+
+            return NegInf, end + 9
+
+        return None
+
+    integer, frac, exp = match.groups()
+
+    if frac or exp:
+
+        res = float(integer + (frac or '') + (exp or ''))
+
+    else:
+
+        res = int(integer)
+
+    return res, match.end()
+
+
+
+_CONSTANT_WORDS = {
+
+    't': 'true',
+
+    'f': 'false',
+
+    'n': 'null',
+
+    'N': 'NaN',
+
+    'I': 'Infinity',
+
+}
+
+
+
+def _scan_constant(s, end, encoding):
+
+    word = _CONSTANT_WORDS[s[end]]
+
+    if not s.startswith(word, end):
+
+        return None
+
+    return _CONSTANTS[word], end + len(word)
+
+
+
+# First character of a scalar value -> function(s, end, encoding)
+
+# returning the value and the index just past it, or None when no value
+
+# starts there.
+
+_SCALARS = {'"': _scan_string, '-': _scan_number}
+
+for i in '0123456789':
+
+    _SCALARS[i] = _scan_number
+
+for i in _CONSTANT_WORDS:
+
+    _SCALARS[i] = _scan_constant
+
+
+
+def scan_once(s, end=0, encoding=None, object_hook=None, _w=WHITESPACE.match):
+
+    """
+
+    Decode the JSON value starting at ``s[end]``; return it and the index
+
+    just past it.
+
+
+
+    This is the table-driven counterpart of ``JSONScanner``: scalars are
+
+    dispatched on their first character through ``_SCALARS`` and open
+
+    objects and arrays are kept on an explicit stack, so neither the
+
+    regex scanner nor Python recursion is involved.
+
+    """
+
+    # Frames are [container, key]; key is None for arrays.
+
+    stack = []
+
+    while True:
+
+        nextchar = s[end:end + 1]
+
+        if nextchar == '{':
+
+            end = _w(s, end + 1).end()
+
+            nextchar = s[end:end + 1]
+
+            if nextchar == '}':
+
+                # trivial empty object, which skips object_hook just as
+
+                # JSONObject does
+
+                value = {}
+
+                end += 1
+
+            elif nextchar != '"':
+
+                raise ValueError(errmsg("Expecting property name", s, end))
+
+            else:
+
+                key, end = scanstring(s, end + 1, encoding)
+
+                end = _w(s, end).end()
+
+                if s[end:end + 1] != ':':
+
+                    raise ValueError(errmsg("Expecting : delimiter", s, end))
+
+                end = _w(s, end + 1).end()
+
+                stack.append([{}, key])
+
+                continue
+
+        elif nextchar == '[':
+
+            end = _w(s, end + 1).end()
+
+            if s[end:end + 1] == ']':
+
+                value = []
+
+                end += 1
+
+            else:
+
+                stack.append([[], None])
+
+                continue
+
+        else:
+
+            scan = _SCALARS.get(nextchar)
+
+            result = None
+
+            if scan is not None:
+
+                result = scan(s, end, encoding)
+
+            if result is None:
+
+                if not stack:
+
+                    # what JSONScanner.iterscan reports at the top level
+
+                    raise ValueError("No JSON object could be decoded")
+
+                raise ValueError(errmsg("Expecting object", s, end))
+
+            value, end = result
+
+        # Store the value in its container and close finished ones.
+
+        while stack:
+
+            frame = stack[-1]
+
+            container, key = frame
+
+            end = _w(s, end).end()
+
+            nextchar = s[end:end + 1]
+
+            end += 1
+
+            if key is None:
+
+                container.append(value)
+
+                if nextchar == ']':
+
+                    stack.pop()
+
+                    value = container
+
+                    continue
+
+                if nextchar != ',':
+
+                    # JSONArray reports the index past the bad character,
+
+                    # JSONObject the bad character itself; keep both.
+
+                    raise ValueError(errmsg("Expecting , delimiter", s, end))
+
+                end = _w(s, end).end()
+
+                break
+
+            container[key] = value
+
+            if nextchar == '}':
+
+                stack.pop()
+
+                value = container
+
+                if object_hook is not None:
+
+                    value = object_hook(value)
+
+                continue
+
+            if nextchar != ',':
+
+                raise ValueError(errmsg("Expecting , delimiter", s, end - 1))
+
+            end = _w(s, end).end()
+
+            if s[end:end + 1] != '"':
+
+                raise ValueError(errmsg("Expecting property name", s, end))
+
+            key, end = scanstring(s, end + 1, encoding)
+
+            end = _w(s, end).end()
+
+            if s[end:end + 1] != ':':
+
+                raise ValueError(errmsg("Expecting : delimiter", s, end))
+
+            end = _w(s, end + 1).end()
+
+            frame[1] = key
+
+            break
+
+        else:
+
+            return value, end
+
+
+
+
+
 
 class JSONDecoder(object):
 
@@ -1448,6 +2111,12 @@ class JSONDecoder(object):
 
         """
 
+        if self._scanner is JSONDecoder._scanner and set(kw) <= set(['idx']):
+
+            return scan_once(s, kw.get('idx', 0), self.encoding,
+
+                             self.object_hook)
+
         kw.setdefault('context', self)
 
         try:
@@ -1851,6 +2520,90 @@ def write(obj):
 
 
 
+def benchmark(obj=None, number=5, out=None):
+
+    """
+
+    Time encoding and decoding of ``obj`` through the generator based
+
+    encoder and regex scanner, the flat encoder and table-driven decoder,
+
+    and the standard library ``json`` module (C accelerated where built).
+
+    """
+
+    import json
+
+    import sys
+
+    import time
+
+    if out is None:
+
+        out = sys.stdout
+
+    if obj is None:
+
+        row = {'id': 12345, 'name': u'sample', 'score': 3.25, 'tags':
+
+               [u'a', u'b', u'c'], 'active': True, 'parent': None}
+
+        obj = {'rows': [dict(row, id=i) for i in range(20000)]}
+
+    encoder = JSONEncoder()
+
+    text = encoder._encode_flat(obj)
+
+    decoder = JSONDecoder()
+
+
+
+    def best(fn):
+
+        times = []
+
+        for _ in range(number):
+
+            start = time.time()
+
+            fn()
+
+            times.append(time.time() - start)
+
+        return min(times)
+
+
+
+    def old_decode():
+
+        obj, end = JSONDecoder._scanner.iterscan(
+
+            text, idx=0, context=decoder).next()
+
+
+
+    out.write('%d bytes of JSON, best of %d\n' % (len(text), number))
+
+    for label, fn in [
+
+            ('encode: iterencode', lambda: ''.join(encoder.iterencode(obj))),
+
+            ('encode: flat', lambda: encoder._encode_flat(obj)),
+
+            ('encode: json.dumps', lambda: json.dumps(obj)),
+
+            ('decode: Scanner', old_decode),
+
+            ('decode: scan_once', lambda: scan_once(text)),
+
+            ('decode: json.loads', lambda: json.loads(text))]:
+
+        out.write('  %-20s %8.3fs\n' % (label, best(fn)))
+
+
+
+
+
 
 
 
@@ -216,6 +216,22 @@ class WebSocketHandler(tornado.web.RequestHandler):
             message = tornado.escape.json_encode(message)
         return self.ws_connection.write_message(message, binary=binary)
 
+    def write_messages(self, messages, binary=False):
+        """Sends several messages to the client with a single write.
+
+        Each message is converted as in `write_message`; the frames are
+        packed into one buffer, so the stream sees one write rather than
+        one per message.  Returns a `.Future` for the whole batch.
+
+        If the connection is already closed, raises `WebSocketClosedError`.
+        """
+        if self.ws_connection is None:
+            raise WebSocketClosedError()
+        messages = [tornado.escape.json_encode(message)
+                    if isinstance(message, dict) else message
+                    for message in messages]
+        return self.ws_connection.write_messages(messages, binary=binary)
+
     def select_subprotocol(self, subprotocols):
         """Invoked when a new WebSocket requests specific subprotocols.
 
@@ -449,12 +465,37 @@ class _PerMessageDeflateCompressor(object):
         return zlib.compressobj(tornado.web.GZipContentEncoding.GZIP_LEVEL,
                                 zlib.DEFLATED, -self._max_wbits)
 
-    def compress(self, data):
+    @property
+    def shared_key(self):
+        """Identifies compressors that produce identical output.
+
+        A compressor without context takeover starts every message from
+        a fresh state, so its output depends only on the window size and
+        can be shared between connections; persistent compressors return
+        None.
+        """
+        if self._compressor is not None:
+            return None
+        return ('deflate', self._max_wbits)
+
+    def compress_parts(self, data):
+        """Like `compress`, but returns the payload as a pair of buffers.
+
+        On Python 3 the trailing sync marker is sliced off without
+        copying, so the parts can be joined straight into an outgoing
+        frame.  Python 2 cannot join memoryviews and gets a plain slice.
+        """
         compressor = self._compressor or self._create_compressor()
-        data = (compressor.compress(data) +
-                compressor.flush(zlib.Z_SYNC_FLUSH))
-        assert data.endswith(b'\x00\x00\xff\xff')
-        return data[:-4]
+        head = compressor.compress(data)
+        tail = compressor.flush(zlib.Z_SYNC_FLUSH)
+        assert tail.endswith(b'\x00\x00\xff\xff')
+        if PY3:
+            return head, memoryview(tail)[:-4]
+        return head, tail[:-4]
+
+    def compress(self, data):
+        head, tail = self.compress_parts(data)
+        return b''.join((head, tail))
 
 
 class _PerMessageDeflateDecompressor(object):
@@ -475,7 +516,15 @@ class _PerMessageDeflateDecompressor(object):
 
     def decompress(self, data):
         decompressor = self._decompressor or self._create_decompressor()
-        return decompressor.decompress(data + b'\x00\x00\xff\xff')
+        # Feed the sync marker separately instead of appending it to
+        # ``data``, which would copy the whole payload.  Everything
+        # before the marker is complete, so the second call rarely
+        # produces output.
+        head = decompressor.decompress(data)
+        tail = decompressor.decompress(b'\x00\x00\xff\xff')
+        if tail:
+            return head + tail
+        return head
 
 
 class WebSocketProtocol13(WebSocketProtocol):
@@ -656,35 +705,64 @@ class WebSocketProtocol13(WebSocketProtocol):
         self._decompressor = _PerMessageDeflateDecompressor(
             **self._get_compressor_options(other_side, agreed_parameters))
 
-    def _write_frame(self, fin, opcode, data, flags=0):
+    def _frame_pieces(self, pieces, fin, opcode, payload, flags=0):
+        """Appends the header, mask and payload of one frame to ``pieces``.
+
+        ``payload`` is a sequence of buffers holding the frame data.
+        """
         if fin:
             finbit = self.FIN
         else:
             finbit = 0
-        frame = struct.pack("B", finbit | opcode | flags)
-        l = len(data)
+        l = sum(len(part) for part in payload)
         if self.mask_outgoing:
             mask_bit = 0x80
         else:
             mask_bit = 0
         if l < 126:
-            frame += struct.pack("B", l | mask_bit)
+            pieces.append(struct.pack("BB", finbit | opcode | flags,
+                                      l | mask_bit))
         elif l <= 0xFFFF:
-            frame += struct.pack("!BH", 126 | mask_bit, l)
+            pieces.append(struct.pack("!BBH", finbit | opcode | flags,
+                                      126 | mask_bit, l))
         else:
-            frame += struct.pack("!BQ", 127 | mask_bit, l)
+            pieces.append(struct.pack("!BBQ", finbit | opcode | flags,
+                                      127 | mask_bit, l))
         if self.mask_outgoing:
             mask = os.urandom(4)
-            data = mask + _websocket_mask(mask, data)
-        frame += data
-        self._wire_bytes_out += len(frame)
+            if len(payload) == 1:
+                data = payload[0]
+            else:
+                data = b"".join(payload)
+            pieces.append(mask)
+            pieces.append(_websocket_mask(mask, data))
+        else:
+            pieces.extend(payload)
+
+    def _pack_frames(self, frames):
+        """Packs ``(fin, opcode, payload, flags)`` tuples into one string.
+
+        The pieces of all frames are joined once, so each payload byte is
+        copied a single time (twice when masked) on its way to the stream.
+        """
+        pieces = []
+        for frame in frames:
+            self._frame_pieces(pieces, *frame)
+        return b"".join(pieces)
+
+    def _write_bytes(self, data):
+        self._wire_bytes_out += len(data)
         try:
-            return self.stream.write(frame)
+            return self.stream.write(data)
         except StreamClosedError:
             self._abort()
 
-    def write_message(self, message, binary=False):
-        """Sends the given message to the client of this Web Socket."""
+    def _write_frame(self, fin, opcode, data, flags=0):
+        return self._write_bytes(
+            self._pack_frames([(fin, opcode, (data,), flags)]))
+
+    def _message_frame(self, message, binary):
+        """Encodes a data message as a frame tuple for `_pack_frames`."""
         if binary:
             opcode = 0x2
         else:
@@ -694,9 +772,48 @@ class WebSocketProtocol13(WebSocketProtocol):
         self._message_bytes_out += len(message)
         flags = 0
         if self._compressor:
-            message = self._compressor.compress(message)
+            payload = self._compressor.compress_parts(message)
             flags |= self.RSV1
-        return self._write_frame(True, opcode, message, flags=flags)
+        else:
+            payload = (message,)
+        return True, opcode, payload, flags
+
+    def write_message(self, message, binary=False):
+        """Sends the given message to the client of this Web Socket."""
+        return self._write_bytes(
+            self._pack_frames([self._message_frame(message, binary)]))
+
+    def write_messages(self, messages, binary=False):
+        """Sends several messages with a single write to the stream."""
+        return self._write_bytes(self._pack_frames(
+            [self._message_frame(message, binary) for message in messages]))
+
+    def _broadcast_key(self):
+        """Connections with equal keys put the same bytes on the wire for
+        a given message; None means this connection's frames are unique
+        (masked, or compressed with context takeover).
+        """
+        if self.mask_outgoing:
+            return None
+        if self._compressor is None:
+            return ('identity',)
+        return self._compressor.shared_key
+
+    def _write_shared(self, message, binary, frames):
+        """Writes ``message``, reusing a frame from ``frames`` if a
+        connection with the same `_broadcast_key` already built one.
+        """
+        key = self._broadcast_key()
+        if key is None:
+            return self.write_message(message, binary=binary)
+        key = (key, binary)
+        data = frames.get(key)
+        if data is None:
+            data = frames[key] = self._pack_frames(
+                [self._message_frame(message, binary)])
+        else:
+            self._message_bytes_out += len(message)
+        return self._write_bytes(data)
 
     def write_ping(self, data):
         """Send ping frame."""
@@ -980,6 +1097,10 @@ class WebSocketClientConnection(simple_httpclient._HTTPConnection):
         """Sends a message to the WebSocket server."""
         return self.protocol.write_message(message, binary)
 
+    def write_messages(self, messages, binary=False):
+        """Sends several messages to the WebSocket server in one write."""
+        return self.protocol.write_messages(messages, binary)
+
     def read_message(self, callback=None):
         """Reads a message from the WebSocket server.
 
@@ -1066,4 +1187,30 @@ def websocket_connect(url, io_loop=None, callback=None, connect_timeout=None,
                                      compression_options=compression_options)
     if callback is not None:
         io_loop.add_future(conn.connect_future, callback)
-    return conn.connect_future
\ No newline at end of file
+    return conn.connect_future
+
+
+def broadcast_message(handlers, message, binary=False):
+    """Sends ``message`` to every `WebSocketHandler` in ``handlers``.
+
+    The message is converted as in `WebSocketHandler.write_message`.
+    Connections that negotiated the same framing (no compression, or
+    permessage-deflate with ``server_no_context_takeover`` and the same
+    window size) get identical bytes, so the frame is compressed and
+    packed once per group instead of once per connection; connections
+    that keep a compression context are written individually.  Closed
+    connections are skipped.
+
+    Returns a list of the `.Future` objects for the individual writes.
+    """
+    if isinstance(message, dict):
+        message = tornado.escape.json_encode(message)
+    message = tornado.escape.utf8(message)
+    frames = {}
+    futures = []
+    for handler in handlers:
+        if handler.ws_connection is None:
+            continue
+        futures.append(
+            handler.ws_connection._write_shared(message, binary, frames))
+    return futures
@@ -4,8 +4,13 @@
 
 __author__ = "Taylor Oshan Tayoshan@gmail.com"
 
+import functools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import numpy.linalg as la
+from scipy import sparse
+from scipy.spatial import cKDTree
 from scipy.stats import t
 from .kernels import *
 from .diagnostics import get_AIC, get_AICc, get_BIC
@@ -18,6 +23,192 @@ from crankshaft.regression.glm.utils import cache_readonly
 fk = {'gaussian': fix_gauss, 'bisquare': fix_bisquare, 'exponential': fix_exp}
 ak = {'gaussian': adapt_gauss, 'bisquare': adapt_bisquare, 'exponential': adapt_exp}
 
+def _kernel_row(W, i):
+    """
+    Column indices and weights of row i of a dense or CSR weights matrix;
+    the indices are a full slice for a dense matrix
+    """
+    if sparse.issparse(W):
+        lo, hi = W.indptr[i], W.indptr[i+1]
+        return W.indices[lo:hi], W.data[lo:hi]
+    return slice(None), np.array(W[i]).flatten()
+
+def _calibrate(state, bounds):
+    """
+    Run the local iwls regressions for calibration points start..stop-1
+
+    state is (y, X, family, offset, ini_params, tol, max_iter, W,
+    streaming); returns the rows of params, predy, v, w and CCT for the
+    points, plus either the rows of S or, when streaming, the diagonal
+    entries of S and the column sums of w[i]*S[i]**2 over the points
+
+    When W is sparse each regression only sees the observations with a
+    nonzero weight (and observation i itself, at weight 0 if need be);
+    the others have no effect on the estimates and their entries of S
+    are zero
+    """
+    y, X, family, offset, ini_params, tol, max_iter, W, streaming = state
+    start, stop = bounds
+    m, k, n = stop - start, X.shape[1], X.shape[0]
+    params = np.zeros((m, k))
+    predy = np.zeros((m, 1))
+    v = np.zeros((m, 1))
+    w = np.zeros((m, 1))
+    CCT = np.zeros((m, k))
+    if streaming:
+        influ = np.zeros((m, 1))
+        STS = np.zeros(n)
+    else:
+        S = np.zeros((m, n))
+    for j, i in enumerate(range(start, stop)):
+        cols, wi = _kernel_row(W, i)
+        if isinstance(cols, slice):
+            at = i
+            rslt = iwls(y, X, family, offset, ini_params, tol, max_iter,
+                    wi=wi.reshape((-1,1)))
+        else:
+            at = np.searchsorted(cols, i)
+            if at == len(cols) or cols[at] != i:
+                cols = np.insert(cols, at, i)
+                wi = np.insert(wi, at, 0.0)
+            rslt = iwls(y[cols], X[cols], family, offset[cols], ini_params,
+                    tol, max_iter, wi=wi.reshape((-1,1)))
+        params[j,:] = rslt[0].T
+        predy[j] = rslt[1][at]
+        v[j] = rslt[2][at]
+        w[j] = rslt[3][at]
+        zi = rslt[4].flatten()
+        ri = np.dot(X[i], rslt[5])
+        Si = ri*zi*(1.0/zi)
+        if streaming:
+            influ[j] = Si[at]
+            STS[cols] += w[j]*Si**2
+        else:
+            S[j, cols] = Si
+        #dont need unless f is explicitly passed for
+        #prediction of non-sampled points
+        #cf = rslt[5] - np.dot(rslt[5], f)
+        #CCT[i] = np.diag(np.dot(cf, cf.T/rslt[3]))
+        CCT[j] = np.diag(np.dot(rslt[5], rslt[5].T))
+    if streaming:
+        return params, predy, v, w, CCT, None, influ, STS
+    return params, predy, v, w, CCT, S, None, None
+
+_worker_state = None
+
+def _init_worker(state):
+    global _worker_state
+    _worker_state = state
+
+def _calibrate_worker(bounds):
+    return _calibrate(_worker_state, bounds)
+
+class GWRNeighbors(object):
+    """
+    Neighbour lists for truncated kernels, found with a KD-tree over the
+    observation coordinates. The lists from the widest query made so far
+    are kept for the calibration points (and for the last set of
+    prediction points), so a bandwidth search only goes back to the tree
+    when the bandwidth grows past them.
+
+    Parameters
+    ----------
+        coords        : array-like
+                        n*2, collection of n sets of (x,y) coordinates of
+                        observations
+
+    Attributes
+    ----------
+        tree          : cKDTree
+                        KD-tree over coords
+
+        n             : integer
+                        number of observations
+    """
+    def __init__(self, coords):
+        self.coords = np.asarray(coords, dtype=float)
+        self.n = len(self.coords)
+        self.tree = cKDTree(self.coords)
+        self._knn = {}
+        self._ball = {}
+
+    def _points(self, points):
+        if points is None:
+            return None, self.coords
+        points = np.asarray(points, dtype=float)
+        return points.tobytes(), points
+
+    def _store(self, cache, key, entry):
+        if key is not None:
+            for other in [k for k in cache if k is not None]:
+                del cache[other]
+        cache[key] = entry
+        return entry
+
+    def adaptive(self, nn, points=None):
+        """
+        Neighbours within the adaptive bandwidth of each point: the
+        distance to its nn-th nearest observation (scaled by 1.0000001,
+        as in the kernels module), so ties at that distance are kept.
+        Returns indptr, indices, distances and bandwidths in CSR layout
+        """
+        key, pts = self._points(points)
+        k = min(self.n, int(nn))
+        kk = 0
+        entry = self._knn.get(key)
+        while True:
+            if entry is None or entry[0] < max(k, kk):
+                kk = min(self.n, 2*max(k, kk))
+                dist, idx = self.tree.query(pts, k=kk)
+                entry = self._store(self._knn, key, (kk,
+                    dist.reshape((len(pts), kk)), idx.reshape((len(pts), kk))))
+            kk, dist, idx = entry
+            bw = dist[:,k-1] * 1.0000001
+            mask = dist < bw.reshape((-1,1))
+            if kk == self.n or not mask[:,-1].any():
+                break
+            # ties run past the cached neighbours; query further
+            kk += 1
+        counts = mask.sum(axis=1)
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        return indptr, idx[mask], dist[mask], np.repeat(bw, counts)
+
+    def fixed(self, bw, points=None):
+        """
+        Neighbours closer than the distance bw to each point. Returns
+        indptr, indices, distances and bandwidths in CSR layout
+        """
+        key, pts = self._points(points)
+        bw = float(bw)
+        entry = self._ball.get(key)
+        if entry is None or entry[0] < bw:
+            lists = self.tree.query_ball_point(pts, bw)
+            counts = np.array([len(l) for l in lists])
+            indices = np.concatenate([np.asarray(l, dtype=np.intp)
+                for l in lists])
+            dist = np.sqrt(np.sum((self.coords[indices] -
+                np.repeat(pts, counts, axis=0))**2, axis=1))
+            entry = self._store(self._ball, key, (bw,
+                np.concatenate(([0], np.cumsum(counts))), indices, dist))
+        _, indptr, indices, dist = entry
+        mask = dist < bw
+        kept = np.concatenate(([0], np.cumsum(mask)))
+        return kept[indptr], indices[mask], dist[mask], bw
+
+    def bisquare(self, bw, fixed, points=None):
+        """
+        m*n CSR matrix of bisquare kernel weights, the nonzero entries of
+        fix_bisquare (fixed=True) or adapt_bisquare (fixed=False)
+        """
+        if fixed:
+            indptr, indices, dist, bws = self.fixed(bw, points)
+        else:
+            indptr, indices, dist, bws = self.adaptive(bw, points)
+        W = sparse.csr_matrix(((1-(dist/bws)**2)**2, indices, indptr),
+                shape=(len(indptr) - 1, self.n))
+        W.sort_indices()
+        return W
+
 class GWR(GLM):
     """
     Geographically weighted regression. Can currently estimate Gaussian,
@@ -77,6 +268,17 @@ class GWR(GLM):
                         True to include intercept (default) in model and False to exclude
                         intercept.
 
+        sparse        : boolean
+                        True to build a bisquare kernel as a sparse CSR
+                        matrix from KD-tree neighbour lists and run each
+                        local regression on the observations it weights;
+                        other kernels are always dense. Default is False
+
+        neighbors     : GWRNeighbors
+                        neighbour lists to reuse, e.g. from a model on the
+                        same coords at another bandwidth; default is None,
+                        which builds them when needed
+
     Attributes
     ----------
         coords        : array-like
@@ -141,10 +343,15 @@ class GWR(GLM):
 
         W             : array
                         n*n, spatial weights matrix for weighting all
-                        observations from each calibration point
+                        observations from each calibration point; a CSR
+                        matrix when sparse
+
+        neighbors     : GWRNeighbors
+                        neighbour lists behind a sparse W; None otherwise
     """
     def __init__(self, coords, y, X, bw, family=Gaussian(), offset=None,
-            sigma2_v1=False, kernel='bisquare', fixed=False, constant=True):
+            sigma2_v1=False, kernel='bisquare', fixed=False, constant=True,
+            sparse=False, neighbors=None):
         """
         Initialize class
         """
@@ -155,6 +362,8 @@ class GWR(GLM):
         self.bw = bw
         self.kernel = kernel
         self.fixed = fixed
+        self.sparse = sparse
+        self.neighbors = neighbors
         if offset is None:
             self.offset = np.ones((self.n, 1))
         else:
@@ -167,6 +376,10 @@ class GWR(GLM):
         self.P = None
 
     def _build_W(self, fixed, kernel, coords, bw, points=None):
+        if self.sparse and kernel == 'bisquare':
+            if self.neighbors is None:
+                self.neighbors = GWRNeighbors(coords)
+            return self.neighbors.bisquare(bw, fixed, points)
         if fixed:
             try:
                 W = fk[kernel](coords, bw, points)
@@ -179,7 +392,8 @@ class GWR(GLM):
                 raise TypeError('Unsupported kernel function  ', kernel)
         return W
 
-    def fit(self, ini_params=None, tol=1.0e-5, max_iter=20, solve='iwls'):
+    def fit(self, ini_params=None, tol=1.0e-5, max_iter=20, solve='iwls',
+            n_jobs=1, backend='thread', streaming=False):
         """
         Method that fits a model with a particular estimation routine.
 
@@ -198,40 +412,83 @@ class GWR(GLM):
         solve         : string
                         Technique to solve MLE equations.
                         'iwls' = iteratively (re)weighted least squares (default)
+        n_jobs        : integer
+                        number of workers running the local regressions;
+                        default is 1 (serial) and -1 uses one per CPU
+        backend       : string
+                        'thread' (default) to run the workers as threads,
+                        which overlap while numpy releases the GIL, or
+                        'process' for a pool of processes
+        streaming     : boolean
+                        True to only keep the diagnostics derived from the
+                        n*n hat matrix (tr_S, tr_STS and influ) instead of
+                        the matrix itself, so memory stays O(n*k) on top of
+                        W; the results then have S set to None.
+                        Default is False
         """
+        if n_jobs != -1 and (n_jobs < 1 or int(n_jobs) != n_jobs):
+            raise ValueError('n_jobs must be -1 or a positive integer  ', n_jobs)
+        if backend not in ('thread', 'process'):
+            raise ValueError('Unsupported backend  ', backend)
         self.fit_params['ini_params'] = ini_params
         self.fit_params['tol'] = tol
         self.fit_params['max_iter'] = max_iter
         self.fit_params['solve']= solve
+        self.fit_params['n_jobs'] = n_jobs
+        self.fit_params['backend'] = backend
+        self.fit_params['streaming'] = streaming
         if solve.lower() == 'iwls':
             m = self.W.shape[0]
             params = np.zeros((m, self.k))
             predy = np.zeros((m, 1))
             v = np.zeros((m, 1))
             w = np.zeros((m, 1))
-            z = np.zeros((self.n, self.n))
-            S = np.zeros((self.n, self.n))
-            R = np.zeros((self.n, self.n))
             CCT = np.zeros((m, self.k))
-            #f = np.zeros((n, n))
-            p = np.zeros((m, 1))
-            for i in range(m):
-                wi = self.W[i].reshape((-1,1))
-                rslt = iwls(self.y, self.X, self.family, self.offset, ini_params, tol, max_iter, wi=wi)
-                params[i,:] = rslt[0].T
-                predy[i] = rslt[1][i]
-                v[i] = rslt[2][i]
-                w[i] = rslt[3][i]
-                z[i] = rslt[4].flatten()
-                R[i] = np.dot(self.X[i], rslt[5])
-                ri = np.dot(self.X[i], rslt[5])
-                S[i] = ri*np.reshape(rslt[4].flatten(), (1,-1))
-                #dont need unless f is explicitly passed for
-                #prediction of non-sampled points
-                #cf = rslt[5] - np.dot(rslt[5], f)
-                #CCT[i] = np.diag(np.dot(cf, cf.T/rslt[3]))
-                CCT[i] = np.diag(np.dot(rslt[5], rslt[5].T))
-            S = S * (1.0/z)
+            if streaming:
+                S = None
+                influ = np.zeros((self.n, 1))
+                STS = np.zeros(self.n)
+            else:
+                S = np.zeros((self.n, self.n))
+            if n_jobs == -1:
+                n_jobs = multiprocessing.cpu_count()
+            state = (self.y, self.X, self.family, self.offset, ini_params,
+                    tol, max_iter, self.W, streaming)
+            # a few blocks per worker to even out uneven convergence, and
+            # bounded so the blocks of S rows in flight stay small
+            size = max(1, min(256, m // (4*n_jobs)))
+            blocks = [(i, min(i + size, m)) for i in range(0, m, size)]
+            pool = None
+            if n_jobs == 1:
+                results = (_calibrate(state, b) for b in blocks)
+            elif backend == 'thread':
+                pool = ThreadPool(n_jobs)
+                results = pool.imap(functools.partial(_calibrate, state), blocks)
+            else:
+                pool = multiprocessing.Pool(n_jobs, _init_worker, (state,))
+                results = pool.imap(_calibrate_worker, blocks)
+            try:
+                for (start, stop), rslt in zip(blocks, results):
+                    params[start:stop] = rslt[0]
+                    predy[start:stop] = rslt[1]
+                    v[start:stop] = rslt[2]
+                    w[start:stop] = rslt[3]
+                    CCT[start:stop] = rslt[4]
+                    if streaming:
+                        influ[start:stop] = rslt[6]
+                        STS += rslt[7]
+                    else:
+                        S[start:stop] = rslt[5]
+            finally:
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+            if streaming:
+                diagnostics = {'influ': influ,
+                        'tr_S': np.sum(influ*w),
+                        'tr_STS': np.dot(w.flatten(), STS)}
+                return GWRResults(self, params, predy, S, CCT, w,
+                        diagnostics=diagnostics)
         return GWRResults(self, params, predy, S, CCT, w)
 
     def predict(self, points, P, exog_scale=None, exog_resid=None, fit_params={}):
@@ -308,11 +565,16 @@ class GWRResults(GLMResults):
                               squares; default is None
 
         S                   : array
-                              n*n, hat matrix
+                              n*n, hat matrix; None if the model was fit
+                              with streaming=True
 
         CCT                 : array
                               n*k, scaled variance-covariance matrix
 
+        diagnostics         : dict
+                              tr_S, tr_STS and influ, computed while fitting
+                              when S is None
+
     Attributes
     ----------
         model               : GWR Object
@@ -455,7 +717,7 @@ class GWRResults(GLMResults):
                               parameters passed into fit method to define estimation
                               routine
     """
-    def __init__(self, model, params, predy, S, CCT, w=None):
+    def __init__(self, model, params, predy, S, CCT, w=None, diagnostics=None):
         GLMResults.__init__(self, model, params, predy, w)
         self.W = model.W
         self.offset = model.offset
@@ -463,6 +725,7 @@ class GWRResults(GLMResults):
             self.w = w
         self.predy = predy
         self.S = S
+        self.diagnostics = diagnostics
         self.CCT = self.cov_params(CCT, model.exog_scale)
         self._cache = {}
     
@@ -505,6 +768,8 @@ class GWRResults(GLMResults):
         """
         trace of S (hat) matrix
         """
+        if self.S is None:
+            return self.diagnostics['tr_S']
         return np.trace(self.S*self.w)
 
     @cache_readonly
@@ -512,6 +777,8 @@ class GWRResults(GLMResults):
         """
         trace of STS matrix
         """
+        if self.S is None:
+            return self.diagnostics['tr_STS']
         return np.trace(np.dot(self.S.T*self.w,self.S*self.w))
 
     @cache_readonly
@@ -524,11 +791,13 @@ class GWRResults(GLMResults):
         else:
             n = self.n
         off = self.offset.reshape((-1,1))
+        y = self.y.reshape((-1,1))
         arr_ybar = np.zeros(shape=(self.n,1))
         for i in range(n):
-            w_i= np.reshape(np.array(self.W[i]), (-1, 1))
-            sum_yw = np.sum(self.y.reshape((-1,1)) * w_i)
-            arr_ybar[i] = 1.0 * sum_yw / np.sum(w_i*off)
+            cols, w_i = _kernel_row(self.W, i)
+            w_i = w_i.reshape((-1, 1))
+            sum_yw = np.sum(y[cols] * w_i)
+            arr_ybar[i] = 1.0 * sum_yw / np.sum(w_i*off[cols])
         return arr_ybar
 
     @cache_readonly
@@ -546,10 +815,11 @@ class GWRResults(GLMResults):
             n = len(self.model.points)
         else:
             n = self.n
+        y = self.y.reshape((-1,1))
         TSS = np.zeros(shape=(n,1))
         for i in range(n):
-            TSS[i] = np.sum(np.reshape(np.array(self.W[i]), (-1,1)) *
-                    (self.y.reshape((-1,1)) - self.y_bar[i])**2)
+            cols, w_i = _kernel_row(self.W, i)
+            TSS[i] = np.sum(w_i.reshape((-1,1)) * (y[cols] - self.y_bar[i])**2)
         return TSS
 
     @cache_readonly
@@ -570,8 +840,8 @@ class GWRResults(GLMResults):
             resid = self.resid_response.reshape((-1,1))
         RSS = np.zeros(shape=(n,1))
         for i in range(n):
-            RSS[i] = np.sum(np.reshape(np.array(self.W[i]), (-1,1))
-                    * resid**2)
+            cols, w_i = _kernel_row(self.W, i)
+            RSS[i] = np.sum(w_i.reshape((-1,1)) * resid[cols]**2)
         return RSS
 
     @cache_readonly
@@ -659,6 +929,8 @@ class GWRResults(GLMResults):
         """
         Influence: leading diagonal of S Matrix
         """
+        if self.S is None:
+            return self.diagnostics['influ']
         return np.reshape(np.diag(self.S),(-1,1))
 
     @cache_readonly
@@ -674,6 +946,13 @@ class GWRResults(GLMResults):
         """
         return self.std_res**2 * self.influ / (self.tr_S * (1.0-self.influ))
 
+    @cache_readonly
+    def _dense_W(self):
+        # the local deviances are n*n whether or not W is sparse
+        if sparse.issparse(self.W):
+            return self.W.toarray()
+        return self.W
+
     @cache_readonly
     def deviance(self):
         off = self.offset.reshape((-1,1)).T
@@ -682,9 +961,9 @@ class GWRResults(GLMResults):
         if isinstance(self.family, Gaussian):
             raise NotImplementedError('deviance not currently used for Gaussian')
         elif isinstance(self.family, Poisson):
-            dev = np.sum(2.0*self.W*(y*np.log(y/(ybar*off))-(y-ybar*off)),axis=1)
+            dev = np.sum(2.0*self._dense_W*(y*np.log(y/(ybar*off))-(y-ybar*off)),axis=1)
         elif isinstance(self.family, Binomial):
-            dev = self.family.deviance(self.y, self.y_bar, self.W, axis=1)
+            dev = self.family.deviance(self.y, self.y_bar, self._dense_W, axis=1)
         return dev.reshape((-1,1))
 
     @cache_readonly
@@ -698,7 +977,7 @@ class GWRResults(GLMResults):
             global_dev_res = ((self.family.resid_dev(self.y, self.mu))**2)
             dev_res = np.repeat(global_dev_res.flatten(),self.n)
             dev_res = dev_res.reshape((self.n, self.n))
-            dev_res = np.sum(dev_res * self.W.T, axis=0)
+            dev_res = np.sum(dev_res * self._dense_W.T, axis=0)
             return dev_res.reshape((-1,1))
 
     @cache_readonly
@@ -900,6 +1179,17 @@ class FBGWR(GWR):
                         True to include intercept (default) in model and False to exclude
                         intercept.
 
+        sparse        : boolean
+                        True to build a bisquare kernel as a sparse CSR
+                        matrix from KD-tree neighbour lists and run each
+                        local regression on the observations it weights;
+                        other kernels are always dense. Default is False
+
+        neighbors     : GWRNeighbors
+                        neighbour lists to reuse, e.g. from a model on the
+                        same coords at another bandwidth; default is None,
+                        which builds them when needed
+
     Attributes
     ----------
         coords        : array-like
@@ -968,7 +1258,8 @@ class FBGWR(GWR):
 
     """
     def __init__(self, coords, y, X, bws, XB, err, family=Gaussian(), offset=None,
-           sigma2_v1=False, kernel='bisquare', fixed=False, constant=True):
+           sigma2_v1=False, kernel='bisquare', fixed=False, constant=True,
+           sparse=False, neighbors=None):
         """
         Initialize class
         """
@@ -984,6 +1275,8 @@ class FBGWR(GWR):
         self.kernel = kernel
         self.fixed = fixed
         self.constant = constant
+        self.sparse = sparse
+        self.neighbors = neighbors
         if constant:
             self.X = USER.check_constant(self.X)
 
@@ -1011,11 +1304,12 @@ class FBGWR(GWR):
         params = np.zeros_like(self.X)
         err = self.err
         for i, bw in enumerate(self.bws):
-            W = self._build_W(self.fixed, self.kernel, self.coords, bw)
             X = self.X[:,i].reshape((-1,1))
             y = self.XB[:,i].reshape((-1,1)) + err
             model = GWR(self.coords, y, X, bw, self.family, self.offset,
-                    self.sigma2_v1, self.kernel, self.fixed, constant=False)
+                    self.sigma2_v1, self.kernel, self.fixed, constant=False,
+                    sparse=self.sparse, neighbors=self.neighbors)
+            self.neighbors = model.neighbors
             results = model.fit(ini_params, tol, max_iter, solve)
             params[:,i] = results.params.flatten()
             err = results.resid_response.reshape((-1,1))
@@ -28,7 +28,11 @@ from elasticsearch.client.utils import query_params, _make_path
 from tornado import concurrent
 from tornado import gen
 from tornado import httpclient
+from tornado import ioloop
+from tornado import locks
+import collections
 import logging
+import math
 import time
 try:
     from urllib import urlencode
@@ -45,6 +49,91 @@ def execute_sql_command(command):
     # Assume this function executes a SQL command
     pass
 
+def _endpoint(method, url):
+    """Return the key a request is filed under in the latency histograms,
+    e.g. ``'GET /*/*/_search'``: path components before the first one that
+    starts with ``_`` (index, type and document id) are replaced by ``*``.
+
+    """
+    parts = [part for part in url.split('/') if part]
+    for offset, part in enumerate(parts):
+        if part.startswith('_'):
+            break
+        parts[offset] = '*'
+    return '%s /%s' % (method, '/'.join(parts))
+
+
+class LatencyHistogram(object):
+    """Request durations counted in buckets on a doubling scale.
+
+    Bucket ``i`` holds durations of up to ``BASE * 2 ** i`` seconds (1ms,
+    2ms, 4ms, ...); the last bucket holds everything slower.
+
+    """
+    BASE = 0.001
+    BUCKETS = 18
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        """Record one request that took ``duration`` seconds."""
+        bucket = 0
+        if duration > self.BASE:
+            bucket = min(int(math.ceil(math.log(duration / self.BASE, 2))),
+                         self.BUCKETS)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def merge(self, other):
+        """Add the counts of another histogram to this one."""
+        for bucket, count in enumerate(other.counts):
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def upper_bound(self, bucket):
+        if bucket == self.BUCKETS:
+            return float('inf')
+        return self.BASE * 2 ** bucket
+
+    def percentile(self, pct):
+        """Estimate the ``pct`` percentile as the upper bound of the bucket
+        it falls in, capped at the slowest duration seen.
+
+        :rtype: float or None if nothing was recorded
+
+        """
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.upper_bound(bucket), self.max)
+        return self.max
+
+    def as_dict(self):
+        """Summary suitable for logging or a metrics endpoint."""
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'max': self.max,
+                'p50': self.percentile(50),
+                'p90': self.percentile(90),
+                'p99': self.percentile(99),
+                'buckets': [(self.upper_bound(bucket), count)
+                            for bucket, count in enumerate(self.counts)
+                            if count]}
+
+
 class AsyncHttpConnection(Connection):
     """Add Tornado Asynchronous support to ElasticSearch.
 
@@ -73,8 +162,8 @@ class AsyncHttpConnection(Connection):
         httpclient.AsyncHTTPClient.configure(None, max_clients=max_clients)
         self._client = httpclient.AsyncHTTPClient()
         self._headers = {'Content-Type': 'application/json; charset=UTF-8'}
-        self._start_time = None
         self.request_timeout = request_timeout
+        self.latency = {}
 
     @concurrent.return_future
     def perform_request(self, method, url, params=None, body=None,
@@ -82,10 +171,11 @@ class AsyncHttpConnection(Connection):
         request_uri = self._request_uri(url, params)
         LOGGER.debug('%s, %r, %r', url, body, params)
         kwargs = self._request_kwargs(method, body, timeout)
-        self._start_time = time.time()
+        start_time = time.time()
 
         def on_response(response):
-            duration = time.time() - self._start_time
+            duration = time.time() - start_time
+            self._record_latency(method, url, duration)
             raw_data = response.body.decode('utf-8') \
                 if response.body is not None else None
             LOGGER.info('Response from %s: %s', url, response.code)
@@ -106,6 +196,13 @@ class AsyncHttpConnection(Connection):
         self._client.fetch(httpclient.HTTPRequest(request_uri, **kwargs),
                            callback=on_response)
 
+    def _record_latency(self, method, url, duration):
+        key = _endpoint(method, url)
+        histogram = self.latency.get(key)
+        if histogram is None:
+            histogram = self.latency[key] = LatencyHistogram()
+        histogram.add(duration)
+
     def _assign_auth_values(self, http_auth):
         """Take the http_auth value and split it into the attributes that
         carry the http auth username and password
@@ -234,6 +331,398 @@ class AsyncTransport(Transport):
                 raise gen.Return((status, response))
 
 
+class AsyncBulkIndexer(object):
+    """Buffer bulk actions and send them through
+    :meth:`AsyncElasticsearch.bulk` in batches.
+
+    A batch is sent once it holds ``max_docs`` actions, once its body
+    reaches ``max_bytes`` characters, or ``flush_interval`` seconds after
+    its first action was queued, whichever comes first.  No more than
+    ``max_in_flight`` bulk requests are outstanding at a time: when a full
+    batch finds them all busy, the call that filled it waits for one to
+    finish, so a fast producer is slowed down instead of buffering without
+    bound::
+
+        indexer = es.bulk_indexer(index='tweets', doc_type='tweet')
+        for doc in docs:
+            yield indexer.index(doc)
+        succeeded, failed = yield indexer.close()
+
+    :param client: The :class:`AsyncElasticsearch` to send requests with
+    :param str index: Default index for actions that don't name one
+    :param str doc_type: Default type for actions that don't name one
+    :param int max_docs: Send a batch once it holds this many actions
+    :param int max_bytes: Send a batch once its body is this large
+    :param float flush_interval: Send a partial batch after this many
+      seconds; ``None`` or ``0`` disables the timer
+    :param int max_in_flight: Bulk requests allowed to run concurrently
+    :param dict params: Query parameters passed to every bulk request
+
+    """
+    def __init__(self, client, index=None, doc_type=None, max_docs=500,
+                 max_bytes=5 * 1024 * 1024, flush_interval=1.0,
+                 max_in_flight=2, params=None):
+        self.client = client
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.params = params or {}
+        self.succeeded = 0
+        self.failed = []
+        self.errors = []
+        self._index = index
+        self._doc_type = doc_type
+        self._lines = []
+        self._docs = 0
+        self._bytes = 0
+        self._timeout = None
+        self._slots = locks.Semaphore(max_in_flight)
+        self._pending = set()
+
+    def index(self, body, id=None, index=None, doc_type=None, **meta):
+        """Queue an ``index`` action for ``body``."""
+        return self.add('index', body, id, index, doc_type, **meta)
+
+    def create(self, body, id=None, index=None, doc_type=None, **meta):
+        """Queue a ``create`` action for ``body``."""
+        return self.add('create', body, id, index, doc_type, **meta)
+
+    def delete(self, id, index=None, doc_type=None, **meta):
+        """Queue a ``delete`` action for the document ``id``."""
+        return self.add('delete', None, id, index, doc_type, **meta)
+
+    @gen.coroutine
+    def add(self, op_type, body=None, id=None, index=None, doc_type=None,
+            **meta):
+        """Queue one bulk action.
+
+        :param str op_type: ``index``, ``create``, ``update`` or ``delete``
+        :param body: The document (or update script); omitted for deletes
+        :param meta: Other action metadata, e.g. ``_routing`` or ``_version``
+
+        """
+        action = dict(meta)
+        if id is not None:
+            action['_id'] = id
+        if index is not None:
+            action['_index'] = index
+        if doc_type is not None:
+            action['_type'] = doc_type
+        dumps = self.client.transport.serializer.dumps
+        self._append(dumps({op_type: action}))
+        if body is not None:
+            self._append(dumps(body))
+        self._docs += 1
+        if self._docs >= self.max_docs or self._bytes >= self.max_bytes:
+            yield self.flush()
+        elif self._timeout is None and self.flush_interval:
+            self._timeout = ioloop.IOLoop.current().call_later(
+                self.flush_interval, self._flush_on_timer)
+
+    def _append(self, line):
+        self._lines.append(line)
+        self._bytes += len(line) + 1
+
+    def _flush_on_timer(self):
+        self._timeout = None
+        ioloop.IOLoop.current().add_future(self.flush(),
+                                           lambda future: future.result())
+
+    @gen.coroutine
+    def flush(self):
+        """Send the buffered actions now.
+
+        Resolves once the request has been started, which may mean waiting
+        for a free slot; use :meth:`close` to wait for the responses.
+
+        """
+        if self._timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        if not self._lines:
+            return
+        lines, docs = self._lines, self._docs
+        self._lines, self._docs, self._bytes = [], 0, 0
+        yield self._slots.acquire()
+        future = self._send(lines, docs)
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+
+    @gen.coroutine
+    def _send(self, lines, docs):
+        lines.append('')
+        try:
+            result = yield self.client.bulk('\n'.join(lines),
+                                            index=self._index,
+                                            doc_type=self._doc_type,
+                                            params=dict(self.params))
+        except TransportError as error:
+            LOGGER.error('Bulk request of %i actions failed: %s', docs, error)
+            self.errors.append(error)
+        else:
+            for item in result.get('items', ()):
+                for info in item.values():
+                    if 200 <= info.get('status', 500) < 300:
+                        self.succeeded += 1
+                    else:
+                        self.failed.append(item)
+        finally:
+            self._slots.release()
+
+    @gen.coroutine
+    def close(self):
+        """Send what is left and wait for every outstanding request.
+
+        Returns a 2-tuple of the number of successful actions and the list
+        of response items for the actions that failed.  Requests that
+        failed outright are logged and kept in :attr:`errors`.
+
+        """
+        yield self.flush()
+        if self._pending:
+            yield list(self._pending)
+        raise gen.Return((self.succeeded, self.failed))
+
+
+class ScrollIterator(object):
+    """Stream the hits of a search one at a time.
+
+    Pages are fetched with the scroll API, or with ``search_after`` if
+    ``search_after`` is true (the body must then have a ``sort`` that ends
+    in a unique field).  As soon as a page arrives the request for the
+    next one is sent, so the network round trip overlaps with consuming
+    the current page.  At most two pages are held at once.  The scroll
+    context is cleared once the last page has been received, or by
+    :meth:`close` if iteration stops early::
+
+        hits = es.scan(index='tweets', body={'query': {'match_all': {}}})
+        while (yield hits.fetch_next):
+            hit = hits.next_object()
+
+    On Python 3.5+ the iterator also supports ``async for``.
+
+    :param client: The :class:`AsyncElasticsearch` to send requests with
+    :param str index: The index (or comma-separated indices) to search
+    :param str doc_type: The document type(s) to search
+    :param dict body: The search definition using the Query DSL
+    :param str scroll: How long each scroll context is kept alive
+    :param int size: Hits per page (per shard with ``search_type=scan``)
+    :param bool search_after: Page with ``search_after`` instead of scroll
+    :param dict params: Other query parameters for the search request
+
+    """
+    def __init__(self, client, index=None, doc_type=None, body=None,
+                 scroll='5m', size=1000, search_after=False, params=None):
+        self.client = client
+        self.index = index
+        self.doc_type = doc_type
+        self.body = dict(body or {})
+        self.scroll = scroll
+        self.size = size
+        self.search_after = search_after
+        self.params = params or {}
+        self.total = None
+        if search_after and 'sort' not in self.body:
+            raise ValueError('search_after requires a sort in the body')
+        self._hits = collections.deque()
+        self._next_page = None
+        self._scroll_id = None
+        self._received = 0
+        self._first_page_seen = False
+        self._started = False
+        self._clearing = None
+
+    def _search(self, body, params):
+        params.update(self.params)
+        params['size'] = self.size
+        return self.client.search(index=self.index, doc_type=self.doc_type,
+                                  body=body, params=params)
+
+    def _request(self, last_hit=None):
+        if self.search_after:
+            body = self.body
+            if last_hit is not None:
+                body = dict(body, search_after=last_hit['sort'])
+            return self._search(body, {})
+        if self._scroll_id is None:
+            return self._search(self.body, {'scroll': self.scroll})
+        return self.client.scroll(self._scroll_id, self.scroll)
+
+    @property
+    def fetch_next(self):
+        """A Future that resolves to ``True`` if another hit is available
+        from :meth:`next_object`, or ``False`` when the search is exhausted.
+
+        """
+        return self._fetch()
+
+    @gen.coroutine
+    def _fetch(self):
+        while not self._hits:
+            if self._next_page is None:
+                if self._started:
+                    if self._clearing is not None:
+                        yield self._clearing
+                    raise gen.Return(False)
+                self._started = True
+                self._next_page = self._request()
+            response = yield self._next_page
+            self._next_page = None
+            first = not self._first_page_seen
+            self._first_page_seen = True
+            hits = response['hits']['hits']
+            self._scroll_id = response.get('_scroll_id', self._scroll_id)
+            if self.total is None:
+                total = response['hits'].get('total')
+                if isinstance(total, dict):
+                    total = total['value'] if total['relation'] == 'eq' else None
+                self.total = total
+            self._received += len(hits)
+            # The first page of a scan search carries no hits
+            if ((hits or first) and
+                    (self.total is None or self._received < self.total)):
+                self._next_page = self._request(hits[-1] if hits else None)
+            else:
+                self._clear()
+            self._hits.extend(hits)
+        raise gen.Return(True)
+
+    def next_object(self):
+        """Return the next hit; call only after :attr:`fetch_next` has
+        resolved to ``True``.
+
+        """
+        return self._hits.popleft()
+
+    def __aiter__(self):
+        return self
+
+    @gen.coroutine
+    def __anext__(self):
+        if (yield self.fetch_next):
+            raise gen.Return(self.next_object())
+        raise StopAsyncIteration()
+
+    def _clear(self):
+        if self._clearing is None:
+            self._clearing = self._clear_scroll(self._scroll_id)
+        return self._clearing
+
+    @gen.coroutine
+    def _clear_scroll(self, scroll_id):
+        if self.search_after or scroll_id is None:
+            return
+        try:
+            yield self.client.clear_scroll(scroll_id, ignore=404)
+        except TransportError as error:
+            LOGGER.warning('Could not clear scroll %s: %s', scroll_id, error)
+
+    @gen.coroutine
+    def close(self):
+        """Stop iterating and release the scroll context."""
+        self._started = True
+        self._hits.clear()
+        if self._next_page is not None:
+            try:
+                response = yield self._next_page
+                self._scroll_id = response.get('_scroll_id', self._scroll_id)
+            except TransportError:
+                pass
+            self._next_page = None
+        yield self._clear()
+
+
+def benchmark_scan(total=20000, size=500, latency=0.02, work=0.02):
+    """Compare :class:`ScrollIterator` with a plain search/scroll loop.
+
+    Starts a stub Elasticsearch on a local port that answers each request
+    after ``latency`` seconds, then reads ``total`` hits both ways while
+    spending ``work`` seconds (asynchronously) on every page.  Prints and
+    returns the two timings in seconds::
+
+        python -c 'import tornado_elasticsearch as t; t.benchmark_scan()'
+
+    """
+    import json
+    from tornado import netutil
+    from tornado import httpserver
+    from tornado import web
+
+    scrolls = {}
+
+    def page(offset):
+        hits = [{'_id': str(n), '_source': {'n': n, 'text': 'x' * 100}}
+                for n in range(offset, min(offset + size, total))]
+        return {'hits': {'total': total, 'hits': hits}}
+
+    class Search(web.RequestHandler):
+        @gen.coroutine
+        def get(self, *args):
+            yield gen.sleep(latency)
+            body = page(0)
+            if self.get_argument('scroll', None):
+                scroll_id = str(len(scrolls))
+                scrolls[scroll_id] = len(body['hits']['hits'])
+                body['_scroll_id'] = scroll_id
+            self.write(body)
+        post = get
+
+    class Scroll(web.RequestHandler):
+        @gen.coroutine
+        def post(self):
+            yield gen.sleep(latency)
+            scroll_id = json.loads(self.request.body.decode('utf-8'))['scroll_id']
+            body = page(scrolls[scroll_id])
+            scrolls[scroll_id] += len(body['hits']['hits'])
+            body['_scroll_id'] = scroll_id
+            self.write(body)
+
+        def delete(self):
+            for scroll_id in json.loads(self.request.body.decode('utf-8'))['scroll_id']:
+                scrolls.pop(scroll_id, None)
+            self.write({})
+
+    app = web.Application([(r'/_search/scroll', Scroll),
+                           (r'/(?:[^/]+/)*_search', Search)])
+    sockets = netutil.bind_sockets(0, '127.0.0.1')
+    server = httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    es = AsyncElasticsearch(['127.0.0.1:%d' % sockets[0].getsockname()[1]])
+
+    @gen.coroutine
+    def loop():
+        seen = 0
+        response = yield es.search(index='bench', scroll='1m', size=size)
+        while response['hits']['hits']:
+            seen += len(response['hits']['hits'])
+            yield gen.sleep(work)
+            response = yield es.scroll(response['_scroll_id'], '1m')
+        raise gen.Return(seen)
+
+    @gen.coroutine
+    def scan():
+        seen = 0
+        hits = es.scan(index='bench', size=size)
+        while (yield hits.fetch_next):
+            hits.next_object()
+            seen += 1
+            if seen % size == 0:
+                yield gen.sleep(work)
+        raise gen.Return(seen)
+
+    timings = {}
+    try:
+        for name, run in (('search/scroll loop', loop),
+                          ('ScrollIterator', scan)):
+            start = time.time()
+            seen = ioloop.IOLoop.current().run_sync(run)
+            timings[name] = time.time() - start
+            print('%-20s %6d hits %8.3fs' % (name, seen, timings[name]))
+    finally:
+        server.stop()
+    return timings
+
+
 class AsyncElasticsearch(Elasticsearch):
     """Extends the official elasticsearch.Elasticsearch object to make the
     client invoked methods coroutines.
@@ -716,6 +1205,13 @@ class AsyncElasticsearch(Elasticsearch):
                                                        params=params)
         raise gen.Return(data)
 
+    def scan(self, index=None, doc_type=None, body=None, **kwargs):
+        """Return a :class:`ScrollIterator` over every hit of a search,
+        prefetching one page ahead.  Keyword arguments are passed on to it.
+
+        """
+        return ScrollIterator(self, index, doc_type, body, **kwargs)
+
     @gen.coroutine
     @query_params('consistency', 'parent', 'refresh', 'replication', 'routing',
                   'timeout', 'version', 'version_type')
@@ -795,6 +1291,27 @@ class AsyncElasticsearch(Elasticsearch):
                                                        body=self._bulk_body(body))
         raise gen.Return(data)
 
+    def bulk_indexer(self, index=None, doc_type=None, **kwargs):
+        """Return an :class:`AsyncBulkIndexer` that batches actions into
+        :meth:`bulk` requests.  Keyword arguments are passed on to it.
+
+        """
+        return AsyncBulkIndexer(self, index, doc_type, **kwargs)
+
+    def latency_histograms(self):
+        """Per-endpoint request latencies across all connections.
+
+        :rtype: dict mapping keys such as ``'GET /*/_search'`` to
+          :class:`LatencyHistogram`
+
+        """
+        pool = self.transport.connection_pool
+        merged = {}
+        for connection in getattr(pool, 'orig_connections', pool.connections):
+            for key, histogram in getattr(connection, 'latency', {}).items():
+                merged.setdefault(key, LatencyHistogram()).merge(histogram)
+        return merged
+
     @gen.coroutine
     @query_params('search_type')
     def msearch(self, body, index=None, doc_type=None, params=None):
@@ -10,10 +10,13 @@ shorter-named convenience form that returns a list. Some of the
 following are based on examples in itertools docs.
 """
 
+import sys
 import math
+import time
 import random
 import itertools
-from collections import Mapping, Sequence, Set, ItemsView
+from collections import (Mapping, Sequence, Set, ItemsView, OrderedDict,
+                         deque)
 
 try:
     from typeutils import make_sentinel
@@ -206,22 +209,54 @@ def chunked_iter(src, size, **kw):
         raise ValueError('got unexpected keyword arguments: %r' % kw.keys())
     if not src:
         return
-    postprocess = lambda chk: chk
     if isinstance(src, basestring):
-        postprocess = lambda chk, _sep=type(src)(): _sep.join(chk)
-    cur_chunk = []
-    i = 0
-    for item in src:
-        cur_chunk.append(item)
-        i += 1
-        if i % size == 0:
-            yield postprocess(cur_chunk)
-            cur_chunk = []
+        # slices are the same as joining each chunk's characters
+        for start in xrange(0, len(src), size):
+            cur_chunk = src[start:start + size]
+            lc = len(cur_chunk)
+            if do_fill and lc < size:
+                cur_chunk += type(src)().join([fill_val] * (size - lc))
+            yield cur_chunk
+        return
+    src_iter = iter(src)
+    while True:
+        cur_chunk = list(itertools.islice(src_iter, size))
+        lc = len(cur_chunk)
+        if lc < size:
+            break
+        yield cur_chunk
     if cur_chunk:
         if do_fill:
-            lc = len(cur_chunk)
             cur_chunk[lc:] = [fill_val] * (size - lc)
-        yield postprocess(cur_chunk)
+        yield cur_chunk
+    return
+
+
+def chunked_view_iter(src, size):
+    """Like :func:`chunked_iter`, but for :class:`bytes`,
+    :class:`bytearray`, :class:`array.array` and other buffer objects,
+    generates zero-copy :class:`memoryview` slices of *src* instead of
+    new lists or strings. Other sequences are sliced.
+
+    >>> views = list(chunked_view_iter(b'abcdefg', 3))
+    >>> [view.tobytes() for view in views] == [b'abc', b'def', b'g']
+    True
+
+    The views share memory with *src*, so changes to a mutable *src*
+    show through them, and *src* cannot be resized while they are alive.
+    """
+    size = int(size)
+    if size <= 0:
+        raise ValueError('expected a positive integer chunk size')
+    try:
+        view = memoryview(src)
+    except TypeError:
+        if not hasattr(src, '__getitem__'):
+            raise TypeError('expected a buffer or a sequence, not %r'
+                            % type(src))
+        view = src  # e.g., Python 2's array.array
+    for start in xrange(0, len(view), size):
+        yield view[start:start + size]
     return
 
 def pairwise(src):
@@ -284,6 +319,34 @@ def windowed_iter(src, size):
         return izip([])
     return izip(*tees)
 
+def windowed_view_iter(src, size):
+    """Like :func:`windowed_iter`, but instead of a new tuple for every
+    step, generates the same :class:`~collections.deque` of the last
+    *size* items, updated in place. Each step is O(1) regardless of
+    *size*, so use this for wide windows which are consumed (summed,
+    compared, etc.) before the next step.
+
+    >>> [sum(window) for window in windowed_view_iter(range(7), 3)]
+    [3, 6, 9, 12, 15]
+
+    Copy the window (e.g., with :func:`tuple`) to keep it past the
+    current step.
+    """
+    size = int(size)
+    if size <= 0:
+        raise ValueError('expected a positive integer window size')
+    src_iter = iter(src)
+    window = deque(itertools.islice(src_iter, size), maxlen=size)
+    if len(window) < size:
+        return
+    yield window
+    append = window.append
+    for item in src_iter:
+        append(item)
+        yield window
+    return
+
+
 def xfrange(stop, start=None, step=1.0):
     """Same as :func:`frange`, but generator-based instead of returning a
     list.
@@ -513,7 +576,7 @@ def unique(src, key=None):
     """
     return list(unique_iter(src, key))
 
-def unique_iter(src, key=None):
+def unique_iter(src, key=None, maxsize=None, bloom=False):
     """Yield unique elements from the iterable, *src*, based on *key*,
     in the order in which they first appeared in *src*.
 
@@ -529,6 +592,19 @@ def unique_iter(src, key=None):
     >>> pleasantries = ['hi', 'hello', 'ok', 'bye', 'yes']
     >>> list(unique_iter(pleasantries, key=lambda x: len(x)))
     ['hi', 'hello', 'bye']
+
+    Every key seen is remembered, so memory grows with the number of
+    unique keys. For unbounded streams, pass *maxsize* to remember only
+    the *maxsize* most recently seen keys; an element whose key has
+    been forgotten is yielded again.
+
+    >>> list(unique_iter([1, 2, 1, 3, 1, 2], maxsize=2))
+    [1, 2, 3, 2]
+
+    With *bloom* set, keys are remembered in a pair of rotating Bloom
+    filters sized for *maxsize* keys each (about 1.2 bytes per key per
+    filter), instead of an LRU of the keys themselves. Up to 2% of never-seen
+    elements are then wrongly skipped as duplicates.
     """
     if not is_iterable(src):
         raise TypeError('expected an iterable, not %r' % type(src))
@@ -540,6 +616,17 @@ def unique_iter(src, key=None):
         key_func = lambda x: getattr(x, key, x)
     else:
         raise TypeError('"key" expected a string or callable, not %r' % key)
+    if maxsize is not None:
+        maxsize = int(maxsize)
+        if maxsize <= 0:
+            raise ValueError('expected a positive maxsize, not %r' % maxsize)
+        seen = _BloomSeen(maxsize) if bloom else _LRUSeen(maxsize)
+        for i in src:
+            if seen.add(key_func(i)):
+                yield i
+        return
+    elif bloom:
+        raise ValueError('bloom requires a maxsize')
     seen = set()
     for i in src:
         k = key_func(i)
@@ -548,6 +635,73 @@ def unique_iter(src, key=None):
             yield i
     return
 
+class _LRUSeen(object):
+    """The *maxsize* most recently seen keys, for :func:`unique_iter`."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+
+    def add(self, key):
+        "Mark *key* as seen, returning ``True`` if it was not seen before."
+        keys = self._keys
+        if key in keys:
+            del keys[key]
+            keys[key] = None
+            return False
+        keys[key] = None
+        if len(keys) > self.maxsize:
+            keys.popitem(last=False)
+        return True
+
+
+class _BloomSeen(object):
+    """Approximate set of recently seen keys, for :func:`unique_iter`.
+
+    Keys go into a Bloom filter sized for *maxsize* keys at a 1% false
+    positive rate. Once it holds *maxsize* keys, it is kept for lookups
+    only and a new one is started, so between *maxsize* and twice
+    *maxsize* of the most recent keys are remembered.
+    """
+    error_rate = 0.01
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        ln2 = math.log(2)
+        self.nbits = int(math.ceil(-maxsize * math.log(self.error_rate)
+                                   / (ln2 * ln2)))
+        self.nhashes = max(1, int(round(self.nbits * ln2 / maxsize)))
+        self._cur = bytearray((self.nbits + 7) // 8)
+        self._prev = None
+        self._count = 0
+        self._hash_range = range(self.nhashes)
+
+    @staticmethod
+    def _contains(bits, positions):
+        for p in positions:
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        "Mark *key* as seen, returning ``True`` if it was (likely) not seen."
+        h1 = hash(key)
+        h2 = hash((h1, 'bloom')) | 1
+        nbits = self.nbits
+        positions = [(h1 + i * h2) % nbits for i in self._hash_range]
+        cur, prev = self._cur, self._prev
+        if self._contains(cur, positions):
+            return False
+        seen = prev is not None and self._contains(prev, positions)
+        if self._count >= self.maxsize:
+            self._prev, cur = cur, bytearray(len(cur))
+            self._cur = cur
+            self._count = 0
+        for p in positions:
+            cur[p >> 3] |= 1 << (p & 7)
+        self._count += 1
+        return not seen
+
+
 def one(src, default=None, key=None):
     """Along the same lines as builtins, :func:`all` and :func:`any`, and
     similar to :func:`first`, ``one()`` returns the single object in
@@ -780,6 +934,14 @@ def remap(root, visit=default_visit, enter=default_enter, exit=default_exit,
             callable. When set to ``False``, remap ignores any errors
             raised by the *visit* callback. Items causing exceptions
             are kept. See examples for more details.
+        copy_on_write (bool): When set to ``True``, a traversed value
+            whose remapped items are all the very same keys and values
+            that *enter* produced is reused as is, and *exit* is not
+            called for it. Only the values with a change somewhere
+            below them are rebuilt, so remapping a large structure
+            with few changes takes little extra memory. This assumes
+            *enter* produces all of a value's items and *exit* would
+            build an equal value from them, as the defaults do.
 
     remap is designed to cover the majority of cases with just the
     *visit* callable. While passing in multiple callables is very
@@ -808,6 +970,7 @@ def remap(root, visit=default_visit, enter=default_enter, exit=default_exit,
     if not callable(exit):
         raise TypeError('exit expected callable, not: %r' % exit)
     reraise_visit = kwargs.pop('reraise_visit', True)
+    copy_on_write = kwargs.pop('copy_on_write', False)
     if kwargs:
         raise TypeError('unexpected keyword arguments: %r' % kwargs.keys())
 
@@ -817,10 +980,13 @@ def remap(root, visit=default_visit, enter=default_enter, exit=default_exit,
         key, value = stack.pop()
         id_value = id(value)
         if key is _REMAP_EXIT:
-            key, new_parent, old_parent = value
+            key, new_parent, old_parent, old_items = value
             id_value = id(old_parent)
             path, new_items = new_items_stack.pop()
-            value = exit(path, key, old_parent, new_parent, new_items)
+            if old_items is not None and _same_items(old_items, new_items):
+                value = old_parent
+            else:
+                value = exit(path, key, old_parent, new_parent, new_items)
             registry[id_value] = value
             if not new_items_stack:
                 continue
@@ -840,9 +1006,10 @@ def remap(root, visit=default_visit, enter=default_enter, exit=default_exit,
                 new_items_stack.append((path, []))
                 if value is not root:
                     path += (key,)
-                stack.append((_REMAP_EXIT, (key, new_parent, value)))
-                if new_items:
-                    stack.extend(reversed(list(new_items)))
+                old_items = list(new_items) if new_items else []
+                stack.append((_REMAP_EXIT, (key, new_parent, value,
+                                            old_items if copy_on_write else None)))
+                stack.extend(reversed(old_items))
                 continue
         if visit is _orig_default_visit:
             # avoid function call overhead by inlining identity operation
@@ -867,6 +1034,16 @@ def remap(root, visit=default_visit, enter=default_enter, exit=default_exit,
             raise TypeError('expected remappable root, not: %r' % root)
     return value
 
+def _same_items(old_items, new_items):
+    if len(old_items) != len(new_items):
+        return False
+    for (old_key, old_value), (new_key, new_value) in izip(old_items,
+                                                           new_items):
+        if old_key is not new_key or old_value is not new_value:
+            return False
+    return True
+
+
 class PathAccessError(KeyError, IndexError, TypeError):
     # TODO: could maybe get fancy with an isinstance
     # TODO: should accept an idx argument
@@ -914,10 +1091,134 @@ def get_path(root, path, default=_UNSET):
                 raise PathAccessError(exc, seg, path)
     return cur
 
+
+def compile_path(path):
+    """Parse *path*, as accepted by :func:`get_path`, once and return a
+    function which looks it up in any number of roots:
+
+    >>> get_name = compile_path('users.0.name')
+    >>> get_name({'users': [{'name': 'alice'}]})
+    'alice'
+    >>> get_name({'users': []}, default=None) is None
+    True
+
+    The function takes the root and an optional *default*, returned
+    instead of raising :exc:`PathAccessError` when the path is missing.
+    Lookups otherwise behave as :func:`get_path`, without splitting the
+    path or converting segments to integers on every call.
+    """
+    if isinstance(path, basestring):
+        path = path.split('.')
+    segs = []
+    for seg in path:
+        try:
+            int_seg = int(seg)
+        except (ValueError, TypeError):
+            int_seg = None
+        segs.append((seg, int_seg))
+    segs = tuple(segs)
+
+    def get_compiled_path(root, default=_UNSET):
+        cur = root
+        for seg, int_seg in segs:
+            try:
+                cur = cur[seg]
+                continue
+            except (KeyError, IndexError) as exc:
+                error = PathAccessError(exc, seg, path)
+            except TypeError as exc:
+                # either string index in a list, or a parent that
+                # doesn't support indexing
+                if int_seg is None:
+                    error = PathAccessError(exc, seg, path)
+                else:
+                    try:
+                        cur = cur[int_seg]
+                        continue
+                    except (KeyError, IndexError, TypeError):
+                        error = PathAccessError(exc, int_seg, path)
+            if default is _UNSET:
+                raise error
+            return default
+        return cur
+
+    return get_compiled_path
+
 # TODO: get_path/set_path
 # TODO: recollect()
 # TODO: reiter()
 
+def _time(func, repeat):
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def _consume(src):
+    for _ in src:
+        pass
+
+
+def benchmark(size=1000000, repeat=3, out=None):
+    """Time the list-building iterators above against their view-based
+    and bounded-memory counterparts on *size* items, writing the best of
+    *repeat* runs for each to *out* (``sys.stdout`` by default).
+
+    Run with ``python iterutils.py``.
+    """
+    out = out or sys.stdout
+    data = list(range(size))
+    data_bytes = bytes(bytearray(i % 256 for i in xrange(size)))
+    keys = [random.randrange(size // 4) for _ in xrange(size)]
+    cases = [
+        ('chunked_iter(list, 64)',
+         lambda: _consume(chunked_iter(data, 64))),
+        ('chunked_iter(bytes, 64)',
+         lambda: _consume(chunked_iter(data_bytes, 64))),
+        ('chunked_view_iter(bytes, 64)',
+         lambda: _consume(chunked_view_iter(data_bytes, 64))),
+        ('pairwise_iter(list)',
+         lambda: _consume(pairwise_iter(data))),
+        ('windowed_iter(list, 100)',
+         lambda: _consume(windowed_iter(data, 100))),
+        ('windowed_view_iter(list, 100)',
+         lambda: _consume(windowed_view_iter(data, 100))),
+        ('split_iter(list)',
+         lambda: _consume(split_iter(data, lambda x: x % 100 == 0))),
+        ('unique_iter(keys)',
+         lambda: _consume(unique_iter(keys))),
+        ('unique_iter(keys, maxsize=%d)' % (size // 10),
+         lambda: _consume(unique_iter(keys, maxsize=size // 10))),
+        ('unique_iter(keys, maxsize=%d, bloom=True)' % (size // 10),
+         lambda: _consume(unique_iter(keys, maxsize=size // 10, bloom=True))),
+    ]
+    doc = [{'id': i, 'tags': ['a', 'b'], 'meta': {'n': i, 'ok': None}}
+           for i in xrange(size // 20)]
+    drop_none = lambda p, k, v: v is not None or k != 'ok' or p[-1:] != (0,)
+    get_n = compile_path('meta.n')
+    cases += [
+        ('remap(doc)',
+         lambda: remap(doc, drop_none)),
+        ('remap(doc, copy_on_write=True)',
+         lambda: remap(doc, drop_none, copy_on_write=True)),
+        ('get_path(item, "meta.n")',
+         lambda: [get_path(item, 'meta.n') for item in doc]),
+        ('compile_path("meta.n")(item)',
+         lambda: [get_n(item) for item in doc]),
+    ]
+    for name, func in cases:
+        out.write('%-45s %8.3fs\n' % (name, _time(func, repeat)))
+
+
+if __name__ == '__main__':
+    benchmark()
+
+
 """
 May actually be faster to do an isinstance check for a str path
 
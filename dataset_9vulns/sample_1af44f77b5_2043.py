@@ -92,12 +92,22 @@ import sys
 import zlib
 import struct
 import math
+import binascii
+import random
+import time
 from array import array
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import os
 import pickle
 
 from pyglet.compat import asbytes
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _adam7 = ((0, 0, 8, 8),
           (4, 0, 8, 8),
           (0, 4, 4, 8),
@@ -148,7 +158,8 @@ class Writer:
                  bytes_per_sample=1,
                  compression=None,
                  interlaced=False,
-                 chunk_limit=2**20):
+                 chunk_limit=2**20,
+                 threads=None):
         """
         Create a PNG encoder object.
 
@@ -162,6 +173,7 @@ class Writer:
         bytes_per_sample - 8-bit or 16-bit input data
         compression - zlib compression level (1-9)
         chunk_limit - write multiple IDAT chunks to save memory
+        threads - deflate bands of chunk_limit bytes in this many threads
 
         If specified, the transparent and background parameters must
         be a tuple with three integer values for red, green, blue, or
@@ -217,6 +229,7 @@ class Writer:
         self.compression = compression
         self.chunk_limit = chunk_limit
         self.interlaced = interlaced
+        self.threads = threads
 
         if self.greyscale:
             self.color_depth = 1
@@ -291,6 +304,18 @@ class Writer:
                              struct.pack("!L", int(self.gamma * 100000)))
 
         # http://www.w3.org/TR/PNG/#11IDAT
+        if self.threads:
+            self.write_idat_bands(outfile, scanlines)
+        else:
+            self.write_idat(outfile, scanlines)
+
+        # http://www.w3.org/TR/PNG/#11IEND
+        self.write_chunk(outfile, 'IEND', '')
+
+    def write_idat(self, outfile, scanlines):
+        """
+        Compress scanlines through a single zlib stream into IDAT chunks.
+        """
         if self.compression is not None:
             compressor = zlib.compressobj(self.compression)
         else:
@@ -315,8 +340,56 @@ class Writer:
             # print >> sys.stderr, len(data), len(compressed), len(flushed)
             self.write_chunk(outfile, 'IDAT', compressed + flushed)
 
-        # http://www.w3.org/TR/PNG/#11IEND
-        self.write_chunk(outfile, 'IEND', '')
+    def write_idat_bands(self, outfile, scanlines):
+        """
+        Compress scanlines into IDAT chunks using a pool of threads.
+
+        The image is cut into bands of about chunk_limit bytes.  Each band
+        is deflated on its own and ended with a full flush, which leaves
+        it byte aligned, so the bands can simply be concatenated into one
+        zlib stream.  zlib releases the GIL while compressing, so bands
+        are deflated in parallel; each is written out as an IDAT chunk as
+        soon as it and all the bands before it are done.  At most two
+        bands per thread are held in memory.
+        """
+        if self.compression is not None:
+            level = self.compression
+        else:
+            level = zlib.Z_DEFAULT_COMPRESSION
+        pool = ThreadPool(self.threads)
+        pending = deque()
+        checksum = 1
+        first = True
+        try:
+            for band in self._bands(scanlines):
+                checksum = zlib.adler32(band, checksum)
+                pending.append(
+                    pool.apply_async(_deflate_band, (band, level, first)))
+                first = False
+                if len(pending) >= 2 * self.threads:
+                    self.write_chunk(outfile, 'IDAT', pending.popleft().get())
+            while pending:
+                self.write_chunk(outfile, 'IDAT', pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+        # An empty final block ends the deflate stream.
+        final = zlib.compressobj(level, zlib.DEFLATED, -15).flush()
+        if first:
+            final = _zlib_header(level) + final
+        self.write_chunk(outfile, 'IDAT',
+                         final + struct.pack("!I", checksum & 0xffffffff))
+
+    def _bands(self, scanlines):
+        data = array('B')
+        for scanline in scanlines:
+            data.append(0)
+            data.extend(scanline)
+            if len(data) >= self.chunk_limit:
+                yield data.tostring()
+                data = array('B')
+        if len(data):
+            yield data.tostring()
 
     def write_array(self, outfile, pixels):
         """
@@ -432,6 +505,35 @@ class Writer:
                             pixels[offset+i:end_offset:skip]
                     yield row
 
+def _zlib_header(level):
+    """
+    Return the two byte zlib stream header for a compression level.
+    """
+    # http://www.ietf.org/rfc/rfc1950.txt
+    cmf = 0x78
+    if level < 0 or level == 6:
+        flevel = 2
+    elif level < 2:
+        flevel = 0
+    elif level < 6:
+        flevel = 1
+    else:
+        flevel = 3
+    flg = flevel << 6
+    flg += (31 - (cmf * 256 + flg) % 31) % 31
+    return struct.pack("!2B", cmf, flg)
+
+def _deflate_band(data, level, first):
+    """
+    Deflate one band of scanlines as a raw, byte aligned deflate run,
+    preceded by the zlib header if it is the first band.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    data = compressor.compress(data) + compressor.flush(zlib.Z_FULL_FLUSH)
+    if first:
+        data = _zlib_header(level) + data
+    return data
+
 class _readable:
     """
     A simple file-like interface for strings and arrays.
@@ -448,6 +550,119 @@ class _readable:
         self.offset += n
         return r
 
+# Row-at-a-time filter reconstruction.  Each function takes one filtered
+# scanline, the reconstructed previous line of the same pass (or None on
+# the first line) and the pixel size in bytes, and returns the
+# reconstructed line as a bytearray.
+#
+# Sub and up are the common filters and both are plain byte-wise sums, so
+# they are done with NumPy where it is installed and otherwise on whole
+# rows at once as big integers, adding 7 bits per byte and patching the
+# top bits back in with xor so no carry crosses a byte boundary.  Average
+# and Paeth depend on the byte just reconstructed to their left and have
+# to be done byte by byte either way.
+
+_swar_masks = {}
+
+def _row_to_int(row):
+    return int(binascii.hexlify(row), 16)
+
+def _int_to_row(value, length):
+    return bytearray(binascii.unhexlify('%0*x' % (length * 2, value)))
+
+def _swar_add(x, y, length):
+    """
+    Add two rows packed as integers byte by byte, modulo 256.
+    """
+    try:
+        high, low = _swar_masks[length]
+    except KeyError:
+        high = int('80' * length, 16)
+        low = int('7f' * length, 16)
+        _swar_masks[length] = high, low
+    return ((x & low) + (y & low)) ^ ((x ^ y) & high)
+
+def _unfilter_sub(line, prev, psize):
+    if numpy is not None:
+        row = numpy.frombuffer(line, numpy.uint8).reshape(-1, psize)
+        row = numpy.add.accumulate(row, axis=0, dtype=numpy.uint8)
+        return bytearray(row.tobytes())
+    length = len(line)
+    value = _row_to_int(line)
+    # Hillis-Steele prefix sum over each channel; doubling the shift on
+    # every pass needs only log2(length) passes.
+    shift = psize
+    while shift < length:
+        value = _swar_add(value, value >> (8 * shift), length)
+        shift *= 2
+    return _int_to_row(value, length)
+
+def _unfilter_up(line, prev, psize):
+    if prev is None:
+        return bytearray(line)
+    if numpy is not None:
+        row = numpy.frombuffer(line, numpy.uint8) + \
+              numpy.frombuffer(prev, numpy.uint8)
+        return bytearray(row.tobytes())
+    length = len(line)
+    return _int_to_row(
+        _swar_add(_row_to_int(line), _row_to_int(prev), length), length)
+
+def _unfilter_average(line, prev, psize):
+    out = bytearray(line)
+    if prev is None:
+        prev = bytearray(len(out))
+    for i in range(psize):
+        out[i] = (out[i] + (prev[i] >> 1)) & 0xff
+    for i in range(psize, len(out)):
+        out[i] = (out[i] + ((out[i - psize] + prev[i]) >> 1)) & 0xff
+    return out
+
+def _unfilter_paeth(line, prev, psize):
+    if prev is None:
+        return _unfilter_sub(line, prev, psize)
+    out = bytearray(line)
+    for i in range(psize):
+        out[i] = (out[i] + prev[i]) & 0xff
+    for i in range(psize, len(out)):
+        a = out[i - psize]
+        b = prev[i]
+        c = prev[i - psize]
+        # pa, pb, pc as in the spec, with p = a + b - c folded in
+        pa = abs(b - c)
+        pb = abs(a - c)
+        pc = abs(a + b - c - c)
+        if pa <= pb and pa <= pc:
+            pr = a
+        elif pb <= pc:
+            pr = b
+        else:
+            pr = c
+        out[i] = (out[i] + pr) & 0xff
+    return out
+
+_unfilters = {
+    1: _unfilter_sub,
+    2: _unfilter_up,
+    3: _unfilter_average,
+    4: _unfilter_paeth,
+}
+
+def unfilter_scanline(filter_type, line, prev, psize):
+    """
+    Undo the PNG filter on one scanline and return it as a bytearray.
+
+    prev is the reconstructed previous line of the same pass, or None
+    for the first line.
+    """
+    if filter_type == 0:
+        return bytearray(line)
+    try:
+        unfilter = _unfilters[filter_type]
+    except KeyError:
+        raise Error("unknown filter type %s" % filter_type)
+    return unfilter(line, prev, psize)
+
 class Reader:
     """
     PNG decoder in pure Python.
@@ -671,66 +886,51 @@ class Reader:
         for xstart, ystart, xstep, ystep in _adam7:
             # print >> sys.stderr, "Adam7: start=%s,%s step=%s,%s" % (
             #     xstart, ystart, xstep, ystep)
-            filter_first_line = 1
+            if xstart >= self.width:
+                continue
+            # Note we want the ceiling of (width - xstart) / xtep
+            row_len = self.psize * (
+                (self.width - xstart + xstep - 1) // xstep)
+            prev = None
             for y in range(ystart, self.height, ystep):
-                if xstart >= self.width:
-                    continue
                 filter_type = scanlines[source_offset]
                 source_offset += 1
+                line = scanlines[source_offset:source_offset + row_len]
+                source_offset += row_len
+                prev = unfilter_scanline(filter_type, line, prev, self.psize)
+                row = array('B', prev)
                 if xstep == 1:
                     offset = y * self.row_bytes
-                    a[offset:offset+self.row_bytes] = \
-                        scanlines[source_offset:source_offset + self.row_bytes]
-                    source_offset += self.row_bytes
+                    a[offset:offset+self.row_bytes] = row
                 else:
-                    # Note we want the ceiling of (width - xstart) / xtep
-                    row_len = self.psize * (
-                        (self.width - xstart + xstep - 1) / xstep)
                     offset = y * self.row_bytes + xstart * self.psize
                     end_offset = (y+1) * self.row_bytes
                     skip = self.psize * xstep
                     for i in range(self.psize):
-                        a[offset+i:end_offset:skip] = \
-                            scanlines[source_offset + i:
-                                      source_offset + row_len:
-                                      self.psize]
-                    source_offset += row_len
-                if filter_type:
-                    self.reconstruct_line(filter_type, filter_first_line,
-                                          offset, xstep, ystep)
-                filter_first_line = 0
+                        a[offset+i:end_offset:skip] = row[i::self.psize]
         return a
 
     def read_flat(self, scanlines):
         a = array('B')
         self.pixels = a
-        offset = 0
-        source_offset = 0
-        filter_first_line = 1
-        for y in range(self.height):
-            filter_type = scanlines[source_offset]
-            source_offset += 1
-            a.extend(scanlines[source_offset: source_offset + self.row_bytes])
-            if filter_type:
-                self.reconstruct_line(filter_type, filter_first_line,
-                                      offset, 1, 1)
-            filter_first_line = 0
-            offset += self.row_bytes
-            source_offset += self.row_bytes
+        stride = self.row_bytes + 1
+        prev = None
+        for source_offset in range(0, self.height * stride, stride):
+            prev = unfilter_scanline(
+                scanlines[source_offset],
+                scanlines[source_offset + 1:source_offset + stride],
+                prev, self.psize)
+            a.extend(array('B', prev))
         return a
 
-    def read(self):
+    def _chunks(self, image_metadata):
         """
-        Read a simple PNG file, return width, height, pixels and image metadata
-
-        This function is a very early prototype with limited flexibility
-        and excessive use of memory.
+        Read the PNG signature and chunks, yielding the data of each IDAT
+        chunk and filling in image_metadata from the others.
         """
         signature = self.file.read(8)
         if (signature != struct.pack("8B", 137, 80, 78, 71, 13, 10, 26, 10)):
             raise Error("PNG file has invalid header")
-        compressed = []
-        image_metadata = {}
         while True:
             try:
                 tag, data = self.read_chunk()
@@ -775,8 +975,13 @@ class Reader:
                 self.width = width
                 self.height = height
                 self.row_bytes = width * self.psize
+                self.interlaced = interlaced
+                image_metadata["greyscale"] = greyscale
+                image_metadata["has_alpha"] = has_alpha
+                image_metadata["bytes_per_sample"] = bps
+                image_metadata["interlaced"] = interlaced
             elif tag == asbytes('IDAT'): # http://www.w3.org/TR/PNG/#11IDAT
-                compressed.append(data)
+                yield data
             elif tag == asbytes('bKGD'):
                 if greyscale:
                     image_metadata["background"] = struct.unpack("!1H", data)
@@ -792,16 +997,82 @@ class Reader:
                     struct.unpack("!L", data)[0]) / 100000.0
             elif tag == asbytes('IEND'): # http://www.w3.org/TR/PNG/#11IEND
                 break
+
+    def read(self):
+        """
+        Read a simple PNG file, return width, height, pixels and image metadata
+
+        This function is a very early prototype with limited flexibility
+        and excessive use of memory.  See iter_rows() for a version that
+        decodes one scanline at a time.
+        """
+        image_metadata = {}
+        compressed = list(self._chunks(image_metadata))
         scanlines = array('B', zlib.decompress(asbytes('').join(compressed)))
-        if interlaced:
+        if self.interlaced:
             pixels = self.deinterlace(scanlines)
         else:
             pixels = self.read_flat(scanlines)
-        image_metadata["greyscale"] = greyscale
-        image_metadata["has_alpha"] = has_alpha
-        image_metadata["bytes_per_sample"] = bps
-        image_metadata["interlaced"] = interlaced
-        return width, height, pixels, image_metadata
+        return self.width, self.height, pixels, image_metadata
+
+    def iter_rows(self):
+        """
+        Read a PNG file, return width, height, rows and image metadata.
+
+        Like read(), but rows is an iterator yielding each row as an
+        array('B'), decompressed and reconstructed as the IDAT chunks
+        are read, so only one row is held in memory at a time.  An
+        interlaced image has to be decoded in full before its first
+        row is known; for those the rows come from read()'s pixels.
+        """
+        image_metadata = {}
+        chunks = self._chunks(image_metadata)
+        try:
+            first = next(chunks)
+        except StopIteration:
+            raise Error("PNG file has no IDAT chunk")
+        if self.interlaced:
+            scanlines = array('B', zlib.decompress(
+                asbytes('').join([first] + list(chunks))))
+            rows = self._split_rows(self.deinterlace(scanlines))
+        else:
+            rows = self._iter_flat(first, chunks)
+        return self.width, self.height, rows, image_metadata
+
+    def _split_rows(self, pixels):
+        for offset in range(0, len(pixels), self.row_bytes):
+            yield pixels[offset:offset + self.row_bytes]
+
+    def _iter_flat(self, first, chunks):
+        decompressor = zlib.decompressobj()
+        stride = self.row_bytes + 1
+        pending = bytearray(decompressor.decompress(first))
+        prev = None
+        y = 0
+        while True:
+            offset = 0
+            while len(pending) - offset >= stride and y < self.height:
+                prev = unfilter_scanline(
+                    pending[offset],
+                    pending[offset + 1:offset + stride],
+                    prev, self.psize)
+                yield array('B', prev)
+                offset += stride
+                y += 1
+            del pending[:offset]
+            if y == self.height:
+                break
+            try:
+                data = next(chunks)
+            except StopIteration:
+                pending.extend(decompressor.flush())
+                if len(pending) < stride:
+                    raise Error("PNG image data is truncated")
+                continue
+            pending.extend(decompressor.decompress(data))
+        # Drain the remaining chunks so trailing metadata is still read.
+        for data in chunks:
+            pass
 
 
 def test_suite(options):
@@ -960,10 +1231,52 @@ def test_suite(options):
                     gamma=options.gamma,
                     has_alpha=options.test_alpha,
                     compression=options.compression,
-                    interlaced=options.interlace)
+                    interlaced=options.interlace,
+                    threads=options.threads)
     writer.write_array(sys.stdout, pixels)
 
 
+def benchmark(options):
+    """
+    Time write_array with one zlib stream against threaded IDAT bands.
+    """
+    size = options.test_size or 2048
+    threads = options.threads or 4
+
+    class _counter:
+        def __init__(self):
+            self.bytes = 0
+        def write(self, data):
+            self.bytes += len(data)
+
+    # Rows are RGB ramps with a little noise, cycled through more rows
+    # than fit in the 32K deflate window, so the image compresses about
+    # as well as a photograph does.
+    rng = random.Random(0)
+    rows = []
+    for y in range(61):
+        row = array('B')
+        for x in range(size):
+            row.extend(((x + rng.randint(0, 3)) & 0xff,
+                        ((x >> 1) + rng.randint(0, 3)) & 0xff,
+                        (x * 3 + y) & 0xff))
+        rows.append(row)
+    pixels = array('B')
+    for y in range(size):
+        pixels.extend(rows[y % len(rows)])
+
+    print("%dx%d RGB, compression %s" % (size, size, options.compression))
+    for label, nthreads in (("array_scanlines", None),
+                            ("%d threads" % threads, threads)):
+        writer = Writer(size, size, compression=options.compression,
+                        interlaced=options.interlace, threads=nthreads)
+        out = _counter()
+        start = time.time()
+        writer.write_array(out, pixels)
+        elapsed = time.time() - start
+        print("  %-16s %8.3fs %12d bytes" % (label, elapsed, out.bytes))
+
+
 def read_pnm_header(infile, supported='P6'):
     """
     Read a PNM header, return width and height of the image in pixels.
@@ -1051,6 +1364,12 @@ def _main():
     parser.add_option("-S", "--test-size",
                       action="store", type="int", metavar="size",
                       help="width and height of the test image")
+    parser.add_option("-P", "--threads",
+                      action="store", type="int", metavar="count",
+                      help="compress IDAT bands in this many threads")
+    parser.add_option("--benchmark",
+                      default=False, action="store_true",
+                      help="time threaded against single stream compression")
     (options, args) = parser.parse_args()
 
     # Convert options
@@ -1062,6 +1381,8 @@ def _main():
     # Run regression tests
     if options.test:
         return test_suite(options)
+    if options.benchmark:
+        return benchmark(options)
 
     # Prepare input and output files
     if len(args) == 0:
@@ -1081,7 +1402,8 @@ def _main():
                     background=options.background,
                     has_alpha=options.alpha is not None,
                     gamma=options.gamma,
-                    compression=options.compression)
+                    compression=options.compression,
+                    threads=options.threads)
     if options.alpha is not None:
         pgmfile = open(options.alpha, 'rb')
         awidth, aheight = read_pnm_header(pgmfile, 'P5')
@@ -17,6 +17,10 @@ from ..python2_3 import basestring
 
 __all__ = ['ScatterPlotItem', 'SpotItem']
 
+## Whether QPainter.drawPixmapFragments accepts the sip.array built by
+## fragmentArray(); None until the first 'fragments' mode paint.
+_fragmentArraySupported = None
+
 ## Build all symbol paths
 Symbols = OrderedDict([(name, QtGui.QPainterPath()) for name in ['o', 's', 't', 't1', 't2', 't3','d', '+', 'x', 'p', 'h', 'star']])
 Symbols['o'].addEllipse(QtCore.QRectF(-0.5, -0.5, 1, 1))
@@ -91,6 +95,28 @@ def makeSymbolPixmap(size, pen, brush, symbol):
     img = renderSymbol(symbol, size, pen, brush)
     return QtGui.QPixmap(img)
 
+def fragmentArray(n):
+    """
+    Return an array of *n* QPainter.PixmapFragment structs together with an
+    (n, 10) float64 view of its memory, or (None, None) if the Qt binding
+    cannot share that memory with numpy (this needs PyQt5 with sip.array).
+
+    The view columns are x, y, sourceLeft, sourceTop, width, height, scaleX,
+    scaleY, rotation and opacity; x and y give the *center* of the target.
+    """
+    if not USE_PYQT5:
+        return None, None
+    try:
+        from PyQt5 import sip
+    except ImportError:
+        import sip
+    if not hasattr(sip, 'array'):
+        return None, None
+    frags = sip.array(QtGui.QPainter.PixmapFragment, n)
+    view = np.frombuffer(sip.voidptr(frags, n*80), dtype=np.float64).reshape(n, 10)
+    return frags, view
+
+
 class SymbolAtlas(object):
     """
     Used to efficiently construct a single QPixmap containing all rendered symbols
@@ -211,6 +237,75 @@ class SymbolAtlas(object):
 
 
 
+class SpotIndex(object):
+    """
+    Uniform grid over spot positions, used by ScatterPlotItem to find the
+    spots inside a rectangle without visiting every point.
+
+    Cells hold about *density* points each. Point indexes are stored sorted
+    by cell (row-major), so each grid row of a query is a single slice.
+    Points with non-finite coordinates are left out.
+    """
+    def __init__(self, x, y, density=4):
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        idx = np.nonzero(np.isfinite(x) & np.isfinite(y))[0]
+        self.nx = self.ny = 0
+        self.order = idx
+        if len(idx) == 0:
+            return
+        x = x[idx]
+        y = y[idx]
+        self.xmin, self.xmax = x.min(), x.max()
+        self.ymin, self.ymax = y.min(), y.max()
+        w = self.xmax - self.xmin
+        h = self.ymax - self.ymin
+        cells = max(1, len(idx) // density)
+        if w > 0 and h > 0:
+            nx = int(np.clip(np.sqrt(cells * w / h), 1, cells))
+            ny = max(1, cells // nx)
+        elif w > 0:
+            nx, ny = cells, 1
+        elif h > 0:
+            nx, ny = 1, cells
+        else:
+            nx = ny = 1
+        self.nx, self.ny = nx, ny
+        self.dx = w / nx if w > 0 else 1.0
+        self.dy = h / ny if h > 0 else 1.0
+        cell = self._col(x) + self._row(y) * nx
+        sort = np.argsort(cell, kind='mergesort')
+        self.order = idx[sort]
+        self.starts = np.zeros(nx * ny + 1, dtype=int)
+        np.cumsum(np.bincount(cell, minlength=nx * ny), out=self.starts[1:])
+
+    # Clip before casting: coordinates far outside the grid would overflow
+    # the integer conversion.
+    def _col(self, x):
+        return np.clip((x - self.xmin) / self.dx, 0, self.nx - 1).astype(int)
+
+    def _row(self, y):
+        return np.clip((y - self.ymin) / self.dy, 0, self.ny - 1).astype(int)
+
+    def query(self, x0, x1, y0, y1):
+        """
+        Return the indexes of all points that may lie within x0..x1, y0..y1
+        (in no particular order; callers apply their own exact test), or
+        None if the rectangle covers every point.
+        """
+        if self.nx == 0 or x1 < self.xmin or x0 > self.xmax or y1 < self.ymin or y0 > self.ymax:
+            return np.empty(0, dtype=int)
+        if x0 <= self.xmin and x1 >= self.xmax and y0 <= self.ymin and y1 >= self.ymax:
+            return None
+        c0, c1 = self._col(np.array([x0, x1]))
+        r0, r1 = self._row(np.array([y0, y1]))
+        nx = self.nx
+        if c0 == 0 and c1 == nx - 1:
+            return self.order[self.starts[r0*nx]:self.starts[(r1+1)*nx]]
+        return np.concatenate([self.order[self.starts[r*nx+c0]:self.starts[r*nx+c1+1]]
+                               for r in range(r0, r1 + 1)])
+
+
 class ScatterPlotItem(GraphicsObject):
     """
     Displays a set of x/y points. Instances of this class are created
@@ -242,13 +337,17 @@ class ScatterPlotItem(GraphicsObject):
         self.picture = None   # QPicture used for rendering when pxmode==False
         self.fragmentAtlas = SymbolAtlas()
 
-        self.data = np.empty(0, dtype=[('x', float), ('y', float), ('size', float), ('symbol', object), ('pen', object), ('brush', object), ('data', object), ('item', object), ('sourceRect', object), ('targetRect', object), ('width', float)])
+        self.data = np.empty(0, dtype=[('x', float), ('y', float), ('size', float), ('symbol', object), ('pen', object), ('brush', object), ('data', object), ('item', object), ('sourceRect', object), ('sourceCoords', float, 4), ('targetRect', object), ('width', float)])
         self.bounds = [None, None]  ## caches data bounds
+        self._spotIndex = None      ## SpotIndex over x/y, built on demand
+        self._maxSpotSize = None    ## largest spot size, for hit-testing
+        self._composite = None      ## (key, QImage) cached by the 'image' render mode
         self._maxSpotWidth = 0      ## maximum size of the scale-variant portion of all spots
         self._maxSpotPxWidth = 0    ## maximum size of the scale-invariant portion of all spots
         self.opts = {
             'pxMode': True,
             'useCache': True,  ## If useCache is False, symbols are re-drawn on every paint.
+            'renderMode': None,  ## None, 'fragments' or 'image'; see setRenderMode()
             'antialias': getConfigOption('antialias'),
             'name': None,
         }
@@ -294,6 +393,7 @@ class ScatterPlotItem(GraphicsObject):
                                it is in the item's local coordinate system.
         *data*                 a list of python objects used to uniquely identify each spot.
         *identical*            *Deprecated*. This functionality is handled automatically now.
+        *renderMode*           How cached symbols are drawn in pxMode; see setRenderMode().
         *antialias*            Whether to draw symbols with antialiasing. Note that if pxMode is True, symbols are
                                always rendered with antialiasing (since the rendered symbols can be cached, this
                                incurs very little performance cost)
@@ -388,6 +488,8 @@ class ScatterPlotItem(GraphicsObject):
 
         if 'pxMode' in kargs:
             self.setPxMode(kargs['pxMode'])
+        if 'renderMode' in kargs:
+            self.setRenderMode(kargs['renderMode'])
         if 'antialias' in kargs:
             self.opts['antialias'] = kargs['antialias']
 
@@ -410,8 +512,17 @@ class ScatterPlotItem(GraphicsObject):
     def invalidate(self):
         ## clear any cached drawing state
         self.picture = None
+        self._spotIndex = None
+        self._maxSpotSize = None
+        self._composite = None
         self.update()
 
+    def spotIndex(self):
+        """Return the SpotIndex over the current spot positions, building it if needed."""
+        if self._spotIndex is None:
+            self._spotIndex = SpotIndex(self.data['x'], self.data['y'])
+        return self._spotIndex
+
     def getData(self):
         return self.data['x'], self.data['y']
 
@@ -544,9 +655,33 @@ class ScatterPlotItem(GraphicsObject):
         self.opts['pxMode'] = mode
         self.invalidate()
 
+    def setRenderMode(self, mode):
+        """
+        Set how symbols are drawn from the atlas when pxMode and useCache are on.
+
+        ============== ==========================================================
+        None           One drawPixmap call per visible spot (the default).
+        'fragments'    Target positions are written into a contiguous float
+                       array shared with a QPainter.PixmapFragment array and
+                       drawn with a single drawPixmapFragments call. Falls back
+                       to the default if the Qt binding does not support this.
+        'image'        Spots are composited into a QImage with numpy, which is
+                       cached until the data or the view changes. Where
+                       translucent spots overlap, the stacking order is only
+                       approximate.
+        ============== ==========================================================
+        """
+        if mode not in (None, 'fragments', 'image'):
+            raise Exception("renderMode must be None, 'fragments' or 'image' (got %r)" % (mode,))
+        if self.opts['renderMode'] == mode:
+            return
+        self.opts['renderMode'] = mode
+        self.invalidate()
+
     def updateSpots(self, dataSet=None):
         if dataSet is None:
             dataSet = self.data
+        self._maxSpotSize = None
 
         invalidate = False
         if self.opts['pxMode']:
@@ -557,9 +692,15 @@ class ScatterPlotItem(GraphicsObject):
                 sourceRect = self.fragmentAtlas.getSymbolCoords(opts)
                 dataSet['sourceRect'][mask] = sourceRect
 
+            if not self.fragmentAtlas.atlasValid:
+                ## rebuilding the atlas moves every symbol, so all cached
+                ## source coordinates must be refreshed
+                dataSet = self.data
             self.fragmentAtlas.getAtlas() # generate atlas so source widths are available.
 
-            dataSet['width'] = np.array(list(imap(QtCore.QRectF.width, dataSet['sourceRect'])))/2
+            coords = np.array(list(imap(QtCore.QRectF.getRect, dataSet['sourceRect']))).reshape(len(dataSet), 4)
+            dataSet['sourceCoords'] = coords
+            dataSet['width'] = coords[:,2]/2
             dataSet['targetRect'] = None
             self._maxSpotPxWidth = self.fragmentAtlas.max_width
         else:
@@ -690,6 +831,7 @@ class ScatterPlotItem(GraphicsObject):
         GraphicsObject.viewTransformChanged(self)
         self.bounds = [None, None]
         self.data['targetRect'] = None
+        self._composite = None
 
     def setExportMode(self, *args, **kwds):
         GraphicsObject.setExportMode(self, *args, **kwds)
@@ -719,10 +861,28 @@ class ScatterPlotItem(GraphicsObject):
             return None
         viewBounds = vb.mapRectToDevice(vb.boundingRect())
         w = self.data['width']
-        mask = ((pts[0] + w > viewBounds.left()) &
-                (pts[0] - w < viewBounds.right()) &
-                (pts[1] + w > viewBounds.top()) &
-                (pts[1] - w < viewBounds.bottom())) ## remove out of view points
+
+        ## Use the spot index to find the points that may be in view. pts is
+        ## offset by -w, so a visible point lies within 2*w of viewBounds.
+        candidates = None
+        if len(w) > 0:
+            pad = 2 * w.max() + 1
+            rect = self.mapRectFromDevice(viewBounds.adjusted(-pad, -pad, pad, pad))
+            if rect is not None:
+                candidates = self.spotIndex().query(rect.left(), rect.right(), rect.top(), rect.bottom())
+        if candidates is None:
+            return ((pts[0] + w > viewBounds.left()) &
+                    (pts[0] - w < viewBounds.right()) &
+                    (pts[1] + w > viewBounds.top()) &
+                    (pts[1] - w < viewBounds.bottom())) ## remove out of view points
+
+        pts = pts[:,candidates]
+        w = w[candidates]
+        mask = np.zeros(len(self.data), dtype=bool)
+        mask[candidates] = ((pts[0] + w > viewBounds.left()) &
+                            (pts[0] - w < viewBounds.right()) &
+                            (pts[1] + w > viewBounds.top()) &
+                            (pts[1] - w < viewBounds.bottom()))
         return mask
 
 
@@ -757,6 +917,14 @@ class ScatterPlotItem(GraphicsObject):
                 # Draw symbols from pre-rendered atlas
                 atlas = self.fragmentAtlas.getAtlas()
 
+                mode = self.opts['renderMode']
+                if mode == 'fragments':
+                    if self.drawFragments(p, pts, viewMask, atlas):
+                        return
+                elif mode is not None:
+                    self.drawComposite(p, pts, viewMask)
+                    return
+
                 # Update targetRects if necessary
                 updateMask = viewMask & np.equal(self.data['targetRect'], None)
                 if np.any(updateMask):
@@ -795,6 +963,126 @@ class ScatterPlotItem(GraphicsObject):
             p.setRenderHint(p.Antialiasing, aa)
             self.picture.play(p)
 
+    def drawFragments(self, p, pts, viewMask, atlas):
+        """
+        Draw the spots selected by *viewMask* with one drawPixmapFragments
+        call. *pts* are the device coordinates from mapPointsToDevice().
+        Return False if the Qt binding cannot do this.
+        """
+        global _fragmentArraySupported
+        if _fragmentArraySupported is False:
+            return False
+        w = self.data['width'][viewMask]
+        n = len(w)
+        frags, arr = fragmentArray(max(n, 1))
+        if frags is None:
+            _fragmentArraySupported = False
+            return False
+        arr[:n,0] = pts[0,viewMask] + w
+        arr[:n,1] = pts[1,viewMask] + w
+        arr[:n,2:6] = self.data['sourceCoords'][viewMask]
+        arr[:n,6:8] = 1.0
+        arr[:n,8] = 0.0
+        arr[:n,9] = 1.0
+        if n == 0:
+            return True
+        try:
+            p.drawPixmapFragments(frags, atlas)
+        except TypeError:
+            _fragmentArraySupported = False
+            return False
+        _fragmentArraySupported = True
+        return True
+
+    def drawComposite(self, p, pts, viewMask):
+        """
+        Draw the spots selected by *viewMask* by compositing them from the atlas
+        into one QImage covering the view. The image is cached until the data
+        or the view transform changes.
+        """
+        vb = self.getViewBox()
+        if vb is None:
+            return
+        bounds = vb.mapRectToDevice(vb.boundingRect()).toAlignedRect()
+        tr = self.deviceTransform()
+        key = (bounds.x(), bounds.y(), bounds.width(), bounds.height(),
+               tr.m11(), tr.m12(), tr.m21(), tr.m22(), tr.dx(), tr.dy())
+        if self._composite is None or self._composite[0] != key:
+            coords = self.data['sourceCoords'][viewMask]
+            self._composite = (key, self.compositeImage(pts[:,viewMask], coords, bounds))
+        p.drawImage(QtCore.QPointF(bounds.x(), bounds.y()), self._composite[1])
+
+    def compositeImage(self, pts, coords, bounds):
+        """
+        Composite the atlas symbols at *coords* (rows of sourceCoords) to the
+        device positions *pts* in a QImage the size of the QRect *bounds*.
+
+        Spots are grouped by symbol and symbol pixels by color. Compositing
+        one color k times over a pixel with the 'over' operator has a closed
+        form, so each color is applied once to the pixels it covers after
+        counting, per pixel, how many spots cover it with that color, over
+        all spot positions and sprite pixels of the color at once. Stacking
+        is exact within a color and approximate between colors and symbols.
+        """
+        width, height = bounds.width(), bounds.height()
+        atlas = self.fragmentAtlas.atlasData
+        if len(coords) == 0 or width <= 0 or height <= 0 or atlas is None or atlas.size == 0:
+            return fn.makeQImage(np.zeros((max(height, 1), max(width, 1), 4), dtype=np.ubyte),
+                                 alpha=True, transpose=False)
+
+        ## pad the canvas by the largest symbol so no per-pixel bounds checks are needed
+        coords = coords.astype(np.int64)
+        pad = int(coords[:,2:].max())
+        W, H = width + 2*pad, height + 2*pad
+        canvas = np.zeros((H*W, 4), dtype=np.float32)
+        x = np.round(pts[0]).astype(np.int64) - bounds.x() + pad
+        y = np.round(pts[1]).astype(np.int64) - bounds.y() + pad
+        inside = (x >= 0) & (x < W - pad) & (y >= 0) & (y < H - pad)
+        base = (y*W + x)[inside]
+        coords = coords[inside]
+
+        keys = ((coords[:,0]*32768 + coords[:,1])*32768 + coords[:,2])*32768 + coords[:,3]
+        symbols, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        for i in range(len(symbols)):
+            sx, sy, sw, sh = coords[first[i]]
+            targets = base[inverse == i] if len(symbols) > 1 else base
+            sprite = atlas[sy:sy+sh, sx:sx+sw].reshape(-1, 4)
+            offsets = (np.arange(sh)[:,None]*W + np.arange(sw)[None,:]).ravel()
+            colors, pixels = np.unique(sprite.view(np.uint32).ravel(), return_inverse=True)
+            for j in np.argsort(colors.view(np.uint8).reshape(-1, 4)[:,3]):
+                color = colors[j:j+1].view(np.uint8).astype(np.float32)
+                if color[3] == 0:
+                    continue
+                ## count every (spot, sprite pixel) pair of this color: sparse
+                ## colors directly, dense ones with a few million pairs per
+                ## bincount over the canvas to bound the index array
+                offs = offsets[pixels.ravel() == j]
+                if len(targets) * len(offs) < H*W:
+                    idx = (targets[:,None] + offs[None,:]).ravel()
+                    covered, count = np.unique(idx, return_counts=True)
+                else:
+                    step = max(1, max(H*W, 1 << 22) // len(offs))
+                    count = np.zeros(H*W, dtype=np.intp)
+                    for k in range(0, len(targets), step):
+                        idx = (targets[k:k+step,None] + offs[None,:]).ravel()
+                        count += np.bincount(idx, minlength=H*W)
+                    covered = np.nonzero(count)[0]
+                    count = count[covered]
+                alpha = color[3] / 255.
+                color[:3] *= alpha
+                if alpha >= 1.0:
+                    canvas[covered] = color
+                    continue
+                q = (1. - alpha) ** count.astype(np.float32)
+                canvas[covered] = color * ((1. - q) / alpha)[:,None] + canvas[covered] * q[:,None]
+
+        canvas = canvas.reshape(H, W, 4)[pad:pad+height, pad:pad+width]
+        alpha = canvas[...,3:]
+        out = np.empty((height, width, 4), dtype=np.ubyte)
+        out[...,:3] = np.clip(canvas[...,:3] * 255. / np.maximum(alpha, 1e-6) + 0.5, 0, 255)
+        out[...,3:] = np.clip(alpha + 0.5, 0, 255)
+        return fn.makeQImage(out, alpha=True, transpose=False)
+
     def points(self):
         for rec in self.data:
             if rec['item'] is None:
@@ -804,25 +1092,39 @@ class ScatterPlotItem(GraphicsObject):
     def pointsAt(self, pos):
         x = pos.x()
         y = pos.y()
+        if len(self.data) == 0:
+            return []
         pw = self.pixelWidth()
         ph = self.pixelHeight()
+        if self._maxSpotSize is None:
+            sizes = self.data['size']
+            self._maxSpotSize = max(np.nanmax(sizes), self.opts['size'])
+
+        ## only spots within the largest half-size of pos can be hit
+        s2x = s2y = self._maxSpotSize * 0.5
+        if self.opts['pxMode']:
+            s2x *= pw
+            s2y *= ph
+        candidates = self.spotIndex().query(x-s2x, x+s2x, y-s2y, y+s2y)
+        if candidates is None:
+            candidates = np.arange(len(self.data))
+        data = self.data[candidates]
+
+        ss = np.where(data['size'] == -1, self.opts['size'], data['size'])
+        s2x = s2y = ss * 0.5
+        if self.opts['pxMode']:
+            s2x = s2x * pw
+            s2y = s2y * ph
+        sx = data['x']
+        sy = data['y']
+        hit = (x > sx-s2x) & (x < sx+s2x) & (y > sy-s2y) & (y < sy+s2y)
         pts = []
-        for s in self.points():
-            sp = s.pos()
-            ss = s.size()
-            sx = sp.x()
-            sy = sp.y()
-            s2x = s2y = ss * 0.5
-            if self.opts['pxMode']:
-                s2x *= pw
-                s2y *= ph
-            if x > sx-s2x and x < sx+s2x and y > sy-s2y and y < sy+s2y:
-                pts.append(s)
-                #print "HIT:", x, y, sx, sy, s2x, s2y
-            #else:
-                #print "No hit:", (x, y), (sx, sy)
-                #print "       ", (sx-s2x, sy-s2y), (sx+s2x, sy+s2y)
-        return pts[::-1]
+        for i in np.sort(candidates[hit])[::-1]:
+            rec = self.data[i]
+            if rec['item'] is None:
+                rec['item'] = SpotItem(rec, self)
+            pts.append(rec['item'])
+        return pts
 
 
     def mouseClickEvent(self, ev):
@@ -942,6 +1244,63 @@ class SpotItem(object):
         self._plot.updateSpots(self._data.reshape(1))
         self._plot.invalidate()
 
+def benchmark(sizes=(100000, 1000000, 10000000), modes=(None, 'fragments', 'image'), repeat=3):
+    """
+    Time setData() and painting of a ScatterPlotItem for each number of
+    points in *sizes* and each render mode in *modes*, printing the results.
+    If no QApplication exists yet, Qt is started on the offscreen platform so
+    this also runs headless::
+
+        python -c "from pyqtgraph.graphicsItems.ScatterPlotItem import benchmark; benchmark()"
+
+    Each paint renders the view into an 800x600 QImage after invalidate(),
+    so the 'image' mode's cache does not count. Returns
+    {(mode, size): (setData seconds, best paint seconds)}.
+    """
+    import os
+    from .. import ptime
+    if QtGui.QApplication.instance() is None:
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from .. import mkQApp
+    from ..widgets.GraphicsView import GraphicsView
+    from .ViewBox import ViewBox
+
+    app = mkQApp()
+    view = GraphicsView()
+    vb = ViewBox()
+    view.setCentralItem(vb)
+    view.resize(800, 600)
+    view.show()
+    image = QtGui.QImage(800, 600, QtGui.QImage.Format_ARGB32_Premultiplied)
+    rng = np.random.RandomState(0)
+    results = {}
+    for size in sizes:
+        x = rng.normal(size=size)
+        y = rng.normal(size=size)
+        for mode in modes:
+            item = ScatterPlotItem(pen=None, brush=(100, 100, 200, 100), renderMode=mode)
+            start = ptime.time()
+            item.setData(x=x, y=y)
+            setup = ptime.time() - start
+            vb.addItem(item)
+            vb.autoRange()
+            app.processEvents()
+            best = None
+            for i in range(repeat):
+                item.invalidate()
+                image.fill(0)
+                p = QtGui.QPainter(image)
+                start = ptime.time()
+                view.render(p)
+                elapsed = ptime.time() - start
+                p.end()
+                best = elapsed if best is None else min(best, elapsed)
+            vb.removeItem(item)
+            results[(mode, size)] = (setup, best)
+            print("%-10s %9d points: setData %7.3fs  paint %7.3fs" % (mode, size, setup, best))
+    return results
+
+
 #class PixmapSpotItem(SpotItem, QtGui.QGraphicsPixmapItem):
     #def __init__(self, data, plot):
         #QtGui.QGraphicsPixmapItem.__init__(self)
@@ -18,21 +18,27 @@ from __future__ import division
 
 
 import numbers
+import os
 from abc import ABCMeta
 from abc import abstractmethod
 from math import ceil
 
 import numpy as np
 from scipy.sparse import issparse
+from scipy.sparse import vstack as sparse_vstack
 
 from ..base import BaseEstimator
 from ..base import ClassifierMixin
 from ..base import RegressorMixin
 from ..externals import six
+from ..externals.joblib import Parallel, delayed
 from ..feature_selection.from_model import _LearntSelectorMixin
 from ..utils import check_array
 from ..utils import check_random_state
 from ..utils import compute_sample_weight
+from ..utils import gen_even_slices
+from ..utils import _get_n_jobs
+from ..utils.fixes import parallel_helper
 from ..utils.multiclass import check_classification_targets
 from ..exceptions import NotFittedError
 
@@ -46,7 +52,8 @@ from . import _tree, _splitter, _criterion
 __all__ = ["DecisionTreeClassifier",
            "DecisionTreeRegressor",
            "ExtraTreeClassifier",
-           "ExtraTreeRegressor"]
+           "ExtraTreeRegressor",
+           "TreeArrays"]
 
 
 # =============================================================================
@@ -55,6 +62,7 @@ __all__ = ["DecisionTreeClassifier",
 
 DTYPE = _tree.DTYPE
 DOUBLE = _tree.DOUBLE
+TREE_LEAF = _tree.TREE_LEAF
 
 CRITERIA_CLF = {"gini": _criterion.Gini, "entropy": _criterion.Entropy}
 CRITERIA_REG = {"mse": _criterion.MSE, "friedman_mse": _criterion.FriedmanMSE,
@@ -92,7 +100,8 @@ class BaseDecisionTree(six.with_metaclass(ABCMeta, BaseEstimator,
                  random_state,
                  min_impurity_split,
                  class_weight=None,
-                 presort=False):
+                 presort=False,
+                 n_jobs=1):
         self.criterion = criterion
         self.splitter = splitter
         self.max_depth = max_depth
@@ -105,6 +114,7 @@ class BaseDecisionTree(six.with_metaclass(ABCMeta, BaseEstimator,
         self.min_impurity_split = min_impurity_split
         self.class_weight = class_weight
         self.presort = presort
+        self.n_jobs = n_jobs
 
         self.n_features_ = None
         self.n_outputs_ = None
@@ -404,6 +414,23 @@ class BaseDecisionTree(six.with_metaclass(ABCMeta, BaseEstimator,
 
         return X
 
+    def _tree_call(self, method, X):
+        """Call ``self.tree_.<method>`` on X, split in blocks of rows that
+        are handled by ``n_jobs`` threads"""
+        n_samples = X.shape[0]
+        n_jobs = min(_get_n_jobs(self.n_jobs), n_samples)
+        if n_jobs <= 1:
+            return getattr(self.tree_, method)(X)
+
+        # The tree methods release the GIL while traversing the tree
+        results = Parallel(n_jobs=n_jobs, backend="threading")(
+            delayed(parallel_helper)(self.tree_, method, X[s])
+            for s in gen_even_slices(n_samples, n_jobs))
+
+        if method == "decision_path":
+            return sparse_vstack(results, format="csr")
+        return np.concatenate(results)
+
     def predict(self, X, check_input=True):
         """Predict class or regression value for X.
 
@@ -429,7 +456,7 @@ class BaseDecisionTree(six.with_metaclass(ABCMeta, BaseEstimator,
         """
 
         X = self._validate_X_predict(X, check_input)
-        proba = self.tree_.predict(X)
+        proba = self._tree_call("predict", X)
         n_samples = X.shape[0]
 
         # Classification
@@ -481,7 +508,7 @@ class BaseDecisionTree(six.with_metaclass(ABCMeta, BaseEstimator,
             numbering.
         """
         X = self._validate_X_predict(X, check_input)
-        return self.tree_.apply(X)
+        return self._tree_call("apply", X)
 
     def decision_path(self, X, check_input=True):
         """Return the decision path in the tree
@@ -505,7 +532,23 @@ class BaseDecisionTree(six.with_metaclass(ABCMeta, BaseEstimator,
 
         """
         X = self._validate_X_predict(X, check_input)
-        return self.tree_.decision_path(X)
+        return self._tree_call("decision_path", X)
+
+    def export_arrays(self):
+        """Export the fitted tree as flat NumPy arrays.
+
+        Returns
+        -------
+        arrays : TreeArrays
+            A copy of the node arrays of ``tree_``, which can predict on its
+            own and be saved to ``.npy`` files to be memory-mapped by other
+            processes.
+        """
+        if self.tree_ is None:
+            raise NotFittedError("Estimator not fitted, call `fit` before"
+                                 " `export_arrays`.")
+
+        return TreeArrays.from_tree(self.tree_)
 
     @property
     def feature_importances_(self):
@@ -526,6 +569,118 @@ class BaseDecisionTree(six.with_metaclass(ABCMeta, BaseEstimator,
         return self.tree_.compute_feature_importances()
 
 
+# =============================================================================
+# Array export
+# =============================================================================
+
+class TreeArrays(object):
+    """A fitted tree as a structure of flat NumPy arrays.
+
+    Holds the node arrays of a ``Tree`` and traverses them in pure NumPy,
+    so that a tree can be written to ``.npy`` files and memory-mapped by
+    any number of worker processes instead of being pickled to each.
+
+    Parameters
+    ----------
+    feature : array of int, shape = [node_count]
+        The feature used to split each node; meaningless for leaves.
+
+    threshold : array of float64, shape = [node_count]
+        The threshold of each split: samples with
+        ``X[:, feature] <= threshold`` go to the left child.
+
+    children_left : array of int, shape = [node_count]
+        The left child of each node, ``TREE_LEAF`` for leaves.
+
+    children_right : array of int, shape = [node_count]
+        The right child of each node, ``TREE_LEAF`` for leaves.
+
+    value : array of float64, shape = [node_count, n_outputs, max_n_classes]
+        The contents of each node, as in ``Tree.value``.
+    """
+    _fields = ("feature", "threshold", "children_left", "children_right",
+               "value")
+
+    def __init__(self, feature, threshold, children_left, children_right,
+                 value):
+        self.feature = feature
+        self.threshold = threshold
+        self.children_left = children_left
+        self.children_right = children_right
+        self.value = value
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Copy the node arrays of a ``Tree``"""
+        return cls(*[np.array(getattr(tree, name)) for name in cls._fields])
+
+    def save(self, folder):
+        """Write each array to ``<folder>/<name>.npy``"""
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for name in self._fields:
+            np.save(os.path.join(folder, name + ".npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, folder, mmap_mode="r"):
+        """Read the arrays written by `save`, memory-mapped by default"""
+        return cls(*[np.load(os.path.join(folder, name + ".npy"),
+                             mmap_mode=mmap_mode)
+                     for name in cls._fields])
+
+    def apply(self, X):
+        """Return the index of the leaf that each sample ends up in.
+
+        All samples descend the tree together, one level per step: those
+        still at a split node look up its feature and threshold and move
+        to a child, so the loop runs once per level instead of once per
+        sample and node.
+
+        Parameters
+        ----------
+        X : array-like, shape = [n_samples, n_features]
+            The input samples. Internally, it will be converted to
+            ``dtype=np.float32``.
+
+        Returns
+        -------
+        X_leaves : array of int, shape = [n_samples,]
+            The leaf of each sample, numbered as in ``Tree.apply``.
+        """
+        X = check_array(X, dtype=DTYPE)
+        node = np.zeros(X.shape[0], dtype=np.intp)
+        active = np.arange(X.shape[0])
+
+        while active.size > 0:
+            current = node[active]
+            left = self.children_left[current]
+            split = left != TREE_LEAF
+            active = active[split]
+            current = current[split]
+            go_left = (X[active, self.feature[current]] <=
+                       self.threshold[current])
+            node[active] = np.where(go_left, left[split],
+                                    self.children_right[current])
+
+        return node
+
+    def predict(self, X):
+        """Return the contents of the leaf that each sample ends up in.
+
+        Parameters
+        ----------
+        X : array-like, shape = [n_samples, n_features]
+            The input samples. Internally, it will be converted to
+            ``dtype=np.float32``.
+
+        Returns
+        -------
+        value : array of float64, shape = [n_samples, n_outputs, max_n_classes]
+            As ``Tree.predict``.
+        """
+        return self.value.take(self.apply(X), axis=0)
+
+
 # =============================================================================
 # Public estimators
 # =============================================================================
@@ -628,6 +783,11 @@ class DecisionTreeClassifier(BaseDecisionTree, ClassifierMixin):
         When using either a smaller dataset or a restricted depth, this may
         speed up the training.
 
+    n_jobs : integer, optional (default=1)
+        The number of jobs to run in parallel for `predict`, `apply` and
+        `decision_path`, each on a block of rows of the input. If -1, then
+        the number of jobs is set to the number of cores.
+
     Attributes
     ----------
     classes_ : array of shape = [n_classes] or a list of such arrays
@@ -700,7 +860,8 @@ class DecisionTreeClassifier(BaseDecisionTree, ClassifierMixin):
                  max_leaf_nodes=None,
                  min_impurity_split=1e-7,
                  class_weight=None,
-                 presort=False):
+                 presort=False,
+                 n_jobs=1):
         super(DecisionTreeClassifier, self).__init__(
             criterion=criterion,
             splitter=splitter,
@@ -713,7 +874,8 @@ class DecisionTreeClassifier(BaseDecisionTree, ClassifierMixin):
             class_weight=class_weight,
             random_state=random_state,
             min_impurity_split=min_impurity_split,
-            presort=presort)
+            presort=presort,
+            n_jobs=n_jobs)
 
     def predict_proba(self, X, check_input=True):
         """Predict class probabilities of the input samples X.
@@ -740,7 +902,7 @@ class DecisionTreeClassifier(BaseDecisionTree, ClassifierMixin):
             classes corresponds to that in the attribute `classes_`.
         """
         X = self._validate_X_predict(X, check_input)
-        proba = self.tree_.predict(X)
+        proba = self._tree_call("predict", X)
 
         if self.n_outputs_ == 1:
             proba = proba[:, :self.n_classes_]
@@ -751,16 +913,14 @@ class DecisionTreeClassifier(BaseDecisionTree, ClassifierMixin):
             return proba
 
         else:
-            all_proba = []
-
-            for k in range(self.n_outputs_):
-                proba_k = proba[:, k, :self.n_classes_[k]]
-                normalizer = proba_k.sum(axis=1)[:, np.newaxis]
-                normalizer[normalizer == 0.0] = 1.0
-                proba_k /= normalizer
-                all_proba.append(proba_k)
+            # Normalize all outputs at once, the columns past n_classes_[k]
+            # of output k are zero
+            normalizer = proba.sum(axis=2)[:, :, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+            proba /= normalizer
 
-            return all_proba
+            return [proba[:, k, :self.n_classes_[k]]
+                    for k in range(self.n_outputs_)]
 
     def predict_log_proba(self, X):
         """Predict class log-probabilities of the input samples X.
@@ -879,6 +1039,11 @@ class DecisionTreeRegressor(BaseDecisionTree, RegressorMixin):
         When using either a smaller dataset or a restricted depth, this may
         speed up the training.
 
+    n_jobs : integer, optional (default=1)
+        The number of jobs to run in parallel for `predict`, `apply` and
+        `decision_path`, each on a block of rows of the input. If -1, then
+        the number of jobs is set to the number of cores.
+
     Attributes
     ----------
     feature_importances_ : array of shape = [n_features]
@@ -942,7 +1107,8 @@ class DecisionTreeRegressor(BaseDecisionTree, RegressorMixin):
                  random_state=None,
                  max_leaf_nodes=None,
                  min_impurity_split=1e-7,
-                 presort=False):
+                 presort=False,
+                 n_jobs=1):
         super(DecisionTreeRegressor, self).__init__(
             criterion=criterion,
             splitter=splitter,
@@ -954,7 +1120,8 @@ class DecisionTreeRegressor(BaseDecisionTree, RegressorMixin):
             max_leaf_nodes=max_leaf_nodes,
             random_state=random_state,
             min_impurity_split=min_impurity_split,
-            presort=presort)
+            presort=presort,
+            n_jobs=n_jobs)
 
 
 class ExtraTreeClassifier(DecisionTreeClassifier):
@@ -992,7 +1159,8 @@ class ExtraTreeClassifier(DecisionTreeClassifier):
                  random_state=None,
                  max_leaf_nodes=None,
                  min_impurity_split=1e-7,
-                 class_weight=None):
+                 class_weight=None,
+                 n_jobs=1):
         super(ExtraTreeClassifier, self).__init__(
             criterion=criterion,
             splitter=splitter,
@@ -1004,7 +1172,8 @@ class ExtraTreeClassifier(DecisionTreeClassifier):
             max_leaf_nodes=max_leaf_nodes,
             class_weight=class_weight,
             min_impurity_split=min_impurity_split,
-            random_state=random_state)
+            random_state=random_state,
+            n_jobs=n_jobs)
 
 
 class ExtraTreeRegressor(DecisionTreeRegressor):
@@ -1041,7 +1210,8 @@ class ExtraTreeRegressor(DecisionTreeRegressor):
                  max_features="auto",
                  random_state=None,
                  min_impurity_split=1e-7,
-                 max_leaf_nodes=None):
+                 max_leaf_nodes=None,
+                 n_jobs=1):
         super(ExtraTreeRegressor, self).__init__(
             criterion=criterion,
             splitter=splitter,
@@ -1052,4 +1222,5 @@ class ExtraTreeRegressor(DecisionTreeRegressor):
             max_features=max_features,
             max_leaf_nodes=max_leaf_nodes,
             min_impurity_split=min_impurity_split,
-            random_state=random_state)
\ No newline at end of file
+            random_state=random_state,
+            n_jobs=n_jobs)
\ No newline at end of file
@@ -0,0 +1,100 @@
+"""Tests for ``ScrollIterator`` in the tornado_elasticsearch sample.
+
+The sample is loaded from every dataset variant that carries it, so the
+variants cannot drift apart on this behaviour.  Variants that are not valid
+Python (some are truncated in the corpus) are skipped.
+"""
+import glob
+import importlib.util
+import os
+import unittest
+
+from tornado import concurrent
+from tornado import gen
+from tornado import ioloop
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE = "sample_566de09bf7_431.py"
+
+
+def _load_variants():
+    modules = []
+    for path in sorted(glob.glob(os.path.join(ROOT, "dataset_*", SAMPLE))):
+        name = "%s_%s" % (os.path.basename(os.path.dirname(path)), SAMPLE[:-3])
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        try:
+            spec.loader.exec_module(module)
+        except SyntaxError:
+            continue
+        modules.append(module)
+    return modules
+
+
+def _resolved(value):
+    future = concurrent.Future()
+    future.set_result(value)
+    return future
+
+
+class FakeClient(object):
+    """Answers every search and scroll with the same page.
+
+    Gives up after a handful of requests so an iterator that never stops
+    fails the test instead of hanging it.
+    """
+
+    MAX_REQUESTS = 10
+
+    def __init__(self, page):
+        self.page = page
+        self.requests = []
+
+    def _record(self, kind):
+        self.requests.append(kind)
+        if len(self.requests) > self.MAX_REQUESTS:
+            raise AssertionError("iterator kept requesting: %r"
+                                 % self.requests)
+
+    def search(self, **kwargs):
+        self._record("search")
+        return _resolved(self.page)
+
+    def scroll(self, scroll_id, scroll):
+        self._record("scroll")
+        return _resolved(self.page)
+
+    def clear_scroll(self, scroll_id, ignore=()):
+        self._record("clear_scroll")
+        return _resolved({})
+
+
+class ScrollIteratorTest(unittest.TestCase):
+
+    variants = _load_variants()
+
+    def drain(self, hits):
+        """Iterate ``hits`` to the end and return the hits it yielded."""
+        @gen.coroutine
+        def run():
+            seen = []
+            while (yield hits.fetch_next):
+                seen.append(hits.next_object())
+            raise gen.Return(seen)
+        return ioloop.IOLoop().run_sync(run, timeout=5)
+
+    def test_empty_result_without_total_ends_scroll(self):
+        for module in self.variants:
+            client = FakeClient({"_scroll_id": "s1", "hits": {"hits": []}})
+            hits = module.ScrollIterator(client)
+            self.assertEqual(self.drain(hits), [])
+            self.assertEqual(client.requests,
+                             ["search", "scroll", "clear_scroll"])
+
+    def test_empty_result_without_total_ends_search_after(self):
+        for module in self.variants:
+            client = FakeClient({"hits": {"hits": []}})
+            hits = module.ScrollIterator(client, body={"sort": ["_doc"]},
+                                         search_after=True)
+            self.assertEqual(self.drain(hits), [])
+            self.assertEqual(client.requests, ["search", "search"])
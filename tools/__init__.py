@@ -0,0 +1 @@
+"""Tooling for working with the ``dataset_*vulns`` sample corpus."""
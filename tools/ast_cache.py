@@ -0,0 +1,192 @@
+"""Content-addressed cache of parsed ASTs for the sample corpus.
+
+Entries are keyed by a BLAKE2b digest of the source bytes together with
+the running Python's major/minor version (the AST shape changes between
+releases) and the entry format, so an edited sample simply misses and a
+renamed or duplicated one hits.  Samples that do not parse are cached too,
+as the exception type and arguments, so they are not re-parsed on every
+run and raise the same SyntaxError (with its position) or ValueError that
+``ast.parse`` would.
+
+`build_cache` fills the cache with a process pool; `AstCache.parse` is
+the drop-in replacement for ``ast.parse`` that tools should call.
+
+Usage::
+
+    python -m tools.ast_cache build [-j N]
+    python -m tools.ast_cache bench [-j N]     # cold vs warm per dataset
+"""
+
+import argparse
+import ast
+import hashlib
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from tools.corpus import BUILD_DIR, DATASETS, ROOT, iter_samples
+
+DEFAULT_DIR = os.path.join(BUILD_DIR, "ast")
+# Bump _FORMAT when the layout of the pickled entries changes.
+_FORMAT = 2
+_VERSION_TAG = ("py%d.%d/%d" % (sys.version_info[:2] + (_FORMAT,))).encode("ascii")
+
+
+def content_key(data):
+    """Cache key for the source bytes `data`."""
+    return hashlib.blake2b(_VERSION_TAG + b"\0" + data, digest_size=20).hexdigest()
+
+
+class AstCache(object):
+    """On-disk AST cache rooted at `directory`."""
+
+    def __init__(self, directory=DEFAULT_DIR):
+        self.directory = directory
+
+    def path_for(self, digest):
+        return os.path.join(self.directory, digest[:2], digest + ".pickle")
+
+    def _load(self, digest):
+        try:
+            with open(self.path_for(digest), "rb") as fp:
+                return pickle.load(fp)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _store(self, digest, entry):
+        path = self.path_for(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as fp:
+            pickle.dump(entry, fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def _entry(self, data, filename):
+        digest = content_key(data)
+        entry = self._load(digest)
+        hit = entry is not None
+        if not hit:
+            try:
+                entry = ("ok", ast.parse(data, filename))
+            except (SyntaxError, ValueError) as e:
+                entry = ("error", (type(e), e.args))
+            self._store(digest, entry)
+        return entry, hit
+
+    def parse(self, data, filename="<unknown>"):
+        """Like ``ast.parse(data)``, served from the cache when possible."""
+        entry, _ = self._entry(data, filename)
+        if entry[0] == "error":
+            cls, args = entry[1]
+            if issubclass(cls, SyntaxError) and len(args) == 2:
+                # The entry may come from a copy of this source under
+                # another name; report the file actually being parsed.
+                args = (args[0], (filename,) + tuple(args[1][1:]))
+            raise cls(*args)
+        return entry[1]
+
+    def parse_file(self, path):
+        with open(path, "rb") as fp:
+            return self.parse(fp.read(), path)
+
+    def ensure(self, path):
+        """Make sure `path` is cached; return ``(ok, hit)``."""
+        with open(path, "rb") as fp:
+            entry, hit = self._entry(fp.read(), path)
+        return entry[0] == "ok", hit
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _ensure_worker(args):
+    directory, path = args
+    return AstCache(directory).ensure(path)
+
+
+def build_cache(datasets=DATASETS, directory=DEFAULT_DIR, workers=None, root=ROOT):
+    """Parse every sample of `datasets` into the cache with a process pool.
+
+    Returns ``{dataset: (parsed, failed, hits)}``.
+    """
+    stats = {}
+    with ProcessPoolExecutor(workers) as pool:
+        for dataset in datasets:
+            jobs = [(directory, path) for _, path in iter_samples(dataset, root)]
+            parsed = failed = hits = 0
+            for ok, hit in pool.map(_ensure_worker, jobs, chunksize=16):
+                if ok:
+                    parsed += 1
+                else:
+                    failed += 1
+                hits += hit
+            stats[dataset] = (parsed, failed, hits)
+    return stats
+
+
+def _load_all(cache, dataset):
+    for _, path in iter_samples(dataset):
+        try:
+            cache.parse_file(path)
+        except (SyntaxError, ValueError):
+            pass
+
+
+def bench(workers=None, datasets=DATASETS, out=sys.stdout):
+    """Time cold (empty cache) and warm parses of each dataset."""
+    directory = tempfile.mkdtemp(prefix="ast-cache-")
+    cache = AstCache(directory)
+    try:
+        out.write("%-16s %10s %12s %12s %12s\n"
+                  % ("dataset", "files", "serial ast", "cold build", "warm load"))
+        for dataset in datasets:
+            paths = [p for _, p in iter_samples(dataset)]
+            start = time.perf_counter()
+            for p in paths:
+                with open(p, "rb") as fp:
+                    try:
+                        ast.parse(fp.read(), p)
+                    except (SyntaxError, ValueError):
+                        pass
+            serial = time.perf_counter() - start
+
+            start = time.perf_counter()
+            build_cache([dataset], directory, workers)
+            cold = time.perf_counter() - start
+
+            start = time.perf_counter()
+            _load_all(cache, dataset)
+            warm = time.perf_counter() - start
+            out.write("%-16s %10d %11.2fs %11.2fs %11.2fs\n"
+                      % (dataset, len(paths), serial, cold, warm))
+    finally:
+        cache.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tools.ast_cache")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="populate the AST cache")
+    build.add_argument("datasets", nargs="*", default=DATASETS)
+    build.add_argument("--dir", default=DEFAULT_DIR)
+    sub.add_parser("bench", help="cold vs warm parse time per dataset")
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        bench(args.workers)
+        return 0
+    stats = build_cache(args.datasets, args.dir, args.workers)
+    for dataset in args.datasets:
+        parsed, failed, hits = stats[dataset]
+        sys.stdout.write("%s: %d parsed, %d syntax errors, %d cache hits\n"
+                         % (dataset, parsed, failed, hits))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
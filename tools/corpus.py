@@ -0,0 +1,214 @@
+"""Corpus layout helpers and the packed, memory-mapped sample store.
+
+The corpus is four directories, ``dataset_<n>vulns``, each holding files
+named ``sample_<hash>_<id>.py``.  A sample is addressed by its key, the
+``(hash, id)`` pair taken from the file name.
+
+``build_pack`` concatenates one dataset into a single file with a sorted
+offset table in front of the data, and ``CorpusPack`` maps that file and
+hands out zero-copy ``memoryview`` slices of it, so reading a sample costs
+a dict lookup instead of an open/read/close.
+
+Pack layout (integers are little-endian)::
+
+    magic   8s      b"VCPACK01"
+    count   Q
+    table   count * (hash 10s, id I, offset Q, length Q), sorted by key
+    data    file contents, in table order
+
+Usage::
+
+    python -m tools.corpus build                 # all four datasets
+    python -m tools.corpus build dataset_3vulns
+"""
+
+import argparse
+import mmap
+import os
+import re
+import struct
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASETS = ("dataset_1vulns", "dataset_3vulns", "dataset_5vulns", "dataset_9vulns")
+BUILD_DIR = os.path.join(ROOT, "build", "corpus")
+
+SAMPLE_RE = re.compile(r"^sample_([0-9a-f]{10})_(\d+)\.py$")
+
+PACK_MAGIC = b"VCPACK01"
+_HEADER = struct.Struct("<8sQ")
+_ENTRY = struct.Struct("<10sIQQ")
+
+
+def parse_sample_name(name):
+    """Return the ``(hash, id)`` key for a sample file name, or None."""
+    m = SAMPLE_RE.match(name)
+    if m is None:
+        return None
+    return m.group(1), int(m.group(2))
+
+
+def sample_name(key):
+    """Inverse of `parse_sample_name`."""
+    return "sample_%s_%d.py" % key
+
+
+def iter_samples(dataset, root=ROOT):
+    """Yield ``(key, path)`` for every sample in `dataset`, sorted by key."""
+    directory = os.path.join(root, dataset)
+    found = []
+    for name in os.listdir(directory):
+        key = parse_sample_name(name)
+        if key is not None:
+            found.append((key, os.path.join(directory, name)))
+    found.sort()
+    return iter(found)
+
+
+def default_pack_path(dataset, build_dir=BUILD_DIR):
+    return os.path.join(build_dir, dataset + ".pack")
+
+
+def _write_atomic(path, write):
+    """Call ``write(fp)`` on a temporary file and move it over `path`."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as fp:
+            write(fp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def write_pack(path, keys, load, magic=PACK_MAGIC):
+    """Write a pack holding ``load(key)`` for each of the sorted `keys`.
+
+    The table is reserved up front and filled in once the data has been
+    streamed out, so only one record is held in memory at a time.
+    """
+    keys = list(keys)
+
+    def write(fp):
+        fp.write(_HEADER.pack(magic, len(keys)))
+        fp.write(b"\0" * (_ENTRY.size * len(keys)))
+        table = []
+        offset = _HEADER.size + _ENTRY.size * len(keys)
+        for sha, sid in keys:
+            data = load((sha, sid))
+            fp.write(data)
+            table.append(_ENTRY.pack(sha.encode("ascii"), sid, offset, len(data)))
+            offset += len(data)
+        fp.seek(_HEADER.size)
+        fp.write(b"".join(table))
+
+    _write_atomic(path, write)
+    return path
+
+
+def _read_file(path):
+    with open(path, "rb") as fp:
+        return fp.read()
+
+
+def build_pack(dataset, path=None, root=ROOT):
+    """Pack every sample of `dataset` into one file and return its path."""
+    if path is None:
+        path = default_pack_path(dataset)
+    paths = dict(iter_samples(dataset, root))
+    return write_pack(path, sorted(paths), lambda key: _read_file(paths[key]))
+
+
+class CorpusPack(object):
+    """Read-only view of a pack written by `write_pack`.
+
+    Indexing with a ``(hash, id)`` key returns a ``memoryview`` into the
+    mapping; no data is copied.  Views must be released before `close`
+    is called, since a mapping with live exports cannot be unmapped.
+    """
+
+    magic = PACK_MAGIC
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        magic, count = _HEADER.unpack_from(self._map, 0)
+        if magic != self.magic:
+            self.close()
+            raise ValueError("%s is not a %s file" % (path, type(self).__name__))
+        self._keys = []
+        self._index = {}
+        for sha, sid, offset, length in _ENTRY.iter_unpack(
+                self._view[_HEADER.size:_HEADER.size + _ENTRY.size * count]):
+            key = (sha.decode("ascii"), sid)
+            self._keys.append(key)
+            self._index[key] = (offset, length)
+
+    @classmethod
+    def open(cls, dataset, build_dir=BUILD_DIR):
+        return cls(default_pack_path(dataset, build_dir))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __getitem__(self, key):
+        offset, length = self._index[key]
+        return self._view[offset:offset + length]
+
+    def get(self, key, default=None):
+        if key not in self._index:
+            return default
+        return self[key]
+
+    def text(self, key, encoding="utf-8"):
+        """Decoded source of one sample (this one does copy)."""
+        return str(self[key], encoding)
+
+    def items(self):
+        """Stream ``(key, memoryview)`` pairs in key order."""
+        for key in self._keys:
+            yield key, self[key]
+
+    def close(self):
+        if self._map is not None:
+            self._view.release()
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tools.corpus")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="pack datasets into mmap-able blobs")
+    build.add_argument("datasets", nargs="*", default=DATASETS)
+    build.add_argument("--out", default=BUILD_DIR, help="output directory")
+    args = parser.parse_args(argv)
+
+    for dataset in args.datasets:
+        path = build_pack(dataset, default_pack_path(dataset, args.out))
+        with CorpusPack(path) as pack:
+            count = len(pack)
+        sys.stdout.write("%s: %d samples -> %s\n" % (dataset, count, path))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""Locate the lines that differ between the variants of each sample.
+
+For every ``(hash, id)`` key the variant from the lowest-numbered dataset
+is taken as the base and each other variant is aligned against it with
+Myers' O(ND) diff.  Results are streamed as JSON lines, one per variant
+pair::
+
+    {"hash": "35f766e019", "id": 2684, "base": "dataset_1vulns",
+     "variant": "dataset_3vulns", "spans": [[484, 485, 484, 485], ...]}
+
+Each span is ``[i1, i2, j1, j2]``: base lines ``i1:i2`` (0-based,
+half-open) were replaced by variant lines ``j1:j2``, the same convention
+as ``difflib.SequenceMatcher.get_opcodes``.
+
+Keys are farmed out to a process pool through ``imap``, so only the
+results that have not yet been written are held in memory.
+
+Usage::
+
+    python -m tools.spans [-j N] [-o spans.jsonl]
+"""
+
+import argparse
+import json
+import multiprocessing
+import sys
+
+from tools.corpus import DATASETS, ROOT, iter_samples
+
+
+def _intern(a, b):
+    """Map the lines of `a` and `b` to small ints so equality is cheap."""
+    ids = {}
+    return ([ids.setdefault(line, len(ids)) for line in a],
+            [ids.setdefault(line, len(ids)) for line in b])
+
+
+def _forward(a, b):
+    """Greedy Myers forward pass; return the V map seen at each distance."""
+    n, m = len(a), len(b)
+    v = {1: 0}
+    trace = []
+    for d in range(n + m + 1):
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return trace
+    return trace
+
+
+def _snakes(a, b):
+    """Return the matching runs ``(x, y, length)`` of a shortest edit script.
+
+    Only the diagonals reachable at each edit distance are kept for the
+    backtrack, so memory is O(D**2) rather than O((N + M) * D).
+    """
+    trace = _forward(a, b)
+    runs = []
+    x, y = len(a), len(b)
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        mid_x = prev_x if prev_k == k + 1 else prev_x + 1
+        if x > mid_x:
+            runs.append((mid_x, mid_x - k, x - mid_x))
+        x, y = prev_x, prev_y
+    runs.reverse()
+    return runs
+
+
+def _matches(a, b):
+    """Matching runs between `a` and `b` in their own coordinates.
+
+    Lines that occur on only one side can never match, so they are
+    dropped before the search (as GNU diff does); on heavily edited
+    files this is what keeps D, and with it the search, small.  Runs
+    found in the filtered sequences are split wherever the dropped lines
+    break their contiguity.
+    """
+    in_a, in_b = set(a), set(b)
+    ka = [i for i, line in enumerate(a) if line in in_b]
+    kb = [j for j, line in enumerate(b) if line in in_a]
+    runs = []
+    for x, y, length in _snakes([a[i] for i in ka], [b[j] for j in kb]):
+        start = x
+        for t in range(x + 1, x + length + 1):
+            u = y + t - x
+            if (t == x + length or ka[t] != ka[t - 1] + 1
+                    or kb[u] != kb[u - 1] + 1):
+                runs.append((ka[start], kb[y + start - x], t - start))
+                start = t
+    return runs
+
+
+def diff_lines(a, b):
+    """Opcodes ``(i1, i2, j1, j2)`` for the changed regions between `a` and `b`.
+
+    `a` and `b` are sequences of hashable lines.  Common prefix and suffix
+    are stripped before the O(ND) search.
+    """
+    n, m = len(a), len(b)
+    lo = 0
+    while lo < n and lo < m and a[lo] == b[lo]:
+        lo += 1
+    hi = 0
+    while hi < n - lo and hi < m - lo and a[n - 1 - hi] == b[m - 1 - hi]:
+        hi += 1
+    ia, ib = _intern(a[lo:n - hi], b[lo:m - hi])
+
+    ops = []
+    x = y = 0
+    for rx, ry, length in _matches(ia, ib) + [(len(ia), len(ib), 0)]:
+        if rx > x or ry > y:
+            ops.append((lo + x, lo + rx, lo + y, lo + ry))
+        x, y = rx + length, ry + length
+    return ops
+
+
+def _collect(root):
+    paths = {}
+    for dataset in DATASETS:
+        for key, path in iter_samples(dataset, root):
+            paths.setdefault(key, []).append((dataset, path))
+    return paths
+
+
+def _read_lines(path):
+    with open(path, "rb") as fp:
+        return fp.read().splitlines(True)
+
+
+def _sample_spans(item):
+    key, variants = item
+    (base, base_path), others = variants[0], variants[1:]
+    a = _read_lines(base_path)
+    out = []
+    for dataset, path in others:
+        out.append({"hash": key[0], "id": key[1], "base": base,
+                    "variant": dataset, "spans": diff_lines(a, _read_lines(path))})
+    return out
+
+
+def iter_spans(root=ROOT, workers=None):
+    """Yield one span record per (base, variant) pair, in key order."""
+    items = sorted(_collect(root).items())
+    if workers == 1:
+        for item in items:
+            for record in _sample_spans(item):
+                yield record
+        return
+    with multiprocessing.Pool(workers) as pool:
+        for records in pool.imap(_sample_spans, items, chunksize=8):
+            for record in records:
+                yield record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tools.spans")
+    parser.add_argument("-j", "--workers", type=int, default=None)
+    parser.add_argument("-o", "--output", default="-")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    try:
+        for record in iter_spans(workers=args.workers):
+            out.write(json.dumps(record) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
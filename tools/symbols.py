@@ -0,0 +1,340 @@
+"""Persistent inverted index of symbols across the sample corpus.
+
+Four kinds of symbol are indexed, each mapped to the ``(dataset, key,
+line)`` places it occurs:
+
+    class    names bound by ``class`` statements
+    def      names bound by ``def`` / ``async def``
+    import   modules named by ``import`` / ``from ... import`` (both
+             ``pkg.mod`` and ``pkg.mod.name`` for the latter)
+    call     call targets, both the dotted form (``np.array``) and the
+             final attribute (``array``)
+
+Samples that parse are walked through `tools.ast_cache`; the rest (the
+Python 2 ones, mostly) fall back to line regexes.
+
+Index layout (integers are little-endian, sections in this order)::
+
+    header  magic 8s b"VCSYMX01", nfiles Q, nterms Q, nposts Q
+    files   nfiles * (dataset B, hash 10s, id I, size Q, mtime_ns Q,
+                      digest 20s)
+    terms   (nterms + 1) * Q offsets into the term blob
+    starts  (nterms + 1) * Q offsets into the postings
+    posts   nposts * (file I, line I), grouped by term
+    blob    the sorted terms, each ``kind byte + b":" + name``
+
+Lookups binary-search the mapped term table, so no part of the index is
+loaded up front.  Rebuilding reuses the postings of every file whose
+size and mtime (or, failing that, content digest) are unchanged.
+
+Usage::
+
+    python -m tools.symbols build
+    python -m tools.symbols lookup JSONEncoder --kind class
+"""
+
+import argparse
+import ast
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+
+from tools.ast_cache import AstCache
+from tools.corpus import BUILD_DIR, DATASETS, ROOT, iter_samples
+
+INDEX_MAGIC = b"VCSYMX01"
+DEFAULT_PATH = os.path.join(BUILD_DIR, "symbols.idx")
+KINDS = {"class": b"c", "def": b"f", "import": b"i", "call": b"k"}
+
+_HEADER = struct.Struct("<8sQQQ")
+_FILE = struct.Struct("<B10sIQQ20s")
+_OFFSET = struct.Struct("<Q")
+_POST = struct.Struct("<II")
+
+_CLASS_RE = re.compile(r"^\s*class\s+([A-Za-z_]\w*)")
+_DEF_RE = re.compile(r"^\s*(?:async\s+)?def\s+([A-Za-z_]\w*)")
+_IMPORT_RE = re.compile(r"^\s*import\s+(.+)")
+_FROM_RE = re.compile(r"^\s*from\s+([\w.]+)\s+import\s+\(?\s*([\w\s,]+)")
+_CALL_RE = re.compile(r"([A-Za-z_][\w.]*)\s*\(")
+_NOT_CALLS = frozenset(("if", "elif", "while", "for", "return", "and", "or",
+                        "not", "in", "is", "print", "except", "with", "assert",
+                        "lambda", "yield", "del", "class", "def"))
+
+
+def _dotted(node):
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(node.id)
+    return ".".join(reversed(parts))
+
+
+def _call_terms(target):
+    yield KINDS["call"], target
+    if "." in target:
+        yield KINDS["call"], target.rsplit(".", 1)[1]
+
+
+def _from_ast(tree):
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ClassDef):
+            yield KINDS["class"], node.name, node.lineno
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            yield KINDS["def"], node.name, node.lineno
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                yield KINDS["import"], alias.name, node.lineno
+        elif isinstance(node, ast.ImportFrom):
+            module = "." * node.level + (node.module or "")
+            yield KINDS["import"], module, node.lineno
+            for alias in node.names:
+                if alias.name != "*":
+                    yield KINDS["import"], module.rstrip(".") + "." + alias.name, node.lineno
+        elif isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Attribute):
+                target = _dotted(node.func) or node.func.attr
+            elif isinstance(node.func, ast.Name):
+                target = node.func.id
+            else:
+                continue
+            for kind, name in _call_terms(target):
+                yield kind, name, node.lineno
+
+
+def _from_lines(text):
+    for lineno, line in enumerate(text.splitlines(), 1):
+        m = _CLASS_RE.match(line)
+        if m:
+            yield KINDS["class"], m.group(1), lineno
+            continue
+        m = _DEF_RE.match(line)
+        if m:
+            yield KINDS["def"], m.group(1), lineno
+            continue
+        m = _FROM_RE.match(line)
+        if m:
+            module = m.group(1)
+            yield KINDS["import"], module, lineno
+            for name in m.group(2).replace(",", " ").split():
+                yield KINDS["import"], module + "." + name, lineno
+            continue
+        m = _IMPORT_RE.match(line)
+        if m:
+            for part in m.group(1).split(","):
+                name = part.split(" as ")[0].strip()
+                if name:
+                    yield KINDS["import"], name, lineno
+            continue
+        for target in _CALL_RE.findall(line):
+            if target not in _NOT_CALLS:
+                for kind, name in _call_terms(target):
+                    yield kind, name, lineno
+
+
+def extract(data, cache=None, filename="<unknown>"):
+    """Return the sorted, de-duplicated ``(term, line)`` pairs of a source."""
+    if cache is None:
+        cache = AstCache()
+    try:
+        found = _from_ast(cache.parse(data, filename))
+    except (SyntaxError, ValueError):
+        found = _from_lines(data.decode("utf-8", "replace"))
+    return sorted({(kind + b":" + name.encode("utf-8"), line)
+                   for kind, name, line in found})
+
+
+class SymbolIndex(object):
+    """Memory-mapped reader for an index written by `build_index`."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        with open(path, "rb") as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.nfiles, self.nterms, self.nposts = _HEADER.unpack_from(self._map, 0)
+        if magic != INDEX_MAGIC:
+            self.close()
+            raise ValueError("%s is not a symbol index" % path)
+        self._files_at = _HEADER.size
+        self._terms_at = self._files_at + _FILE.size * self.nfiles
+        self._starts_at = self._terms_at + _OFFSET.size * (self.nterms + 1)
+        self._posts_at = self._starts_at + _OFFSET.size * (self.nterms + 1)
+        self._blob_at = self._posts_at + _POST.size * self.nposts
+
+    def file(self, number):
+        """``(dataset, key, size, mtime_ns, digest)`` of file `number`."""
+        dataset, sha, sid, size, mtime, digest = _FILE.unpack_from(
+            self._map, self._files_at + _FILE.size * number)
+        return DATASETS[dataset], (sha.decode("ascii"), sid), size, mtime, digest
+
+    def _offset(self, table, i):
+        return _OFFSET.unpack_from(self._map, table + _OFFSET.size * i)[0]
+
+    def term(self, i):
+        lo = self._offset(self._terms_at, i)
+        hi = self._offset(self._terms_at, i + 1)
+        return self._map[self._blob_at + lo:self._blob_at + hi]
+
+    def _find(self, term):
+        lo, hi = 0, self.nterms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < term:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.nterms and self.term(lo) == term:
+            return lo
+        return None
+
+    def postings(self, i):
+        """``(file, line)`` pairs of term number `i`."""
+        start = self._offset(self._starts_at, i)
+        stop = self._offset(self._starts_at, i + 1)
+        at = self._posts_at + _POST.size * start
+        return list(_POST.iter_unpack(self._map[at:at + _POST.size * (stop - start)]))
+
+    def lookup(self, name, kind=None):
+        """Return ``(dataset, key, line)`` for every occurrence of `name`.
+
+        `kind` is one of the `KINDS` names; by default all kinds match.
+        """
+        kinds = [kind] if kind is not None else sorted(KINDS)
+        out = []
+        for k in kinds:
+            i = self._find(KINDS[k] + b":" + name.encode("utf-8"))
+            if i is None:
+                continue
+            for number, line in self.postings(i):
+                dataset, key = self.file(number)[:2]
+                out.append((dataset, key, line))
+        return out
+
+    def items(self):
+        """Yield ``(term, postings)`` for every term, in order."""
+        for i in range(self.nterms):
+            yield self.term(i), self.postings(i)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _previous(path):
+    """``{(dataset, key): (size, mtime, digest, [(term, line)])}`` of an old index."""
+    if not os.path.exists(path):
+        return {}
+    try:
+        index = SymbolIndex(path)
+    except ValueError:
+        return {}
+    with index:
+        files = [index.file(n) for n in range(index.nfiles)]
+        old = dict(((d, k), (s, m, g, [])) for d, k, s, m, g in files)
+        for term, postings in index.items():
+            for number, line in postings:
+                dataset, key = files[number][:2]
+                old[dataset, key][3].append((term, line))
+    return old
+
+
+def _write(path, files, entries):
+    """Write `files` (list of file tuples) and their `entries` lists."""
+    terms = {}
+    for number, pairs in enumerate(entries):
+        for term, line in pairs:
+            terms.setdefault(term, []).append((number, line))
+    ordered = sorted(terms)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as fp:
+        nposts = sum(len(p) for p in terms.values())
+        fp.write(_HEADER.pack(INDEX_MAGIC, len(files), len(ordered), nposts))
+        for dataset, key, size, mtime, digest in files:
+            fp.write(_FILE.pack(DATASETS.index(dataset), key[0].encode("ascii"),
+                                key[1], size, mtime, digest))
+        offset = 0
+        for term in ordered:
+            fp.write(_OFFSET.pack(offset))
+            offset += len(term)
+        fp.write(_OFFSET.pack(offset))
+        offset = 0
+        for term in ordered:
+            fp.write(_OFFSET.pack(offset))
+            offset += len(terms[term])
+        fp.write(_OFFSET.pack(offset))
+        for term in ordered:
+            fp.write(b"".join(_POST.pack(n, line) for n, line in terms[term]))
+        fp.write(b"".join(ordered))
+    os.replace(tmp, path)
+
+
+def build_index(path=DEFAULT_PATH, datasets=DATASETS, root=ROOT, cache=None):
+    """(Re)build the index at `path`; return ``(reused, extracted)`` counts."""
+    if cache is None:
+        cache = AstCache()
+    old = _previous(path)
+    files, entries = [], []
+    reused = extracted = 0
+    for dataset in datasets:
+        for key, p in iter_samples(dataset, root):
+            st = os.stat(p)
+            prev = old.get((dataset, key))
+            if prev is not None and prev[:2] == (st.st_size, st.st_mtime_ns):
+                files.append((dataset, key) + prev[:3])
+                entries.append(prev[3])
+                reused += 1
+                continue
+            with open(p, "rb") as fp:
+                data = fp.read()
+            digest = hashlib.blake2b(data, digest_size=20).digest()
+            if prev is not None and prev[2] == digest:
+                pairs = prev[3]
+                reused += 1
+            else:
+                pairs = extract(data, cache, p)
+                extracted += 1
+            files.append((dataset, key, len(data), st.st_mtime_ns, digest))
+            entries.append(pairs)
+    _write(path, files, entries)
+    return reused, extracted
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tools.symbols")
+    parser.add_argument("--index", default=DEFAULT_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("build", help="build or refresh the index")
+    lookup = sub.add_parser("lookup", help="find a symbol")
+    lookup.add_argument("name")
+    lookup.add_argument("--kind", choices=sorted(KINDS))
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        reused, extracted = build_index(args.index)
+        sys.stdout.write("%d files reused, %d extracted -> %s\n"
+                         % (reused, extracted, args.index))
+        return 0
+    with SymbolIndex(args.index) as index:
+        for dataset, key, line in index.lookup(args.name, args.kind):
+            sys.stdout.write("%s/sample_%s_%d.py:%d\n" % ((dataset,) + key + (line,)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,180 @@
+"""Delta storage for the 1/3/5/9-vuln variants of each sample.
+
+Most samples exist in all four ``dataset_*vulns`` directories and the
+copies differ only in the injected lines.  The variant store keeps one
+base text per ``(hash, id)`` key plus, for every other variant, the list
+of line ranges that replace part of the base.  It is written in the pack
+format from `tools.corpus`, one record per key, so lookups are a table
+probe into a memory map.
+
+A record is ``marshal.dumps((base_index, base, deltas))`` where
+`base_index` indexes `DATASETS`, `base` is the raw bytes of that variant
+and `deltas` is a tuple of ``(dataset_index, ops)``.  Each op is
+``(i1, i2, data)``: base lines ``i1:i2`` are replaced by the bytes
+`data`.  Line boundaries are those of ``bytes.splitlines(keepends=True)``
+so every variant is reproduced byte for byte.
+
+Usage::
+
+    python -m tools.variants build
+    python -m tools.variants show 35f766e019 2684 dataset_9vulns
+"""
+
+import argparse
+import marshal
+import os
+import sys
+
+from tools.corpus import (BUILD_DIR, DATASETS, ROOT, CorpusPack, iter_samples,
+                          write_pack)
+from tools.spans import diff_lines
+
+DELTA_MAGIC = b"VCDELT01"
+DEFAULT_PATH = os.path.join(BUILD_DIR, "variants.delta")
+
+
+def line_delta(a, b):
+    """Return the ops that turn line list `a` into line list `b`."""
+    return tuple((i1, i2, b"".join(b[j1:j2])) for i1, i2, j1, j2 in diff_lines(a, b))
+
+
+def apply_delta(lines, ops):
+    """Rebuild a variant from the base `lines` and its `ops`."""
+    out = []
+    pos = 0
+    for i1, i2, data in ops:
+        out.extend(lines[pos:i1])
+        out.append(data)
+        pos = i2
+    out.extend(lines[pos:])
+    return b"".join(out)
+
+
+def encode_record(variants):
+    """Encode ``{dataset_index: bytes}`` as one store record."""
+    indexes = sorted(variants)
+    base_index = indexes[0]
+    base = variants[base_index]
+    base_lines = base.splitlines(True)
+    deltas = []
+    for index in indexes[1:]:
+        deltas.append((index, line_delta(base_lines, variants[index].splitlines(True))))
+    return marshal.dumps((base_index, base, tuple(deltas)))
+
+
+def _collect(root):
+    paths = {}
+    for index, dataset in enumerate(DATASETS):
+        for key, path in iter_samples(dataset, root):
+            paths.setdefault(key, {})[index] = path
+    return paths
+
+
+def build_store(path=DEFAULT_PATH, root=ROOT):
+    """Write the variant store for every sample under `root`."""
+    paths = _collect(root)
+
+    def load(key):
+        variants = {}
+        for index, p in paths[key].items():
+            with open(p, "rb") as fp:
+                variants[index] = fp.read()
+        return encode_record(variants)
+
+    return write_pack(path, sorted(paths), load, magic=DELTA_MAGIC)
+
+
+class _DeltaPack(CorpusPack):
+    magic = DELTA_MAGIC
+
+
+class VariantStore(object):
+    """Reader for a store written by `build_store`.
+
+    Variants are materialized on demand; ``store.get(key, dataset)``
+    returns the same bytes as the file ``dataset/sample_<hash>_<id>.py``.
+    """
+
+    def __init__(self, path=DEFAULT_PATH):
+        self._pack = _DeltaPack(path)
+
+    def __len__(self):
+        return len(self._pack)
+
+    def __contains__(self, key):
+        return key in self._pack
+
+    def __iter__(self):
+        return iter(self._pack)
+
+    def _record(self, key):
+        view = self._pack[key]
+        try:
+            return marshal.loads(view)
+        finally:
+            view.release()
+
+    def datasets(self, key):
+        """Names of the datasets that hold a variant of `key`."""
+        base_index, _, deltas = self._record(key)
+        indexes = [base_index] + [index for index, _ in deltas]
+        return [DATASETS[index] for index in sorted(indexes)]
+
+    def get(self, key, dataset):
+        """Materialize the `dataset` variant of sample `key`."""
+        index = DATASETS.index(dataset)
+        base_index, base, deltas = self._record(key)
+        if index == base_index:
+            return base
+        for delta_index, ops in deltas:
+            if delta_index == index:
+                return apply_delta(base.splitlines(True), ops)
+        raise KeyError((key, dataset))
+
+    def variants(self, key):
+        """Return ``{dataset: bytes}`` for every variant of `key`."""
+        base_index, base, deltas = self._record(key)
+        lines = base.splitlines(True)
+        out = {DATASETS[base_index]: base}
+        for index, ops in deltas:
+            out[DATASETS[index]] = apply_delta(lines, ops)
+        return out
+
+    def close(self):
+        self._pack.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m tools.variants")
+    parser.add_argument("--store", default=DEFAULT_PATH)
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("build", help="write the variant store")
+    show = sub.add_parser("show", help="print one variant")
+    show.add_argument("hash")
+    show.add_argument("id", type=int)
+    show.add_argument("dataset", choices=DATASETS)
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        build_store(args.store)
+        original = sum(os.path.getsize(p) for d in DATASETS
+                       for _, p in iter_samples(d))
+        with VariantStore(args.store) as store:
+            count = len(store)
+        size = os.path.getsize(args.store)
+        sys.stdout.write("%d samples, %d -> %d bytes (%.1fx) -> %s\n"
+                         % (count, original, size, float(original) / size, args.store))
+    else:
+        with VariantStore(args.store) as store:
+            sys.stdout.buffer.write(store.get((args.hash, args.id), args.dataset))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())